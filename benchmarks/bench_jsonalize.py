@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+"""
+jsonalize benchmarks.
+
+Run from the root of the project with::
+
+    PYTHONPATH=. python benchmarks/bench_jsonalize.py [benchmark...]
+"""
+import time
+from copy import deepcopy
+from optparse import OptionParser
+from pyflu import jsonalize
+from pyflu.jsonalize import JSONAlizable, JSONAlizableBase, reverse_registry, \
+        looks_like_mapping, is_serialized_state, get_class, JSONAlizeError
+
+
+class Point(JSONAlizable):
+
+    schema = {
+            "x": 0,
+            "y": 0,
+            "label": "",
+        }
+
+
+class Shape(JSONAlizable):
+
+    schema = {
+            "name": "",
+            "points": [],
+            "attributes": {},
+            "closed": False,
+        }
+
+
+class Layer(JSONAlizable):
+
+    schema = {
+            "name": "layer",
+            "origin": Point(),
+            "clip": [slice(0, 10), slice(0, 10)],
+            "shapes": [],
+            "visible": True,
+        }
+
+
+def make_shapes(count, points=10):
+    shapes = []
+    for i in range(count):
+        shape = Shape(name="shape %d" % i, closed=bool(i % 2),
+                attributes={"color": "red", "width": i})
+        shape.points = [Point(x=j, y=i, label="p%d" % j)
+                for j in range(points)]
+        shapes.append(shape)
+    return shapes
+
+
+# Reference implementation, dispatching values at each level like jsonalize
+# did before codec plans
+
+def reference_serialize(obj):
+    obj_type = type(obj)
+    if obj_type in reverse_registry:
+        uncall, name = reverse_registry[obj_type]
+        if isinstance(obj, JSONAlizableBase):
+            args = ()
+            kwargs = {}
+            for field in obj.schema:
+                kwargs[field] = reference_serialize(getattr(obj, field))
+        else:
+            args, kwargs = uncall(obj)
+        data = {
+                "__class__": name,
+                "__args__": args,
+                "__kwargs__": kwargs,
+            }
+    elif looks_like_mapping(obj):
+        data = {}
+        for key, value in obj.iteritems():
+            data[key] = reference_serialize(value)
+    elif isinstance(obj, (list, tuple)):
+        data = []
+        for value in obj:
+            data.append(reference_serialize(value))
+    else:
+        data = obj
+    return data
+
+
+def reference_unserialize(state):
+    if isinstance(state, list):
+        ret = []
+        for value in state:
+            ret.append(reference_unserialize(value))
+    elif isinstance(state, dict):
+        if is_serialized_state(state):
+            cls = get_class(state["__class__"])
+            kwargs = {}
+            for key, value in state["__kwargs__"].items():
+                kwargs[str(key)] = value
+            if issubclass(cls, JSONAlizableBase):
+                ret = cls.__new__(cls)
+                reference_init(ret, kwargs)
+            else:
+                ret = cls(*state["__args__"], **kwargs)
+        else:
+            ret = {}
+            for key, value in state.items():
+                ret[key] = reference_unserialize(value)
+    else:
+        ret = state
+    return ret
+
+
+def reference_copy(obj):
+    return jsonalize.loads(jsonalize.dumps(obj))
+
+
+def reference_init(obj, kwargs):
+    # Emulate JSONAlizableBase.__init__(), which copied the default value of
+    # every field, even when it was passed in *kwargs*
+    for name, default in obj.schema.items():
+        try:
+            default_copy = reference_copy(default)
+        except (JSONAlizeError, TypeError):
+            default_copy = deepcopy(default)
+        setattr(obj, name,
+                reference_unserialize(kwargs.pop(name, default_copy)))
+    if kwargs:
+        raise NameError("unknown parameters passed to constructor: %s" %
+                ", ".join(kwargs.keys()))
+
+
+def reference_construct(cls):
+    obj = cls.__new__(cls)
+    reference_init(obj, {})
+    return obj
+
+
+def timed(func, *args, **kwargs):
+    """
+    Returns the best time of three calls of *func* with *args* and *kwargs*.
+    """
+    best = None
+    for i in range(3):
+        start = time.time()
+        func(*args, **kwargs)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def print_row(name, reference, current):
+    print "%-24s %10.4f %10.4f %8.2fx" % (name, reference, current,
+            reference / current)
+
+
+def bench_codec_plans(count):
+    print "Serializing %d shapes of 10 points" % count
+    print "%-24s %10s %10s %9s" % ("", "reference", "current", "speedup")
+    shapes = make_shapes(count)
+    state = jsonalize.serialize(shapes)
+    assert reference_serialize(shapes) == state
+    print_row("serialize", timed(reference_serialize, shapes),
+            timed(jsonalize.serialize, shapes))
+    print_row("unserialize", timed(reference_unserialize, state),
+            timed(jsonalize.unserialize, state))
+
+
+def bench_construct(count):
+    print "Constructing %d objects with default values" % count
+    print "%-24s %10s %10s %9s" % ("", "reference", "current", "speedup")
+    for cls in (Point, Shape, Layer):
+        def reference():
+            for i in xrange(count):
+                reference_construct(cls)
+        def current():
+            for i in xrange(count):
+                cls()
+        print_row(cls.__name__, timed(reference), timed(current))
+
+
+def bench_backends(count):
+    print "Dumping and loading %d shapes of 10 points" % count
+    datasets = [("shapes", make_shapes(count))]
+    try:
+        import numpy as np
+    except ImportError:
+        pass
+    else:
+        datasets.append(("float32 array",
+            np.random.rand(count * 10).astype("float32")))
+    print "%-16s %-8s %12s %10s %10s" % ("", "backend", "size", "dumps",
+            "loads")
+    for name, obj in datasets:
+        for backend in ("json", "binary"):
+            data = jsonalize.dumps(obj, backend=backend)
+            print "%-16s %-8s %12d %10.5f %10.5f" % (name, backend,
+                    len(data),
+                    timed(jsonalize.dumps, obj, backend=backend),
+                    timed(jsonalize.loads, data, backend=backend))
+
+
+def make_chain(depth):
+    chain = None
+    for i in xrange(depth):
+        chain = Shape(name="shape %d" % i, points=[chain])
+    return chain
+
+
+def try_timed(func, *args, **kwargs):
+    try:
+        return "%10.4f" % timed(func, *args, **kwargs)
+    except RuntimeError:
+        return "%10s" % "overflow"
+
+
+def bench_deep(count):
+    print "Deep (nested shapes) and wide (%d shapes of 10 points) graphs" \
+            % count
+    print "%-24s %10s %10s %10s %10s" % ("", "serialize", "deep",
+            "unserial.", "deep")
+    graphs = [("wide", make_shapes(count))]
+    for depth in (100, 1000, count):
+        graphs.append(("depth %d" % depth, make_chain(depth)))
+    for name, obj in graphs:
+        state = jsonalize.serialize_deep(obj)
+        print "%-24s %s %s %s %s" % (name,
+                try_timed(jsonalize.serialize, obj),
+                try_timed(jsonalize.serialize_deep, obj),
+                try_timed(jsonalize.unserialize, state),
+                try_timed(jsonalize.unserialize_deep, state))
+
+
+benchmarks = {
+        "backends": bench_backends,
+        "construct": bench_construct,
+        "deep": bench_deep,
+        "plans": bench_codec_plans,
+    }
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] [benchmark...]")
+    parser.add_option("-n", "--count", type="int", default=10000,
+            help="number of objects to process")
+    options, args = parser.parse_args()
+    names = args or sorted(benchmarks)
+    for name in names:
+        benchmarks[name](options.count)
+        print
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+"""
+pyflu.update benchmarks.
+
+Run from the root of the project with::
+
+    PYTHONPATH=. python benchmarks/bench_update.py [benchmark...]
+
+The test fixtures in pyflu/tests/test_update/data are used by default, the
+--old and --new options select other trees.
+"""
+import os
+import time
+import shutil
+import tempfile
+from os.path import join, dirname, getsize
+from optparse import OptionParser
+import pyflu.update
+from pyflu.update import diff, patch, control_sum, digest_algorithms, \
+        compression
+from pyflu.update.compression import codecs
+from pyflu.update.chain import patch_chain
+
+
+data_dir = join(dirname(__file__), "..", "pyflu", "tests", "test_update",
+        "data")
+
+
+def timed(func, *args, **kwargs):
+    """
+    Returns the best time of three calls of *func* with *args* and *kwargs*.
+    """
+    best = None
+    for i in range(3):
+        start = time.time()
+        func(*args, **kwargs)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_codecs(old_dir, new_dir, work_dir):
+    print "Patch archive codecs (%s -> %s)" % (old_dir, new_dir)
+    print "%-8s %-8s %10s %10s %10s" % ("codec", "archive", "size", "build",
+            "apply")
+    patch_file = join(work_dir, "patch")
+    dest_dir = join(work_dir, "dest")
+    def apply_patch():
+        if os.path.isdir(dest_dir):
+            shutil.rmtree(dest_dir)
+        patch(patch_file, old_dir, dest_dir)
+    for name in sorted(codecs):
+        for indexed in (False, True):
+            build_time = timed(diff, patch_file, old_dir, new_dir, 
+                    codec=name, indexed=indexed)
+            print "%-8s %-8s %10d %10.4f %10.4f" % (name, 
+                    "indexed" if indexed else "tar", getsize(patch_file),
+                    build_time, timed(apply_patch))
+
+
+def bench_parallel(old_dir, new_dir, work_dir):
+    print "Parallel patching (%s -> %s)" % (old_dir, new_dir)
+    print "%-8s %-10s %8s %10s" % ("archive", "pool", "workers", "apply")
+    patch_file = join(work_dir, "patch")
+    dest_dir = join(work_dir, "dest")
+    def apply_patch(**kwargs):
+        if os.path.isdir(dest_dir):
+            shutil.rmtree(dest_dir)
+        patch(patch_file, old_dir, dest_dir, **kwargs)
+    for indexed in (False, True):
+        diff(patch_file, old_dir, new_dir, indexed=indexed)
+        for processes, workers in ((False, 1), (False, 4), (True, 4)):
+            print "%-8s %-10s %8d %10.4f" % (
+                    "indexed" if indexed else "tar",
+                    "processes" if processes else "threads", workers,
+                    timed(apply_patch, workers=workers, processes=processes))
+        if not indexed:
+            # Pools decompress tar archives first, separate the time it saves
+            # from the time saved by the pool itself
+            compressed_file = patch_file + ".bz2"
+            os.rename(patch_file, compressed_file)
+            compression.decompress(compressed_file, patch_file)
+            print "%-8s %-10s %8d %10.4f" % ("raw tar", "threads", 1,
+                    timed(apply_patch))
+
+
+def make_tree(root, files=32, size=2**21):
+    """
+    Create a tree of *files* random files of *size* bytes in *root*.
+    """
+    for i in range(files):
+        sub_dir = join(root, "dir%d" % (i % 4))
+        if not os.path.isdir(sub_dir):
+            os.makedirs(sub_dir)
+        fp = open(join(sub_dir, "file%d" % i), "wb")
+        fp.write(os.urandom(size))
+        fp.close()
+
+
+def bench_hashing(old_dir, new_dir, work_dir):
+    tree = join(work_dir, "tree")
+    make_tree(tree)
+    paths = [join(base, f) for base, dirs, files in os.walk(tree)
+            for f in files]
+    total = sum(getsize(p) for p in paths) / float(2**20)
+    print "Control sums of a synthetic tree (%d files, %d MB)" % (
+            len(paths), total)
+    print "%-8s %8s %10s %10s" % ("digest", "buffer", "time", "MB/s")
+    default_size = pyflu.update.control_sum_buffer_size
+    try:
+        for name in sorted(digest_algorithms):
+            for buffer_size in (2**12, 2**16, default_size):
+                pyflu.update.control_sum_buffer_size = buffer_size
+                elapsed = timed(lambda: [control_sum(p, name) 
+                    for p in paths])
+                print "%-8s %8d %10.4f %10.1f" % (name, buffer_size, 
+                        elapsed, total / elapsed)
+    finally:
+        pyflu.update.control_sum_buffer_size = default_size
+        shutil.rmtree(tree)
+
+
+def bench_chain(old_dir, new_dir, work_dir):
+    versions = [join(work_dir, "v0")]
+    make_tree(versions[0], size=2**18)
+    patches = []
+    for i in range(10):
+        # Each version changes two files of the previous one
+        versions.append(join(work_dir, "v%d" % (i + 1)))
+        shutil.copytree(versions[-2], versions[-1])
+        for j in (i, i + 10):
+            path = join(versions[-1], "dir%d" % (j % 4), "file%d" % j)
+            fp = open(path, "r+b")
+            fp.seek(1000 * (i + 1))
+            fp.write(os.urandom(100))
+            fp.close()
+        patches.append(join(work_dir, "patch-%d" % i))
+        diff(patches[-1], versions[-2], versions[-1])
+    print "Chains of patches (32 files, 8 MB, 2 files changed per patch)"
+    print "%-8s %12s %12s" % ("patches", "sequential", "single pass")
+    dest_dirs = [join(work_dir, "dest1"), join(work_dir, "dest2")]
+    def clean():
+        for path in dest_dirs:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+    def apply_sequential(count):
+        clean()
+        src_dir = versions[0]
+        for i in range(count):
+            patch(patches[i], src_dir, dest_dirs[i % 2])
+            if src_dir != versions[0]:
+                shutil.rmtree(src_dir)
+            src_dir = dest_dirs[i % 2]
+    def apply_chain(count):
+        clean()
+        patch_chain(patches[:count], versions[0], dest_dirs[0])
+    try:
+        for count in (1, 2, 5, 10):
+            print "%-8d %12.4f %12.4f" % (count,
+                    timed(apply_sequential, count), timed(apply_chain, count))
+    finally:
+        clean()
+        for path in versions:
+            shutil.rmtree(path)
+
+
+benchmarks = {
+        "chain": bench_chain,
+        "codecs": bench_codecs,
+        "hashing": bench_hashing,
+        "parallel": bench_parallel,
+    }
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] [benchmark...]")
+    parser.add_option("-o", "--old", default=join(data_dir, "orig"),
+            help="original tree")
+    parser.add_option("-n", "--new", default=join(data_dir, "new"),
+            help="new tree")
+    options, args = parser.parse_args()
+    names = args or sorted(benchmarks)
+    work_dir = tempfile.mkdtemp()
+    try:
+        for name in names:
+            benchmarks[name](options.old, options.new, work_dir)
+            print
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,379 @@
+"""
+Pure Python implementation of the MessagePack binary serialization format.
+
+Supported types are None, booleans, integers fitting in 64 bits, floats,
+byte strings (``str``, encoded with the "bin" family), unicode strings
+(encoded with the "str" family), lists and tuples (as arrays), dicts (as maps)
+and :class:`ExtType` objects::
+
+    from pyflu import binpack
+
+    data = binpack.packb({"a": [1, 2.5, None]})
+    assert binpack.unpackb(data) == {"a": [1, 2.5, None]}
+
+Other types can be handled with the *default* argument of :func:`packb`,
+which is called with the unsupported object and must return a supported one,
+typically an :class:`ExtType`. The *ext_hook* argument of :func:`unpackb`
+does the opposite transformation.
+"""
+import struct
+
+
+class UnpackError(ValueError): pass
+
+
+class ExtType(object):
+    """
+    An application defined type, identified by an integer *code* between 0
+    and 127 and carrying a binary string payload, *data*.
+    """
+
+    __slots__ = ("code", "data")
+
+    def __init__(self, code, data):
+        if not 0 <= code <= 127:
+            raise ValueError("invalid extension type code: %s" % code)
+        self.code = code
+        self.data = data
+
+    def __eq__(self, other):
+        return isinstance(other, ExtType) and self.code == other.code \
+                and self.data == other.data
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def __repr__(self):
+        return "ExtType(%d, %r)" % (self.code, self.data)
+
+
+_uint8 = struct.Struct(">B")
+_uint16 = struct.Struct(">H")
+_uint32 = struct.Struct(">I")
+_uint64 = struct.Struct(">Q")
+_int8 = struct.Struct(">b")
+_int16 = struct.Struct(">h")
+_int32 = struct.Struct(">i")
+_int64 = struct.Struct(">q")
+_float32 = struct.Struct(">f")
+_float64 = struct.Struct(">d")
+_ext_header8 = struct.Struct(">BBb")
+_ext_header16 = struct.Struct(">BHb")
+_ext_header32 = struct.Struct(">BIb")
+
+# Fixed size types, indexed by type code
+_inline_structs = {
+        0xca: _float32,
+        0xcb: _float64,
+        0xcc: _uint8,
+        0xcd: _uint16,
+        0xce: _uint32,
+        0xcf: _uint64,
+        0xd0: _int8,
+        0xd1: _int16,
+        0xd2: _int32,
+        0xd3: _int64,
+    }
+
+_fixext_codes = {1: "\xd4", 2: "\xd5", 4: "\xd6", 8: "\xd7", 16: "\xd8"}
+
+
+class Packer(object):
+    """
+    MessagePack encoder.
+    """
+
+    def __init__(self, default=None):
+        self.default = default
+        self.handlers = {
+                type(None): self.pack_nil,
+                bool: self.pack_bool,
+                int: self.pack_int,
+                long: self.pack_int,
+                float: self.pack_float,
+                str: self.pack_bin,
+                unicode: self.pack_text,
+                list: self.pack_array,
+                tuple: self.pack_array,
+                dict: self.pack_map,
+                ExtType: self.pack_ext,
+            }
+
+    def pack(self, obj):
+        """
+        Returns *obj* encoded to a string.
+        """
+        chunks = []
+        self.pack_value(obj, chunks.append)
+        return "".join(chunks)
+
+    def pack_value(self, obj, write):
+        handler = self.handlers.get(type(obj))
+        if handler is None:
+            if self.default is not None:
+                obj = self.default(obj)
+                handler = self.handlers.get(type(obj))
+            if handler is None:
+                raise TypeError("can't serialize %r" % (obj,))
+        handler(obj, write)
+
+    def pack_nil(self, obj, write):
+        write("\xc0")
+
+    def pack_bool(self, obj, write):
+        if obj:
+            write("\xc3")
+        else:
+            write("\xc2")
+
+    def pack_int(self, obj, write):
+        if 0 <= obj < 0x80:
+            write(chr(obj))
+        elif -0x20 <= obj < 0:
+            write(_int8.pack(obj))
+        elif obj >= 0:
+            if obj <= 0xff:
+                write("\xcc" + chr(obj))
+            elif obj <= 0xffff:
+                write("\xcd" + _uint16.pack(obj))
+            elif obj <= 0xffffffff:
+                write("\xce" + _uint32.pack(obj))
+            elif obj <= 0xffffffffffffffff:
+                write("\xcf" + _uint64.pack(obj))
+            else:
+                self.pack_overflow(obj, write)
+        else:
+            if obj >= -0x80:
+                write("\xd0" + _int8.pack(obj))
+            elif obj >= -0x8000:
+                write("\xd1" + _int16.pack(obj))
+            elif obj >= -0x80000000:
+                write("\xd2" + _int32.pack(obj))
+            elif obj >= -0x8000000000000000:
+                write("\xd3" + _int64.pack(obj))
+            else:
+                self.pack_overflow(obj, write)
+
+    def pack_overflow(self, obj, write):
+        if self.default is None:
+            raise TypeError("integer out of range: %d" % obj)
+        replacement = self.default(obj)
+        if isinstance(replacement, (int, long)):
+            raise TypeError("integer out of range: %d" % obj)
+        self.pack_value(replacement, write)
+
+    def pack_float(self, obj, write):
+        write("\xcb" + _float64.pack(obj))
+
+    def pack_bin(self, obj, write):
+        length = len(obj)
+        if length <= 0xff:
+            write("\xc4" + chr(length))
+        elif length <= 0xffff:
+            write("\xc5" + _uint16.pack(length))
+        else:
+            write("\xc6" + _uint32.pack(length))
+        write(obj)
+
+    def pack_text(self, obj, write):
+        data = obj.encode("utf-8")
+        length = len(data)
+        if length < 32:
+            write(chr(0xa0 | length))
+        elif length <= 0xff:
+            write("\xd9" + chr(length))
+        elif length <= 0xffff:
+            write("\xda" + _uint16.pack(length))
+        else:
+            write("\xdb" + _uint32.pack(length))
+        write(data)
+
+    def pack_array(self, obj, write):
+        length = len(obj)
+        if length < 16:
+            write(chr(0x90 | length))
+        elif length <= 0xffff:
+            write("\xdc" + _uint16.pack(length))
+        else:
+            write("\xdd" + _uint32.pack(length))
+        pack_value = self.pack_value
+        for value in obj:
+            pack_value(value, write)
+
+    def pack_map(self, obj, write):
+        length = len(obj)
+        if length < 16:
+            write(chr(0x80 | length))
+        elif length <= 0xffff:
+            write("\xde" + _uint16.pack(length))
+        else:
+            write("\xdf" + _uint32.pack(length))
+        pack_value = self.pack_value
+        for key, value in obj.iteritems():
+            pack_value(key, write)
+            pack_value(value, write)
+
+    def pack_ext(self, obj, write):
+        length = len(obj.data)
+        if length in _fixext_codes:
+            write(_fixext_codes[length] + chr(obj.code))
+        elif length <= 0xff:
+            write(_ext_header8.pack(0xc7, length, obj.code))
+        elif length <= 0xffff:
+            write(_ext_header16.pack(0xc8, length, obj.code))
+        else:
+            write(_ext_header32.pack(0xc9, length, obj.code))
+        write(obj.data)
+
+
+class Unpacker(object):
+    """
+    MessagePack decoder, reading values from the string *data*.
+    """
+
+    def __init__(self, data, ext_hook=None):
+        self.data = data
+        self.pos = 0
+        self.ext_hook = ext_hook
+
+    def unpack(self):
+        """
+        Decode and return the next value.
+        """
+        data = self.data
+        pos = self.pos
+        try:
+            code = ord(data[pos])
+        except IndexError:
+            raise UnpackError("unexpected end of data")
+        pos += 1
+        self.pos = pos
+        # Most common types are decoded inline
+        if code <= 0x7f:
+            return code
+        if code >= 0xe0:
+            return code - 0x100
+        if code >= 0xa0:
+            if code <= 0xbf:
+                return self.read(code & 0x1f).decode("utf-8")
+        elif code >= 0x90:
+            return self.unpack_array(code & 0x0f)
+        else:
+            return self.unpack_map(code & 0x0f)
+        if code == 0xc4:
+            try:
+                end = pos + 1 + ord(data[pos])
+            except IndexError:
+                raise UnpackError("unexpected end of data")
+            if end > len(data):
+                raise UnpackError("unexpected end of data")
+            self.pos = end
+            return data[pos + 1:end]
+        if code == 0xc0:
+            return None
+        if code == 0xc2:
+            return False
+        if code == 0xc3:
+            return True
+        if code in _inline_structs:
+            fmt = _inline_structs[code]
+            end = pos + fmt.size
+            if end > len(data):
+                raise UnpackError("unexpected end of data")
+            self.pos = end
+            return fmt.unpack_from(data, pos)[0]
+        try:
+            reader = self.readers[code]
+        except KeyError:
+            raise UnpackError("invalid type code 0x%02x at offset %d" %
+                    (code, pos - 1))
+        return reader(self)
+
+    def read(self, length):
+        pos = self.pos
+        end = pos + length
+        if end > len(self.data):
+            raise UnpackError("unexpected end of data")
+        self.pos = end
+        return self.data[pos:end]
+
+    def read_struct(self, fmt):
+        return fmt.unpack(self.read(fmt.size))[0]
+
+    def unpack_array(self, length):
+        unpack = self.unpack
+        return [unpack() for i in xrange(length)]
+
+    def unpack_map(self, length):
+        unpack = self.unpack
+        ret = {}
+        for i in xrange(length):
+            key = unpack()
+            ret[key] = unpack()
+        return ret
+
+    def unpack_ext(self, length):
+        code = self.read_struct(_int8)
+        data = self.read(length)
+        if self.ext_hook is None:
+            return ExtType(code, data)
+        return self.ext_hook(code, data)
+
+    readers = {
+            0xc4: lambda self: self.read(self.read_struct(_uint8)),
+            0xc5: lambda self: self.read(self.read_struct(_uint16)),
+            0xc6: lambda self: self.read(self.read_struct(_uint32)),
+            0xc7: lambda self: self.unpack_ext(self.read_struct(_uint8)),
+            0xc8: lambda self: self.unpack_ext(self.read_struct(_uint16)),
+            0xc9: lambda self: self.unpack_ext(self.read_struct(_uint32)),
+            0xd4: lambda self: self.unpack_ext(1),
+            0xd5: lambda self: self.unpack_ext(2),
+            0xd6: lambda self: self.unpack_ext(4),
+            0xd7: lambda self: self.unpack_ext(8),
+            0xd8: lambda self: self.unpack_ext(16),
+            0xd9: lambda self: self.read(self.read_struct(_uint8))
+                .decode("utf-8"),
+            0xda: lambda self: self.read(self.read_struct(_uint16))
+                .decode("utf-8"),
+            0xdb: lambda self: self.read(self.read_struct(_uint32))
+                .decode("utf-8"),
+            0xdc: lambda self: self.unpack_array(self.read_struct(_uint16)),
+            0xdd: lambda self: self.unpack_array(self.read_struct(_uint32)),
+            0xde: lambda self: self.unpack_map(self.read_struct(_uint16)),
+            0xdf: lambda self: self.unpack_map(self.read_struct(_uint32)),
+        }
+
+
+def packb(obj, default=None):
+    """
+    Encode *obj* to a string.
+    """
+    return Packer(default).pack(obj)
+
+
+def unpackb(data, ext_hook=None):
+    """
+    Decode the value stored in the string *data*.
+
+    *ext_hook* is called with the code and data of extension types, the
+    default is to return :class:`ExtType` objects.
+    """
+    unpacker = Unpacker(data, ext_hook)
+    ret = unpacker.unpack()
+    if unpacker.pos != len(data):
+        raise UnpackError("extra data after offset %d" % unpacker.pos)
+    return ret
+
+
+def pack(obj, fp, default=None):
+    """
+    Encode *obj* to the file object *fp*.
+    """
+    fp.write(packb(obj, default))
+
+
+def unpack(fp, ext_hook=None):
+    """
+    Decode the value stored in the file object *fp*.
+    """
+    return unpackb(fp.read(), ext_hook)
@@ -39,6 +39,27 @@ functions::
     obj2 = jsonalize.loads(dumped_state)
     assert obj == obj2
 
+The ``backend`` keyword argument of these functions selects the storage
+format. The default is "json"; "binary" stores objects in the more compact
+MessagePack format::
+
+    data = jsonalize.dumps(obj, backend="binary")
+    obj2 = jsonalize.loads(data, backend="binary")
+
+Objects referenced several times, and cyclic graphs, can be dumped by
+passing ``references=True`` to both the dump and load functions.
+
+Large documents can be loaded with :func:`load_lazy`, which only constructs
+objects when they are accessed::
+
+    doc = jsonalize.load_lazy(fp)
+    shape = jsonalize.lazy_get(doc, "/layers/3/shapes/0")
+    print shape.name
+
+:func:`diff_state` computes the changes between two versions of an object,
+that can be sent instead of the whole object and applied on the other side
+with :func:`apply_state`.
+
 """
 from __future__ import with_statement
 try:
@@ -48,7 +69,9 @@ try:
 except ImportError:
     import simplejson as json
 from copy import deepcopy
+from types import InstanceType, GeneratorType
 from pyflu.meta.inherit import InheritMeta
+from pyflu import jsonstream, binpack
 
 
 class JSONAlizeError(Exception): pass 
@@ -66,6 +89,13 @@ class UnregisteredClassError(JSONAlizeError):
 registry = {}
 reverse_registry = {}
 
+# Types serialized as themselves
+scalar_types = frozenset((type(None), bool, int, long, float, str, unicode))
+
+# serialize() handlers and value kinds caches, indexed by type
+_serializers = {}
+_kinds = {}
+
 
 def register(cls, uncall, name=None, constructor=None):
     """
@@ -93,6 +123,8 @@ def register(cls, uncall, name=None, constructor=None):
                 (cls.__name__, name, conflicting_cls.__name__))
     registry[name] = (cls, constructor)
     reverse_registry[cls] = (uncall, name)
+    _serializers.clear()
+    _kinds.clear()
 
 
 def unregister(cls, name=None):
@@ -103,7 +135,8 @@ def unregister(cls, name=None):
         name = cls.__name__
     del registry[name]
     del reverse_registry[cls]
-    
+    _serializers.clear()
+    _kinds.clear()
 
 
 class JSONAlizableMeta(InheritMeta):
@@ -125,11 +158,172 @@ class JSONAlizableMeta(InheritMeta):
             if name in cls.reserved_names:
                 raise SchemaValidationError("can't use reserved name '%s' in "
                         "%s schema" % (name, new_cls_name))
-        # Register class
+        # Build codec plan and register class
+        new_class._codec_plan = CodecPlan(new_class)
         register(new_class, new_class.uncall, name=new_cls_name)
         return new_class
 
 
+class CodecPlan(object):
+    """
+    Precomputed serialization handlers of a :class:`JSONAlizable` class.
+
+    Each field of the class schema gets a dump and a load handler, chosen from
+    the type of its default value. Handlers check their expected type first
+    and fall back to :func:`serialize` and :func:`unserialize`. Fields whose
+    default value is immutable have no default copier.
+
+    If the class :attr:`~JSONAlizableBase.omit_defaults` attribute is True,
+    :attr:`omitted` lists the fields skipped by :meth:`uncall` when they are
+    equal to their default value.
+    """
+
+    def __init__(self, cls):
+        self.fields = []
+        self.omitted = []
+        for name, default in cls.schema.items():
+            dumper, loader = _field_handlers(default)
+            if is_immutable(default):
+                copier = None
+            else:
+                copier = _copy_default
+            self.fields.append((name, default, dumper, loader, copier))
+            if cls.omit_defaults:
+                self.omitted.append((name, default))
+
+    def uncall(self, obj):
+        """
+        Equivalent of :meth:`JSONAlizableBase.uncall` for *obj*.
+        """
+        kwargs = {}
+        for name, default, dumper, loader, copier in self.fields:
+            kwargs[name] = dumper(getattr(obj, name))
+        if self.omitted:
+            self.omit_defaults(obj, kwargs)
+        return (), kwargs
+
+    def shallow_uncall(self, obj):
+        """
+        Like :meth:`uncall`, but returns the fields values of *obj* without
+        serializing them.
+        """
+        kwargs = {}
+        for field in self.fields:
+            kwargs[field[0]] = getattr(obj, field[0])
+        if self.omitted:
+            self.omit_defaults(obj, kwargs)
+        return (), kwargs
+
+    def omit_defaults(self, obj, kwargs):
+        """
+        Remove from *kwargs* the fields of *obj* equal to their default value.
+        """
+        for name, default in self.omitted:
+            if _is_default_value(getattr(obj, name), default):
+                del kwargs[name]
+
+
+class _LazyCodecPlan(object):
+    """
+    Builds the :class:`CodecPlan` of classes using :class:`JSONAlizableBase`
+    without :class:`JSONAlizableMeta`, the first time it is needed.
+    """
+
+    def __get__(self, obj, cls):
+        try:
+            return _codec_plans[cls]
+        except KeyError:
+            plan = _codec_plans[cls] = CodecPlan(cls)
+            return plan
+
+
+# Codec plans of JSONAlizableBase subclasses created without JSONAlizableMeta
+_codec_plans = {}
+
+
+def _is_default_value(value, default):
+    """
+    Returns True if *value* has the same type as *default* and compares
+    equal to it.
+    """
+    if type(value) is not type(default):
+        return False
+    try:
+        return (value == default) is True
+    except Exception:
+        return False
+
+
+def _field_handlers(default):
+    """
+    Returns the (dumper, loader) handlers pair of a schema field whose default
+    value is *default*.
+    """
+    default_type = type(default)
+    if default is None or default_type in reverse_registry:
+        return serialize, unserialize
+    if default_type in scalar_types:
+        return _dump_scalar, _load_scalar
+    if default_type in (list, tuple):
+        return _dump_list, _load_list
+    if default_type is dict:
+        return _dump_dict, _load_dict
+    return serialize, unserialize
+
+
+def _copy_default(default):
+    """
+    Try to copy a default value with jsonalize's :func:`copy`, else use
+    copy.deepcopy().
+    """
+    try:
+        return copy(default)
+    except (JSONAlizeError, TypeError):
+        return deepcopy(default)
+
+
+def _dump_scalar(value):
+    if type(value) in scalar_types:
+        return value
+    return serialize(value)
+
+
+def _load_scalar(state):
+    if type(state) in scalar_types:
+        return state
+    return unserialize(state)
+
+
+def _dump_list(value):
+    if type(value) is list:
+        return [serialize(v) for v in value]
+    return serialize(value)
+
+
+def _load_list(state):
+    if type(state) is list:
+        return [unserialize(v) for v in state]
+    return unserialize(state)
+
+
+def _dump_dict(value):
+    if type(value) is dict:
+        data = {}
+        for key, v in value.iteritems():
+            data[key] = serialize(v)
+        return data
+    return serialize(value)
+
+
+def _load_dict(state):
+    if type(state) is dict and not _is_state_dict(state):
+        ret = {}
+        for key, value in state.iteritems():
+            ret[key] = unserialize(value)
+        return ret
+    return unserialize(state)
+
+
 class JSONAlizableBase(object):
     """
     Mixin class to ease serializing objects to JSON.
@@ -142,6 +336,15 @@ class JSONAlizableBase(object):
     This attribute is inherited and extended in subclasses.
     """
 
+    omit_defaults = False
+    """
+    If True, attributes equal to their default value are not serialized. They
+    are restored to their default value when the object is loaded.
+    """
+
+    # Set by JSONAlizableMeta, built on first use for other subclasses
+    _codec_plan = _LazyCodecPlan()
+
     def __init__(self, **kwargs):
         """
         Initialize a JSONAlizable instance.
@@ -149,15 +352,13 @@ class JSONAlizableBase(object):
         Takes keyword arguments corresponding to the attributes defined in
         :attr:`schema`. Omitted parameters are set to their default value.
         """
-        for name, default in self.schema.items():
-            # Try to copy the default value with jsonalize's copy(), else use
-            # copy.deepcopy()
-            try:
-                default_copy = copy(default)
-            except (JSONAlizeError, TypeError):
-                default_copy = deepcopy(default)
-            setattr(self, name, 
-                    unserialize(kwargs.pop(name, default_copy)))
+        for name, default, dumper, loader, copier in self._codec_plan.fields:
+            if name in kwargs:
+                setattr(self, name, loader(kwargs.pop(name)))
+            elif copier is None:
+                setattr(self, name, default)
+            else:
+                setattr(self, name, copier(default))
         if kwargs:
             raise NameError("unknown parameters passed to constructor: %s" %
                     ", ".join(kwargs.keys()))
@@ -174,30 +375,29 @@ class JSONAlizableBase(object):
         The default implementation returns a dict containing the object
         attributes defined in :attr:`schema` processed by :func:`serialize`.
         """
-        args = {}
-        for name in self.schema:
-            args[name] = serialize(getattr(self, name))
-        return (), args
+        return self._codec_plan.uncall(self)
             
     @classmethod
-    def load(cls, filename):
+    def load(cls, filename, backend="json"):
         """
         Create a new instance of this class from the contents of the file at
         *filename*.
         """
-        with open(filename, "r") as fp:
-            ret = load(fp)
+        backend = get_backend(backend)
+        with open(filename, backend.read_mode) as fp:
+            ret = backend.load(fp)
         if not isinstance(ret, cls):
             raise TypeError("invalid serialized type: expected '%s' "
                     "got '%s'" % (cls, type(ret)))
         return ret
 
-    def save(self, filename):
+    def save(self, filename, backend="json"):
         """
         Save this instance to *filename*.
         """
-        with open(filename, "w") as fp:
-            dump(self, fp)
+        backend = get_backend(backend)
+        with open(filename, backend.write_mode) as fp:
+            backend.dump(self, fp)
 
 
 class JSONAlizable(JSONAlizableBase):
@@ -205,112 +405,1300 @@ class JSONAlizable(JSONAlizableBase):
     __metaclass__ = JSONAlizableMeta
 
 
-def serialize(obj):
+def serialize(obj, references=False):
     """
     Convert *obj* to its serialized form.
+
+    If *references* is True, registered objects found several times in *obj*
+    are serialized only once, see :class:`ReferenceSerializer`.
+    """
+    if references:
+        return ReferenceSerializer().serialize(obj)
+    try:
+        handler = _serializers[type(obj)]
+    except KeyError:
+        handler = _serializer_for(obj)
+    return handler(obj)
+
+
+def _serializer_for(obj):
+    """
+    Find the :func:`serialize` handler for objects of the same type as *obj*,
+    and cache it.
     """
     obj_type = type(obj)
     if obj_type in reverse_registry:
         # Registered entry
         uncall, name = reverse_registry[obj_type]
+        if _is_default_uncall(uncall):
+            uncall = obj_type._codec_plan.uncall
+        handler = _registered_serializer(uncall, name)
+    elif obj_type in scalar_types:
+        handler = _serialize_other
+    elif looks_like_mapping(obj):
+        handler = _serialize_mapping
+    elif isinstance(obj, (list, tuple)):
+        handler = _serialize_sequence
+    else:
+        handler = _serialize_other
+    # Old-style instances all share the same type, don't cache their handler
+    if obj_type is not InstanceType:
+        _serializers[obj_type] = handler
+    return handler
+
+
+def _is_default_uncall(uncall):
+    """
+    Returns True if *uncall* is the :meth:`JSONAlizableBase.uncall` default
+    implementation.
+    """
+    return getattr(uncall, "im_func", None) is JSONAlizableBase.uncall.im_func
+
+
+def _shallow_uncall(obj, uncall):
+    """
+    Returns the result of *uncall* on *obj*, without serializing the fields of
+    the objects using the default :meth:`JSONAlizableBase.uncall`.
+    """
+    if _is_default_uncall(uncall):
+        return type(obj)._codec_plan.shallow_uncall(obj)
+    return uncall(obj)
+
+
+def _registered_serializer(uncall, name):
+    def serialize_registered(obj):
         args, kwargs = uncall(obj)
-        data = {
+        return {
                 "__class__": name,
                 "__args__": args,
                 "__kwargs__": kwargs,
             }
-    elif looks_like_mapping(obj):
-        # Mapping like object
-        data = {}
-        for key, value in obj.iteritems():
-            data[key] = serialize(value)
-    elif isinstance(obj, (list, tuple)):
-        # Sequence object
-        data = []
-        for value in obj:
-            data.append(serialize(value))
-    else:
-        # Other types
-        data = obj
+    return serialize_registered
+
+
+def _serialize_mapping(obj):
+    data = {}
+    for key, value in obj.iteritems():
+        data[key] = serialize(value)
     return data
 
 
-def unserialize(state):
+def _serialize_sequence(obj):
+    return [serialize(value) for value in obj]
+
+
+def _serialize_other(obj):
+    return obj
+
+
+def unserialize(state, references=False):
     """
     Transform a serialized state back to its initial form.
+
+    *references* must be True to load states created with the same argument
+    of :func:`serialize`.
     """
-    if isinstance(state, list):
-        ret = []
-        for value in state:
-            ret.append(unserialize(value))
+    if references:
+        return ReferenceUnserializer().unserialize(state)
+    state_type = type(state)
+    if state_type is list:
+        return [unserialize(value) for value in state]
+    elif state_type is dict:
+        if _is_state_dict(state):
+            return _construct(state)
+        ret = {}
+        for key, value in state.iteritems():
+            ret[key] = unserialize(value)
+        return ret
+    elif state_type in scalar_types:
+        return state
+    elif isinstance(state, list):
+        return [unserialize(value) for value in state]
     elif isinstance(state, dict):
         if is_serialized_state(state):
-            # Looks like a serialized object
+            return _construct(state)
+        ret = {}
+        for key, value in state.items():
+            ret[key] = unserialize(value)
+        return ret
+    # json only returns items of type list or dict, if we get anything else
+    # then it's not a serialized state
+    return state
+
+
+def _construct(state):
+    """
+    Create the object described by the serialized object *state*.
+    """
+    cls = get_class(state["__class__"])
+    # Force kwargs keys to be of str type
+    kwargs = {}
+    for key, value in state["__kwargs__"].iteritems():
+        kwargs[str(key)] = value
+    return cls(*state["__args__"], **kwargs)
+
+
+def serialize_deep(obj):
+    """
+    Same as :func:`serialize`, but uses an explicit stack instead of
+    recursion, so that graphs of any depth can be serialized.
+    """
+    root = [None]
+    # Stack of (value, container, key) tuples, the serialized value is stored
+    # in container[key]
+    stack = [(obj, root, 0)]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        value, container, key = pop()
+        kind = _value_kind(value)
+        if kind == _SCALAR or type(value) is GeneratorType:
+            container[key] = value
+        elif kind == _REGISTERED:
+            uncall, name = reverse_registry[type(value)]
+            if _is_default_uncall(uncall):
+                args, fields = type(value)._codec_plan.shallow_uncall(value)
+                kwargs = {}
+                for field_name, field_value in fields.iteritems():
+                    push((field_value, kwargs, field_name))
+            else:
+                args, kwargs = uncall(value)
+            container[key] = {
+                    "__class__": name,
+                    "__args__": args,
+                    "__kwargs__": kwargs,
+                }
+        elif kind == _MAPPING:
+            data = {}
+            for item_key, item in value.iteritems():
+                push((item, data, item_key))
+            container[key] = data
+        else:
+            data = [None] * len(value)
+            for index, item in enumerate(value):
+                push((item, data, index))
+            container[key] = data
+    return root[0]
+
+
+# unserialize_deep() tasks
+_VISIT, _BUILD = range(2)
+
+
+def unserialize_deep(state):
+    """
+    Same as :func:`unserialize`, but uses an explicit stack instead of
+    recursion, so that states of any depth can be loaded.
+
+    The arguments of :class:`JSONAlizable` objects are unserialized before
+    being passed to their constructor. Other registered classes receive their
+    arguments as is, like with :func:`unserialize`.
+    """
+    root = [None]
+    # Stack of (_VISIT, state, container, key) and
+    # (_BUILD, cls, args, kwargs, container, key) tuples, results are stored
+    # in container[key]
+    stack = [(_VISIT, state, root, 0)]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        task = pop()
+        if task[0] == _BUILD:
+            action, cls, args, kwargs, container, key = task
+            container[key] = _build_loaded(cls, args, kwargs)
+            continue
+        action, state, container, key = task
+        if isinstance(state, list):
+            ret = [None] * len(state)
+            for index, value in enumerate(state):
+                push((_VISIT, value, ret, index))
+            container[key] = ret
+        elif isinstance(state, dict):
+            if not is_serialized_state(state):
+                ret = {}
+                for item_key, value in state.items():
+                    push((_VISIT, value, ret, item_key))
+                container[key] = ret
+                continue
             cls = get_class(state["__class__"])
-            # Force kwargs keys to be of str type
+            if not (isinstance(cls, type)
+                    and issubclass(cls, JSONAlizableBase)):
+                container[key] = _construct(state)
+                continue
             kwargs = {}
-            for key, value in state["__kwargs__"].items():
-                kwargs[str(key)] = value
-            ret = cls(*state["__args__"], **kwargs)
+            push((_BUILD, cls, state["__args__"], kwargs, container, key))
+            for item_key, value in state["__kwargs__"].items():
+                push((_VISIT, value, kwargs, str(item_key)))
         else:
-            # A normal dict
-            ret = {}
-            for key, value in state.items():
-                ret[key] = unserialize(value)
+            container[key] = state
+    return root[0]
+
+
+def _build_loaded(cls, args, kwargs):
+    """
+    Create an instance of the :class:`JSONAlizableBase` subclass *cls* from
+    already unserialized arguments.
+
+    Unless *cls* overrides the default constructor, fields are set directly
+    instead of going through their loaders, which would walk the values
+    again recursively.
+    """
+    if args or getattr(cls.__init__, "im_func", None) is not \
+            JSONAlizableBase.__init__.im_func:
+        return cls(*args, **kwargs)
+    obj = cls.__new__(cls)
+    for name, default, dumper, loader, copier in cls._codec_plan.fields:
+        if name in kwargs:
+            setattr(obj, name, kwargs.pop(name))
+        elif copier is None:
+            setattr(obj, name, default)
+        else:
+            setattr(obj, name, copier(default))
+    if kwargs:
+        raise NameError("unknown parameters passed to constructor: %s" %
+                ", ".join(kwargs.keys()))
+    return obj
+
+
+class ReferenceSerializer(object):
+    """
+    Serializer keeping track of the registered objects it has already seen,
+    like pickle does.
+
+    The first occurrence of a registered object is serialized with an extra
+    ``__id__`` key, the following ones are replaced by a ``{"__ref__": id}``
+    mapping. Shared objects are thus stored once, and cyclic graphs can be
+    serialized.
+    """
+
+    def __init__(self):
+        self.memo = {}
+        # Keep serialized objects alive, so that their id() are not reused
+        self.objects = []
+
+    def serialize(self, obj):
+        kind = _value_kind(obj)
+        if kind == _SCALAR:
+            return obj
+        if kind == _REGISTERED:
+            ref = self.memo.get(id(obj))
+            if ref is not None:
+                return {"__ref__": ref}
+            state = self.shallow_state(obj, reverse_registry[type(obj)])
+            state["__args__"] = self.serialize(state["__args__"])
+            state["__kwargs__"] = self.serialize(state["__kwargs__"])
+            return state
+        if kind == _MAPPING:
+            data = {}
+            for key, value in obj.iteritems():
+                data[key] = self.serialize(value)
+            return data
+        return [self.serialize(value) for value in obj]
+
+    def shallow_state(self, obj, entry):
+        """
+        Remember the registered object *obj* and return its state, without
+        serializing its arguments.
+
+        *entry* is the ``(uncall, name)`` registry entry of *obj*.
+        """
+        ref = len(self.objects)
+        self.memo[id(obj)] = ref
+        self.objects.append(obj)
+        uncall, name = entry
+        args, kwargs = _shallow_uncall(obj, uncall)
+        return {
+                "__class__": name,
+                "__args__": args,
+                "__kwargs__": kwargs,
+                "__id__": ref,
+            }
+
+
+class ReferenceUnserializer(object):
+    """
+    Rebuilds the states created by :class:`ReferenceSerializer`, preserving
+    the identity of shared objects.
+
+    The arguments of referenced objects are unserialized before being passed
+    to their constructor. References to an object still being constructed
+    (cycles) are resolved once the whole state is loaded, in the schema
+    fields of :class:`JSONAlizable` objects.
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.forwards = 0
+
+    def unserialize(self, state):
+        ret = self.load(state)
+        if self.forwards:
+            self.resolve_forwards()
+        return ret
+
+    def load(self, state):
+        if isinstance(state, list):
+            return [self.load(value) for value in state]
+        if not isinstance(state, dict):
+            return state
+        if len(state) == 1 and "__ref__" in state:
+            ref = state["__ref__"]
+            try:
+                return self.objects[ref]
+            except KeyError:
+                self.forwards += 1
+                return _ForwardReference(ref)
+        if len(state) == 4 and "__id__" in state and "__class__" in state \
+                and "__args__" in state and "__kwargs__" in state:
+            return self.construct(state)
+        if _is_state_dict(state):
+            return _construct(state)
+        ret = {}
+        for key, value in state.items():
+            ret[key] = self.load(value)
+        return ret
+
+    def construct(self, state):
+        cls = get_class(state["__class__"])
+        args = self.load(state["__args__"])
+        kwargs = {}
+        for key, value in state["__kwargs__"].items():
+            kwargs[str(key)] = self.load(value)
+        obj = cls(*args, **kwargs)
+        self.objects[state["__id__"]] = obj
+        return obj
+
+    def resolve_forwards(self):
+        resolved = [0]
+        def resolve(value):
+            if type(value) is _ForwardReference:
+                resolved[0] += 1
+                return self.objects[value.ref]
+            if isinstance(value, list):
+                for index, item in enumerate(value):
+                    value[index] = resolve(item)
+            elif isinstance(value, tuple):
+                value = type(value)([resolve(item) for item in value])
+            elif isinstance(value, dict):
+                for key, item in value.items():
+                    value[key] = resolve(item)
+            return value
+        for obj in self.objects.values():
+            if isinstance(obj, JSONAlizableBase):
+                for field in obj._codec_plan.fields:
+                    setattr(obj, field[0], resolve(getattr(obj, field[0])))
+        # A constructor can store the same placeholder in several fields
+        if resolved[0] < self.forwards:
+            raise JSONAlizeError("%d cyclic references could not be resolved, "
+                    "cycles must go through JSONAlizable fields" %
+                    (self.forwards - resolved[0]))
+
+
+class _ForwardReference(object):
+    """
+    Placeholder for a reference to an object under construction.
+    """
+
+    __slots__ = ("ref",)
+
+    def __init__(self, ref):
+        self.ref = ref
+
+
+# Values kinds, see _value_kind()
+_SCALAR, _REGISTERED, _MAPPING, _SEQUENCE = range(4)
+
+
+def _value_kind(value):
+    """
+    Returns the kind of *value*: _SCALAR for values serialized as is,
+    _REGISTERED, _MAPPING, or _SEQUENCE for lists, tuples and generators.
+    """
+    value_type = type(value)
+    try:
+        return _kinds[value_type]
+    except KeyError:
+        pass
+    if value_type in scalar_types:
+        kind = _SCALAR
+    elif value_type in reverse_registry:
+        kind = _REGISTERED
+    elif looks_like_mapping(value):
+        kind = _MAPPING
+    elif isinstance(value, (list, tuple, GeneratorType)):
+        kind = _SEQUENCE
     else:
-        # json only returns items of type list or dict, if we get anything else
-        # then it's not a serialized state
-        ret = state
-    return ret
+        kind = _SCALAR
+    if value_type is not InstanceType:
+        _kinds[value_type] = kind
+    return kind
+
+
+class StreamEncoder(object):
+    """
+    Incremental JSON encoder.
+
+    Walks registered objects, mappings and sequences like :func:`serialize`
+    does, but produces JSON text chunks of about *chunk_size* bytes instead of
+    building the whole serialized state. Generators are encoded as arrays.
+
+    *indent*, *separators* and *sort_keys* have the same meaning as in
+    json.JSONEncoder(), the other keyword arguments are passed to the
+    json.JSONEncoder() used to encode scalar values.
+    """
+
+    def __init__(self, indent=None, separators=None, sort_keys=False,
+            chunk_size=2**16, **kwargs):
+        self.scalar_encoder = json.JSONEncoder(**kwargs)
+        self.indent = indent
+        if separators is None:
+            if indent is None:
+                separators = (", ", ": ")
+            else:
+                separators = (",", ": ")
+        self.item_separator, self.key_separator = separators
+        self.sort_keys = sort_keys
+        self.chunk_size = chunk_size
+        self.newlines = []
+
+    def iterencode(self, obj):
+        """
+        Encode *obj*, yielding JSON text chunks.
+        """
+        chunks = []
+        append = chunks.append
+        size = 0
+        # Stack of [items iterator, closing string, is mapping, is empty]
+        # lists, one for each container being encoded
+        stack = []
+        value = obj
+        has_value = True
+        while True:
+            if has_value:
+                kind = _value_kind(value)
+                if kind == _SCALAR:
+                    text = self.encode_scalar(value)
+                    append(text)
+                    size += len(text)
+                else:
+                    if kind == _REGISTERED:
+                        value = self.registered_state(value)
+                        kind = _MAPPING
+                    if kind == _MAPPING:
+                        if self.sort_keys:
+                            items = iter(sorted(value.items()))
+                        else:
+                            items = value.iteritems()
+                        append("{")
+                        stack.append([items, "}", True, True])
+                    else:
+                        append("[")
+                        stack.append([iter(value), "]", False, True])
+                    size += 1
+                has_value = False
+            if not stack:
+                break
+            frame = stack[-1]
+            try:
+                item = frame[0].next()
+            except StopIteration:
+                stack.pop()
+                if frame[3]:
+                    append(frame[1])
+                else:
+                    append(self.newline(len(stack)))
+                    append(frame[1])
+                size += 1
+            else:
+                if frame[3]:
+                    frame[3] = False
+                else:
+                    append(self.item_separator)
+                append(self.newline(len(stack)))
+                if frame[2]:
+                    key, value = item
+                    text = self.encode_key(key)
+                    append(text)
+                    append(self.key_separator)
+                    size += len(text)
+                else:
+                    value = item
+                has_value = True
+            if size >= self.chunk_size:
+                yield "".join(chunks)
+                del chunks[:]
+                size = 0
+        if chunks:
+            yield "".join(chunks)
+
+    def registered_state(self, obj):
+        uncall, name = reverse_registry[type(obj)]
+        args, kwargs = _shallow_uncall(obj, uncall)
+        return {
+                "__class__": name,
+                "__args__": args,
+                "__kwargs__": kwargs,
+            }
+
+    def encode_scalar(self, value):
+        if value is None:
+            return "null"
+        value_type = type(value)
+        if value_type is int or value_type is long:
+            return str(value)
+        return self.scalar_encoder.encode(value)
+
+    def encode_key(self, key):
+        # Same keys conversions as the json module
+        if not isinstance(key, basestring):
+            if key is True:
+                key = "true"
+            elif key is False:
+                key = "false"
+            elif key is None:
+                key = "null"
+            elif isinstance(key, float):
+                key = self.scalar_encoder.encode(key)
+            elif isinstance(key, (int, long)):
+                key = str(key)
+            else:
+                raise TypeError("key %r is not a string" % (key,))
+        return self.scalar_encoder.encode(key)
+
+    def newline(self, level):
+        if self.indent is None:
+            return ""
+        newlines = self.newlines
+        while len(newlines) <= level:
+            newlines.append("\n" + " " * (self.indent * len(newlines)))
+        return newlines[level]
+
+
+def iterencode(obj, lines=False, **kwargs):
+    """
+    Encode *obj* to JSON incrementally, yielding chunks of text.
+
+    If *lines* is True, *obj* must be an iterable and each of its elements is
+    encoded on its own line ("JSON lines" format).
+
+    The keyword arguments are passed to :class:`StreamEncoder`.
+    """
+    if lines:
+        encoder = StreamEncoder(**kwargs)
+        for item in obj:
+            for chunk in encoder.iterencode(item):
+                yield chunk
+            yield "\n"
+    else:
+        defaults = {"indent": 4}
+        defaults.update(kwargs)
+        for chunk in StreamEncoder(**defaults).iterencode(obj):
+            yield chunk
+
+
+def dump_iter(obj, fp, lines=False, **kwargs):
+    """
+    Dump *obj* to an open file object *fp* incrementally.
+
+    Contrary to :func:`dump`, the serialized state of *obj* is never built in
+    memory and data is written to *fp* as soon as it is encoded. The
+    arguments are passed to :func:`iterencode`.
+    """
+    for chunk in iterencode(obj, lines, **kwargs):
+        fp.write(chunk)
+
+
+# Serialization backends, indexed by name
+backends = {}
+
+
+def register_backend(backend):
+    """
+    Register *backend* under its name, for use with the *backend* argument of
+    :func:`dump`, :func:`dumps`, :func:`load` and :func:`loads`.
+
+    Backends must define the *name*, *read_mode* and *write_mode* attributes
+    (the last two are the modes used to open files) and the ``dump()``,
+    ``dumps()``, ``load()`` and ``loads()`` methods, taking the same arguments
+    as the module functions. The ``load_state()`` and ``loads_state()``
+    methods, used by :func:`load_lazy` and :func:`loads_lazy`, return
+    serialized states instead of objects.
+    """
+    backends[backend.name] = backend
+
+
+def get_backend(name):
+    """
+    Retrieve a backend by its name.
+    """
+    try:
+        return backends[name]
+    except KeyError:
+        raise JSONAlizeError("unknown backend '%s'" % name)
+
+
+class JSONBackend(object):
+    """
+    The default backend, storing objects in JSON text.
+
+    Extra arguments are passed directly to the functions of the json module.
+    """
+
+    name = "json"
+    read_mode = "r"
+    write_mode = "w"
+
+    def dump(self, obj, fp, *args, **kwargs):
+        references = kwargs.pop("references", False)
+        defaults = {"indent": 4}
+        defaults.update(kwargs)
+        json.dump(serialize(obj, references), fp, *args, **defaults)
+
+    def dumps(self, obj, *args, **kwargs):
+        references = kwargs.pop("references", False)
+        defaults = {"indent": 4}
+        defaults.update(kwargs)
+        return json.dumps(serialize(obj, references), *args, **defaults)
+
+    def load(self, fp, *args, **kwargs):
+        references = kwargs.pop("references", False)
+        return unserialize(self.load_state(fp, *args, **kwargs), references)
+
+    def loads(self, data, *args, **kwargs):
+        references = kwargs.pop("references", False)
+        return unserialize(self.loads_state(data, *args, **kwargs),
+                references)
+
+    def load_state(self, fp, *args, **kwargs):
+        return json.load(fp, *args, **kwargs)
+
+    def loads_state(self, data, *args, **kwargs):
+        return json.loads(data, *args, **kwargs)
+
+
+class BinaryBackend(object):
+    """
+    Backend storing objects in the MessagePack binary format, with
+    :mod:`pyflu.binpack`.
+
+    Registered objects are stored with the same ``__class__``, ``__args__``
+    and ``__kwargs__`` maps as in JSON. Types registered with
+    :meth:`register_native` are stored as MessagePack extension types
+    instead.
+    """
+
+    name = "binary"
+    read_mode = "rb"
+    write_mode = "wb"
+
+    def __init__(self):
+        self.native_encoders = {}
+        self.native_decoders = {}
+
+    def register_native(self, cls, code, encode, decode):
+        """
+        Store instances of *cls* as extension types with the type *code*.
+
+        *encode* takes an instance and returns its binary representation, or
+        None to serialize it as a registered object instead. *decode* does the
+        reverse operation.
+        """
+        self.native_encoders[cls] = (code, encode)
+        self.native_decoders[code] = decode
+
+    def dump(self, obj, fp, references=False):
+        fp.write(self.dumps(obj, references))
+
+    def dumps(self, obj, references=False):
+        if references:
+            memo = ReferenceSerializer()
+            return binpack.packb(obj, lambda o: self.default(o, memo))
+        return binpack.packb(obj, self.default)
+
+    def load(self, fp, references=False):
+        return self.loads(fp.read(), references)
+
+    def loads(self, data, references=False):
+        return unserialize(self.loads_state(data), references)
+
+    def load_state(self, fp):
+        return self.loads_state(fp.read())
+
+    def loads_state(self, data):
+        return binpack.unpackb(data, self.ext_hook)
+
+    def default(self, obj, memo=None):
+        """
+        Convert *obj* to a type supported by binpack.
+
+        *memo* is the :class:`ReferenceSerializer` used to keep track of
+        registered objects when serializing with references.
+        """
+        obj_type = type(obj)
+        native = self.native_encoders.get(obj_type)
+        if native is not None:
+            code, encode = native
+            data = encode(obj)
+            if data is not None:
+                return binpack.ExtType(code, data)
+        entry = reverse_registry.get(obj_type)
+        if entry is not None:
+            if memo is not None:
+                ref = memo.memo.get(id(obj))
+                if ref is not None:
+                    return {"__ref__": ref}
+                return memo.shallow_state(obj, entry)
+            uncall, name = entry
+            args, kwargs = _shallow_uncall(obj, uncall)
+            return {
+                    "__class__": name,
+                    "__args__": args,
+                    "__kwargs__": kwargs,
+                }
+        if looks_like_mapping(obj):
+            return dict(obj.iteritems())
+        if isinstance(obj, (list, tuple, GeneratorType)):
+            return list(obj)
+        for base in (bool, int, long, float, str, unicode):
+            if isinstance(obj, base):
+                return base(obj)
+        raise TypeError("%r is not serializable" % (obj,))
+
+    def ext_hook(self, code, data):
+        try:
+            decode = self.native_decoders[code]
+        except KeyError:
+            raise JSONAlizeError("unknown extension type %d" % code)
+        return decode(data)
+
+
+json_backend = JSONBackend()
+binary_backend = BinaryBackend()
+register_backend(json_backend)
+register_backend(binary_backend)
 
 
 def dump(obj, fp, *args, **kwargs):
     """
     Dump JSON-serializable *obj* to an open file object *fp*.
 
-    The arguments after *obj* are passed directly to json.dump().
+    The *backend* keyword argument selects the storage format by name, the
+    default is "json". The other arguments after *obj* are passed to the
+    backend, the JSON backend passes them directly to json.dump().
     """    
-    defaults = {"indent": 4}
-    defaults.update(kwargs)
-    json.dump(serialize(obj), fp, *args, **defaults)
+    backend = get_backend(kwargs.pop("backend", "json"))
+    backend.dump(obj, fp, *args, **kwargs)
 
 
 def dumps(obj, *args, **kwargs):
     """
     Dump JSON-serializable *obj* object to a string.
 
-    The arguments after *obj* are passed directly to json.dumps().
+    The *backend* keyword argument selects the storage format by name, the
+    default is "json". The other arguments after *obj* are passed to the
+    backend, the JSON backend passes them directly to json.dumps().
     """    
-    defaults = {"indent": 4}
-    defaults.update(kwargs)
-    return json.dumps(serialize(obj), *args, **defaults)
+    backend = get_backend(kwargs.pop("backend", "json"))
+    return backend.dumps(obj, *args, **kwargs)
 
 
 def load(fp, *args, **kwargs):
     """
     Load an object from a file.
 
-    The arguments are passed directly to json.load().
+    The *backend* keyword argument selects the storage format by name, the
+    default is "json". The other arguments are passed to the backend, the
+    JSON backend passes them directly to json.load().
     """    
-    state = json.load(fp, *args, **kwargs)
-    return unserialize(state)
+    backend = get_backend(kwargs.pop("backend", "json"))
+    return backend.load(fp, *args, **kwargs)
+
+
+def iterload(fp, path=None, chunk_size=2**16, lines=False, **kwargs):
+    """
+    Iterate over the objects stored in a JSON array from a file, without
+    loading the whole document in memory.
+
+    The file is parsed incrementally by chunks of *chunk_size* bytes, and each
+    element of the array is yielded as soon as it is parsed. *path* selects
+    an array nested in the document, see :func:`pyflu.jsonstream.iter_array`
+    for its syntax.
+
+    If *lines* is True, the file is read in the "JSON lines" format written
+    by :func:`dump_iter`, and *path* is ignored.
+
+    The other keyword arguments are passed directly to json.JSONDecoder().
+    """
+    decoder = json.JSONDecoder(**kwargs)
+    if lines:
+        for line in fp:
+            if line.strip():
+                yield unserialize(decoder.decode(line))
+        return
+    for state in jsonstream.iter_array(fp, path, chunk_size, decoder):
+        yield unserialize(state)
 
 
 def loads(*args, **kwargs):
     """
     Load an object from a string.
 
-    The arguments are passed directly to json.loads().
+    The *backend* keyword argument selects the storage format by name, the
+    default is "json". The other arguments are passed to the backend, the
+    JSON backend passes them directly to json.loads().
     """    
-    state = json.loads(*args, **kwargs)
-    return unserialize(state)
+    backend = get_backend(kwargs.pop("backend", "json"))
+    return backend.loads(*args, **kwargs)
+
+
+def load_lazy(fp, *args, **kwargs):
+    """
+    Load a document from a file, without constructing the objects it
+    contains.
+
+    The document is parsed, but registered objects and containers are
+    replaced by proxies (see :class:`LazyObject`, :class:`LazyList` and
+    :class:`LazyDict`), that construct the real object on first access. Use
+    :func:`lazy_get` to pull a single value out of a large document, and
+    :func:`resolve` to retrieve the object behind a proxy.
+
+    Arguments are the same as for :func:`load`, documents dumped with
+    references are not supported.
+    """
+    backend = get_backend(kwargs.pop("backend", "json"))
+    return _lazy(backend.load_state(fp, *args, **kwargs))
+
+
+def loads_lazy(*args, **kwargs):
+    """
+    Same as :func:`load_lazy`, but load the document from a string.
+    """
+    backend = get_backend(kwargs.pop("backend", "json"))
+    return _lazy(backend.loads_state(*args, **kwargs))
+
+
+def lazy_get(proxy, path):
+    """
+    Extract the value pointed by *path* from a document loaded with
+    :func:`load_lazy`, without constructing its parents.
+
+    The path syntax is the same as in
+    :func:`pyflu.containerutils.get_from_dict`. Components are keys in dicts,
+    indexes in lists, and attribute names (or indexes of positional
+    arguments) in registered objects. Returns a proxy, or the value itself
+    for scalars.
+    """
+    components = [c for c in path.split("/") if c]
+    if not len(components):
+        raise ValueError("empty path")
+    value = proxy
+    try:
+        for component in components:
+            if not isinstance(value, _LazyProxy):
+                raise KeyError(component)
+            value = value._lazy_child(component)
+    except (KeyError, IndexError, ValueError):
+        raise ValueError("invalid path: %s" % path)
+    return value
+
+
+def resolve(value):
+    """
+    Returns the object behind *value* if it is a lazy proxy, or *value*
+    itself.
+    """
+    if isinstance(value, _LazyProxy):
+        return value._lazy_resolve()
+    return value
+
+
+class _LazyProxy(object):
+    """
+    Base class of lazy proxies, wrapping the serialized *state* of a value.
+
+    Children proxies are cached, so that accessing the same path twice
+    returns the same proxy, and proxies resolve to the same objects as their
+    parents.
+    """
+
+    __slots__ = ("_lazy_state", "_lazy_children", "_lazy_value")
+
+    def __init__(self, state):
+        object.__setattr__(self, "_lazy_state", state)
+        object.__setattr__(self, "_lazy_children", {})
+        object.__setattr__(self, "_lazy_value", _unresolved)
+
+    def _lazy_child(self, key):
+        try:
+            return self._lazy_children[key]
+        except KeyError:
+            child = _lazy(self._lazy_child_state(key))
+            self._lazy_children[key] = child
+            return child
+
+    def _lazy_resolve(self):
+        if self._lazy_value is _unresolved:
+            object.__setattr__(self, "_lazy_value", self._lazy_construct())
+        return self._lazy_value
+
+    def __repr__(self):
+        state = "constructed" if self._lazy_value is not _unresolved \
+                else "not constructed"
+        return "<%s (%s)>" % (self.__class__.__name__, state)
+
+
+_unresolved = object()
+
+
+class LazyObject(_LazyProxy):
+    """
+    Proxy of a registered object.
+
+    The object is constructed the first time one of its attributes is read
+    or written through the proxy. If the object class is a
+    :class:`JSONAlizable`, its attributes are resolved from the children
+    proxies; other classes receive their serialized arguments, as with
+    :func:`unserialize`.
+    """
+
+    __slots__ = ()
+
+    def _lazy_child_state(self, key):
+        state = self._lazy_state
+        if key.isdigit():
+            return state["__args__"][int(key)]
+        return state["__kwargs__"][key]
+
+    def _lazy_construct(self):
+        state = self._lazy_state
+        cls = get_class(state["__class__"])
+        if not (isinstance(cls, type) and issubclass(cls, JSONAlizableBase)):
+            return _construct(state)
+        kwargs = {}
+        for key in state["__kwargs__"]:
+            kwargs[str(key)] = resolve(self._lazy_child(key))
+        return cls(*state["__args__"], **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._lazy_resolve(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._lazy_resolve(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self._lazy_resolve(), name)
+
+
+class LazyList(_LazyProxy):
+    """
+    Proxy of a list. Its length and elements can be accessed without
+    constructing the other elements; elements are returned as proxies.
+    """
+
+    __slots__ = ()
+
+    def _lazy_child_state(self, key):
+        return self._lazy_state[int(key)]
+
+    def _lazy_construct(self):
+        return [resolve(self[i]) for i in xrange(len(self))]
+
+    def __len__(self):
+        return len(self._lazy_state)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self._lazy_state)
+        if not 0 <= index < len(self._lazy_state):
+            raise IndexError("list index out of range")
+        return self._lazy_child(str(index))
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+
+class LazyDict(_LazyProxy):
+    """
+    Proxy of a dict. Values are returned as proxies.
+    """
+
+    __slots__ = ()
+
+    def _lazy_child_state(self, key):
+        return self._lazy_state[key]
+
+    def _lazy_construct(self):
+        ret = {}
+        for key in self._lazy_state:
+            ret[key] = resolve(self._lazy_child(key))
+        return ret
+
+    def __len__(self):
+        return len(self._lazy_state)
+
+    def __contains__(self, key):
+        return key in self._lazy_state
+
+    def __getitem__(self, key):
+        return self._lazy_child(key)
+
+    def __iter__(self):
+        return iter(self._lazy_state)
+
+    def get(self, key, default=None):
+        if key in self._lazy_state:
+            return self._lazy_child(key)
+        return default
+
+    def keys(self):
+        return self._lazy_state.keys()
+
+    def iteritems(self):
+        for key in self._lazy_state:
+            yield key, self._lazy_child(key)
+
+    def items(self):
+        return list(self.iteritems())
+
+
+def _lazy(state):
+    """
+    Wrap *state* in a lazy proxy.
+    """
+    if isinstance(state, list):
+        return LazyList(state)
+    if isinstance(state, dict):
+        if _is_state_dict(state):
+            return LazyObject(state)
+        return LazyDict(state)
+    return state
+
+
+def diff_state(old, new):
+    """
+    Compute the changes between objects *old* and *new*, typically two
+    versions of the same :class:`JSONAlizable` object.
+
+    The objects are compared in their serialized form, and the returned patch
+    is JSON-serializable, it can be applied to *old* with
+    :func:`apply_state`. Returns None if the objects are identical.
+
+    Patches are dicts taking one of these forms:
+
+    * ``{"__set__": state}``: replace the value with the unserialized
+      *state*;
+    * ``{"__update__": {name: patch}, "__remove__": [name, ...]}``: patch
+      the attributes of a JSONAlizable object, or the values of a dict.
+      Removed attributes are reset to their default value;
+    * ``{"__items__": {index: patch}, "__length__": length}``: patch the
+      elements of a list, ``__length__`` is only present if the length
+      changed.
+    """
+    return _diff_states(serialize(old), serialize(new))
+
+
+# Types whose values are compared as values of the key type by
+# _diff_states(), strings all become unicode after a JSON round-trip
+_diff_kinds = {unicode: str, long: int}
+
+
+def _diff_states(old, new):
+    old_type = type(old)
+    new_type = type(new)
+    if old_type is not new_type and _diff_kinds.get(old_type, old_type) is \
+            not _diff_kinds.get(new_type, new_type):
+        return {"__set__": new}
+    if old_type is list:
+        items = {}
+        common = min(len(old), len(new))
+        for index in xrange(common):
+            patch = _diff_states(old[index], new[index])
+            if patch is not None:
+                items[str(index)] = patch
+        for index in xrange(common, len(new)):
+            items[str(index)] = {"__set__": new[index]}
+        if len(old) == len(new):
+            if not items:
+                return None
+            return {"__items__": items}
+        return {"__items__": items, "__length__": len(new)}
+    if old_type is dict:
+        old_object = _is_state_dict(old)
+        if old_object and _is_state_dict(new):
+            if old["__class__"] == new["__class__"] \
+                    and old["__args__"] == new["__args__"] \
+                    and _is_jsonalizable_name(new["__class__"]):
+                return _diff_mappings(old["__kwargs__"], new["__kwargs__"])
+        elif not old_object and not _is_state_dict(new):
+            return _diff_mappings(old, new)
+    if old == new:
+        return None
+    return {"__set__": new}
+
+
+def _diff_mappings(old, new):
+    update = {}
+    for key, value in new.iteritems():
+        if key in old:
+            patch = _diff_states(old[key], value)
+            if patch is not None:
+                update[key] = patch
+        else:
+            update[key] = {"__set__": value}
+    remove = [key for key in old if key not in new]
+    if not update and not remove:
+        return None
+    patch = {}
+    if update:
+        patch["__update__"] = update
+    if remove:
+        patch["__remove__"] = remove
+    return patch
+
+
+def _is_jsonalizable_name(name):
+    """
+    Returns True if *name* is the name of a JSONAlizable class using the
+    default :meth:`JSONAlizableBase.uncall`, whose attributes can be patched.
+    """
+    try:
+        cls = get_class(name)
+    except UnregisteredClassError:
+        return False
+    return isinstance(cls, type) and issubclass(cls, JSONAlizableBase) \
+            and _is_default_uncall(reverse_registry[cls][0])
+
+
+def apply_state(obj, patch):
+    """
+    Apply *patch*, computed by :func:`diff_state`, to *obj*.
+
+    Objects, lists and dicts are modified in place. Returns the patched
+    object, which is a new object if the patch replaces *obj* entirely, or if
+    *obj* is a tuple.
+    """
+    if patch is None:
+        return obj
+    if "__set__" in patch:
+        return unserialize(patch["__set__"])
+    if "__items__" in patch:
+        if isinstance(obj, tuple):
+            return tuple(apply_state(list(obj), patch))
+        if "__length__" in patch:
+            del obj[patch["__length__"]:]
+        indexes = sorted((int(key), value)
+                for key, value in patch["__items__"].iteritems())
+        for index, item_patch in indexes:
+            if index < len(obj):
+                obj[index] = apply_state(obj[index], item_patch)
+            else:
+                obj.append(apply_state(None, item_patch))
+        return obj
+    if "__update__" not in patch and "__remove__" not in patch:
+        raise JSONAlizeError("invalid patch: %r" % (patch,))
+    update = patch.get("__update__", {})
+    remove = patch.get("__remove__", ())
+    if isinstance(obj, JSONAlizableBase):
+        fields = dict((field[0], field) for field in obj._codec_plan.fields)
+        for name, value_patch in update.iteritems():
+            name = str(name)
+            setattr(obj, name, apply_state(getattr(obj, name, None),
+                value_patch))
+        for name in remove:
+            name, default, dumper, loader, copier = fields[str(name)]
+            if copier is not None:
+                default = copier(default)
+            setattr(obj, name, default)
+    else:
+        for key, value_patch in update.iteritems():
+            obj[key] = apply_state(obj.get(key), value_patch)
+        for key in remove:
+            del obj[key]
+    return obj
 
 
 def copy(obj):
     """
-    Return a copy of 'obj' by serializing it then deserializing it.
+    Return a deep copy of *obj*, limited to the values that can be
+    serialized.
+
+    Unlike a JSON round trip, types are preserved where no encoding is
+    involved: strings are not converted to unicode, and tuples are copied
+    as tuples (immutable values, see :func:`is_immutable`, are returned as
+    is). Other sequences are copied to lists and mappings to dicts.
+
+    JSONAlizable objects are rebuilt from copies of their fields. Other
+    registered objects are rebuilt directly from the output of their
+    ``uncall()`` function, without encoding it to JSON; tuples in that
+    output are passed to the constructor as lists, like after a JSON round
+    trip.
+
+    Raises TypeError if *obj* contains values that can't be serialized.
+    """
+    obj_type = type(obj)
+    if obj_type in scalar_types:
+        return obj
+    entry = reverse_registry.get(obj_type)
+    if entry is not None:
+        uncall, name = entry
+        if _is_default_uncall(uncall):
+            # Copy JSONAlizable fields directly
+            kwargs = {}
+            for field in obj_type._codec_plan.fields:
+                kwargs[field[0]] = copy(getattr(obj, field[0]))
+            return get_class(name)(**kwargs)
+        args, kwargs = uncall(obj)
+        return _construct({
+                "__class__": name,
+                "__args__": _copy_state(args),
+                "__kwargs__": _copy_state(kwargs),
+            })
+    if obj_type is tuple:
+        if is_immutable(obj):
+            return obj
+        return tuple([copy(value) for value in obj])
+    if looks_like_mapping(obj):
+        ret = {}
+        for key, value in obj.iteritems():
+            ret[key] = copy(value)
+        return ret
+    if isinstance(obj, (list, tuple)):
+        return [copy(value) for value in obj]
+    raise TypeError("%r is not JSON serializable" % (obj,))
+
+
+def _copy_state(state):
+    """
+    Deep copy of a serialized *state*.
+    """
+    state_type = type(state)
+    if state_type in scalar_types:
+        return state
+    if state_type is list or state_type is tuple:
+        return [_copy_state(value) for value in state]
+    if state_type is dict:
+        ret = {}
+        for key, value in state.iteritems():
+            ret[key] = _copy_state(value)
+        return ret
+    raise TypeError("%r is not JSON serializable" % (state,))
+
+
+def is_immutable(obj):
     """
-    return loads(dumps(obj))
+    Returns True if *obj* is None, a boolean, a number, a string, or a tuple
+    containing only such values.
+    """
+    obj_type = type(obj)
+    if obj_type in scalar_types:
+        return True
+    if obj_type is tuple:
+        for value in obj:
+            if not is_immutable(value):
+                return False
+        return True
+    return False
 
 
 def get_class(name):
@@ -338,6 +1726,15 @@ def is_serialized_state(state):
     return False    
 
 
+def _is_state_dict(state):
+    """
+    Faster version of :func:`is_serialized_state` for *state* objects known to
+    be dicts.
+    """
+    return len(state) == 3 and "__class__" in state \
+            and "__args__" in state and "__kwargs__" in state
+
+
 def looks_like_mapping(obj):
     """
     Return True if *obj* looks like a mapping type object.
@@ -378,13 +1775,53 @@ register(types.EllipsisType, uncall_ellipsis, constructor=get_ellipsis)
 
 try:
     import numpy as np
+    import base64
+
+    def is_raw_array(obj):
+        """
+        Returns True if the ndarray *obj* can be stored as a raw buffer.
+        """
+        dtype = obj.dtype
+        return not dtype.hasobject and dtype.fields is None \
+                and dtype.itemsize > 0
 
     def uncall_ndarray(obj):
-        return (obj.tolist(), obj.dtype.name), {}
+        if not is_raw_array(obj):
+            return (obj.tolist(), obj.dtype.name), {}
+        return (), {
+                "dtype": obj.dtype.str, 
+                "shape": list(obj.shape),
+                "data": base64.b64encode(obj.tobytes()),
+            }
 
-    def create_ndarray(data, dtype):
-        return np.array(data, str(dtype))
+    def create_ndarray(data, dtype, shape=None):
+        if shape is None:
+            # List of elements
+            return np.array(data, str(dtype))
+        return array_from_buffer(base64.b64decode(data), dtype, shape)
+
+    def array_from_buffer(data, dtype, shape, offset=0):
+        """
+        Create an array from the raw buffer stored in the string *data* after
+        *offset*.
+        """
+        ret = np.frombuffer(data, str(dtype), offset=offset)
+        return ret.reshape(shape).copy()
 
     register(np.ndarray, uncall_ndarray, constructor=create_ndarray)
+
+    def encode_ndarray(obj):
+        if not is_raw_array(obj):
+            return None
+        header = binpack.packb([obj.dtype.str, list(obj.shape)])
+        return header + obj.tobytes()
+
+    def decode_ndarray(data):
+        unpacker = binpack.Unpacker(data)
+        dtype, shape = unpacker.unpack()
+        return array_from_buffer(data, dtype, shape, unpacker.pos)
+
+    binary_backend.register_native(np.ndarray, 1, encode_ndarray, 
+            decode_ndarray)
 except ImportError:
     pass
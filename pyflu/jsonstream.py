@@ -0,0 +1,210 @@
+"""
+Incremental JSON parsing.
+
+The functions of this module read JSON documents from file objects by chunks,
+and only keep the value being parsed in memory::
+
+    from pyflu import jsonstream
+
+    with open("huge.json") as fp:
+        for item in jsonstream.iter_array(fp, "/path/to/array"):
+            process(item)
+
+"""
+import re
+try:
+    from json import JSONDecoder
+except ImportError:
+    from simplejson import JSONDecoder
+
+
+class JSONStreamError(ValueError): pass
+
+
+whitespace = " \t\n\r"
+# Characters that can continue a number
+number_chars = "0123456789.eE+-"
+# Position of the error in the messages of the decoder
+error_position = re.compile(r"\(char (\d+)")
+# Longest JSON token that can be cut in a way that is reported before the end
+# of the buffer (a \uXXXX escape)
+max_cut_token = 6
+
+
+class StreamReader(object):
+    """
+    Buffered reader decoding JSON values one at a time from file object *fp*.
+    """
+
+    def __init__(self, fp, chunk_size=2**16, decoder=None):
+        if decoder is None:
+            decoder = JSONDecoder()
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.decoder = decoder
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, size=None):
+        """
+        Read *size* more bytes (defaults to *chunk_size*) in the buffer,
+        dropping the data already consumed.
+
+        Returns False if the end of the file was reached.
+        """
+        if self.eof:
+            return False
+        if size is None:
+            size = self.chunk_size
+        data = self.fp.read(size)
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        if not data:
+            self.eof = True
+            return False
+        return True
+
+    def peek(self):
+        """
+        Skip whitespace and return the next character, or an empty string at
+        the end of the file.
+        """
+        while True:
+            buffer = self.buffer
+            pos = self.pos
+            end = len(buffer)
+            while pos < end and buffer[pos] in whitespace:
+                pos += 1
+            self.pos = pos
+            if pos < end:
+                return buffer[pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, chars):
+        """
+        Consume the next character, raising :class:`JSONStreamError` if it is
+        not one of *chars*.
+        """
+        char = self.peek()
+        if not char or char not in chars:
+            raise JSONStreamError("expected one of %r at offset %d, got %r" %
+                    (chars, self.offset(), char))
+        self.pos += 1
+        return char
+
+    def decode(self):
+        """
+        Decode the next JSON value.
+        """
+        if not self.peek():
+            raise JSONStreamError("unexpected end of file")
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError, err:
+                position = self.error_position(err)
+                error = JSONStreamError("%s at offset %d" % (
+                    str(err).split(": line ")[0], self.offset(position)))
+                # The value may be incomplete, read more data (at least as
+                # much as what we already have, to keep the number of retries
+                # logarithmic). Invalid data is reported right away, instead
+                # of buffering the rest of the file.
+                if not self.truncated(err, position) or not self.fill(
+                        max(self.chunk_size, len(self.buffer) - self.pos)):
+                    raise error
+                continue
+            if not self.eof and (end == len(self.buffer) or
+                    (isinstance(value, (int, long, float))
+                        and self.buffer[end] in number_chars)):
+                # Make sure a number is not cut at the end of the buffer
+                # ("1." or "1e" decode as 1)
+                self.fill(self.chunk_size)
+                continue
+            self.pos = end
+            return value
+
+    def error_position(self, err):
+        """
+        Returns the position in the buffer of the decoding error *err*, or
+        None if the decoder did not report it.
+        """
+        match = error_position.search(str(err))
+        if match is None:
+            return None
+        return int(match.group(1))
+
+    def truncated(self, err, position):
+        """
+        Returns True if the decoding error *err*, at *position*, may be
+        caused by the end of the buffer rather than by invalid data.
+        """
+        if position is None or str(err).startswith("Unterminated string"):
+            return True
+        return position > len(self.buffer) - max_cut_token
+
+    def offset(self, pos=None):
+        """
+        Returns a description of the current position, or of the position
+        *pos* in the buffer, for error messages.
+        """
+        if pos is None:
+            pos = self.pos
+        return self.fp.tell() - len(self.buffer) + pos \
+                if hasattr(self.fp, "tell") else pos
+
+
+def iter_array(fp, path=None, chunk_size=2**16, decoder=None):
+    """
+    Iterate over the elements of a JSON array read incrementally from file
+    object *fp*.
+
+    By default the array must be the top-level value of the document. *path*
+    can be used to select an array nested in objects or other arrays, with
+    the same syntax as :func:`pyflu.containerutils.get_from_dict`; components
+    are object keys, or indexes when the parent is an array.
+
+    Only one element is held in memory at a time. Values preceding the array
+    in its parents are decoded one by one and discarded.
+    """
+    reader = StreamReader(fp, chunk_size, decoder)
+    if path is None:
+        components = []
+    else:
+        components = [c for c in path.split("/") if c]
+    for component in components:
+        seek_child(reader, component, path)
+    reader.expect("[")
+    if reader.peek() == "]":
+        reader.pos += 1
+        return
+    while True:
+        yield reader.decode()
+        if reader.expect(",]") == "]":
+            return
+
+
+def seek_child(reader, component, path):
+    """
+    Move *reader* to the child named *component* of the object or array it
+    is positioned on.
+    """
+    container = reader.expect("{[")
+    closing = "}" if container == "{" else "]"
+    index = 0
+    if reader.peek() != closing:
+        while True:
+            if container == "{":
+                key = reader.decode()
+                reader.expect(":")
+                found = key == component
+            else:
+                found = str(index) == component
+                index += 1
+            if found:
+                return
+            reader.decode()
+            if reader.expect("," + closing) == closing:
+                break
+    raise JSONStreamError("invalid path: %s" % path)
@@ -4,6 +4,7 @@ from os.path import join, isdir
 from pyflu.command import run_script
 import pysvn
 from pyflu.update import diff
+from pyflu.update.hashcache import HashCache
 
 
 def svn_info(path="."):
@@ -34,6 +35,11 @@ class CreatePatchCommand(VersionCommandBase):
             ("patches-root=", None, "Root of the patched content, relative "
                 "to the 'dist' directory of the project."),
             ("verbose-freeze", None, "Verbose output."),
+            ("jobs=", "j", "Number of processes used to compute diffs, 0 to "
+                "use all the available CPUs."),
+            ("hash-cache=", None, "File caching the control sums of the "
+                "versions files. Defaults to hashes.json in the patches "
+                "directory."),
         ]
 
     defaults = {
@@ -46,6 +52,8 @@ class CreatePatchCommand(VersionCommandBase):
             "suffix": ".tar.bz2",
             "patches_root": "",
             "verbose_freeze": False,
+            "jobs": 1,
+            "hash_cache": None,
         }
 
     boolean_options = ["py2exe", "py2app", "verbose_freeze"]
@@ -76,6 +84,9 @@ class CreatePatchCommand(VersionCommandBase):
         self.svn_url, self.head_rev = svn_info()
         if not self.to_version:
             self.to_version = str(self.head_rev)
+        self.jobs = int(self.jobs)
+        if not self.hash_cache:
+            self.hash_cache = join(self.patches_dir, "hashes.json")
 
     def run(self):
         old_path = self.prepare_image(self.from_version)
@@ -83,9 +94,11 @@ class CreatePatchCommand(VersionCommandBase):
         print "creating patch %s > %s" % (self.from_version, self.to_version)
         if not isdir(self.patches_subdir):
             os.mkdir(self.patches_subdir)
+        hash_cache = HashCache(self.hash_cache)
         diff(join(self.patches_subdir, "%s-r%s-r%s%s" % (self.prefix,
             self.from_version, self.to_version, self.suffix)), old_path,
-            new_path)
+            new_path, self.jobs or None, hash_cache=hash_cache)
+        hash_cache.save()
 
     def prepare_image(self, version):
         svn_dir = join(self.svn_subdir, version)
@@ -1,6 +1,14 @@
 from nose.tools import assert_equal, assert_raises
-from pyflu.jsonalize import JSONAlizable, dumps, loads, NameConflictError, \
-        UnregisteredClassError, SchemaValidationError, get_class, copy
+from pyflu.jsonalize import JSONAlizable, JSONAlizableBase, dumps, loads, \
+        NameConflictError, UnregisteredClassError, SchemaValidationError, \
+        get_class, copy, serialize, unserialize, register, unregister, \
+        iterload, iterencode, dump_iter, dump, load, JSONAlizeError, \
+        serialize_deep, unserialize_deep, load_lazy, loads_lazy, lazy_get, \
+        resolve, LazyObject, LazyList, LazyDict, diff_state, apply_state
+from pyflu.jsonstream import JSONStreamError
+from pyflu import binpack
+from StringIO import StringIO
+import json
 import uuid
 import numpy as np
 
@@ -135,3 +143,404 @@ def test_builtin():
     array = np.arange(5)
     assert_equal((array == copy(array)).all(), True)
 
+
+
+def test_codec_plan():
+    # Fields holding values of another type than their default
+    s = SubSubSub(foo=Sub(baz="other"), baz=[1, 2], slices={"a": slice(1)})
+    s2 = copy(s)
+    assert_equal(s2, s)
+    assert_equal(s2.slices, {"a": slice(1)})
+
+    # Registering a class after its instances were serialized
+    class Plain(object):
+        def __init__(self, value):
+            self.value = value
+
+    obj = Plain(1)
+    assert_equal(serialize(obj), obj)
+    register(Plain, lambda o: ([o.value], {}))
+    try:
+        assert_equal(serialize(obj), {"__class__": "Plain", "__args__": [1],
+            "__kwargs__": {}})
+        assert_equal(unserialize(serialize(obj)).value, 1)
+    finally:
+        unregister(Plain)
+    assert_equal(serialize(obj), obj)
+
+    # JSONAlizableBase used as a mixin, without the metaclass
+    class Mixin(JSONAlizableBase):
+        schema = {"x": 0, "items": []}
+
+    class MixinSub(Mixin):
+        schema = {"y": 1}
+
+    m = Mixin(x=1)
+    assert_equal((m.x, m.items), (1, []))
+    assert m.items is not Mixin().items
+    assert_equal(m.uncall(), ((), {"x": 1, "items": []}))
+    assert_equal(MixinSub(y=2).y, 2)
+    assert_raises(NameError, MixinSub, x=1)
+    register(Mixin, Mixin.uncall)
+    try:
+        m2 = loads(dumps(m))
+        assert_equal((type(m2), m2.x, m2.items), (Mixin, 1, []))
+    finally:
+        unregister(Mixin)
+
+
+def test_iterload():
+    objs = [Sub(baz="a" * 100), 12345, [1.5, None, "x"], {"a": Base()}, 6789]
+    doc = dumps(objs)
+    # Small chunks to exercise buffer refills
+    for chunk_size in (1, 7, 2**16):
+        loaded = list(iterload(StringIO(doc), chunk_size=chunk_size))
+        assert_equal(loaded, objs)
+    # Nested arrays
+    doc = dumps({"skipped": [Sub()], "data": {"items": objs}})
+    assert_equal(list(iterload(StringIO(doc), "/data/items", chunk_size=3)),
+            objs)
+    doc = dumps([[], [1, [Sub(), Sub(baz="b")]]])
+    assert_equal(list(iterload(StringIO(doc), "/1/1", chunk_size=5)),
+            [Sub(), Sub(baz="b")])
+    assert_equal(list(iterload(StringIO("[]"))), [])
+    # Numbers cut at chunk boundaries
+    floats = [1.5, 2.25, -3e-5, 12345.6789, 10, 1E+20]
+    doc = "[1.5, 2.25, -3e-5, 12345.6789, 10, 1E+20]"
+    for chunk_size in range(1, 10):
+        assert_equal(list(iterload(StringIO(doc), chunk_size=chunk_size)),
+                floats)
+    floats = [i * 0.123456789 for i in range(20000)]
+    assert_equal(list(iterload(StringIO(dumps(floats)), chunk_size=4096)),
+            floats)
+    # Errors
+    assert_raises(JSONStreamError, list, iterload(StringIO(doc), "/2"))
+    assert_raises(JSONStreamError, list, iterload(StringIO("{}")))
+    assert_raises(ValueError, list, iterload(StringIO("[1, 2")))
+    # Invalid elements are reported without reading the rest of the file
+    fp = StringIO("[1, 2, 3, {bad}, " + "4, " * 100000 + "5]")
+    try:
+        list(iterload(fp, chunk_size=16))
+    except JSONStreamError, err:
+        assert_equal(str(err), "Expecting property name at offset 11")
+    else:
+        assert False, "JSONStreamError not raised"
+    assert fp.tell() < 100
+    assert_raises(JSONStreamError, list, iterload(StringIO('["a", "b')))
+
+
+def test_iterencode():
+    objs = [Base(), SubSubSub(), {"a": [1, 2.5, None], 1: True}, (), {}, 
+            u"\xe9", 1 + 2j]
+    state = serialize(objs)
+    for kwargs in ({"indent": None}, 
+            {"indent": None, "separators": (",", ":")}, 
+            {"indent": 4, "separators": (",", ": ")}):
+        text = "".join(iterencode(objs, sort_keys=True, chunk_size=10, 
+            **kwargs))
+        assert_equal(text, json.dumps(state, sort_keys=True, **kwargs))
+    # Default layout is the same as dumps()
+    assert_equal(loads("".join(iterencode(objs))), loads(dumps(objs)))
+    # Generators
+    fp = StringIO()
+    dump_iter((Sub(baz=i) for i in range(3)), fp)
+    assert_equal(loads(fp.getvalue()), [Sub(baz=i) for i in range(3)])
+    # JSON lines
+    fp = StringIO()
+    dump_iter(objs, fp, lines=True)
+    assert_equal(len(fp.getvalue().splitlines()), len(objs))
+    fp.seek(0)
+    assert_equal(list(iterload(fp, lines=True)), loads(dumps(objs)))
+    assert_raises(TypeError, list, iterencode(set()))
+    assert_raises(TypeError, list, iterencode({(1, 2): 3}))
+
+
+def test_copy():
+    # Immutable values are not copied
+    t = (1, "a", (None, 2.5))
+    assert copy(t) is t
+    # Mutable values are
+    l = [1, {"a": [Sub()]}, (2, [3])]
+    l2 = copy(l)
+    assert_equal(l2, l)
+    assert l2[1]["a"] is not l[1]["a"]
+    assert l2[1]["a"][0] is not l[1]["a"][0]
+    assert l2[2][1] is not l[2][1]
+    # Mutable schema defaults are not shared between instances
+    s1, s2 = SubSubSub(), SubSubSub()
+    assert s1.slices is not s2.slices
+    assert_equal(s1.slices, s2.slices)
+    assert_raises(TypeError, copy, [set()])
+
+
+def test_binpack():
+    values = [None, True, False, 0, 127, 128, -1, -32, -33, -129, 2**16, 
+            2**32, 2**64 - 1, -2**63, 1.5, float("inf"), "", "a" * 300,
+            u"\xe9t\xe9" * 20, [], [1] * 20, (1, 2), {}, 
+            dict((str(i), i) for i in range(20)), {1: [2, {"3": None}]},
+            binpack.ExtType(5, "x" * 3), binpack.ExtType(5, "x" * 16),
+            "b" * 70000]
+    for value in values:
+        packed = binpack.packb(value)
+        if isinstance(value, tuple):
+            value = list(value)
+        assert_equal(binpack.unpackb(packed), value)
+    assert_equal(binpack.packb({"compact": True, "schema": 0}), 
+            "\x82\xc4\x07compact\xc3\xc4\x06schema\x00")
+    assert_raises(TypeError, binpack.packb, 2**64)
+    assert_raises(TypeError, binpack.packb, set())
+    assert_raises(binpack.UnpackError, binpack.unpackb, "\x92\x01")
+    assert_raises(binpack.UnpackError, binpack.unpackb, "\x01\x02")
+    assert_raises(binpack.UnpackError, binpack.unpackb, "\xc1")
+
+
+def test_binary_backend():
+    objs = [Base(), SubSubSub(), 1 + 2j, uuid.uuid4(), Ellipsis,
+            {"a": (1, 2.5, None), "b": u"\xe9"}]
+    data = dumps(objs, backend="binary")
+    assert_equal(loads(data, backend="binary"), loads(dumps(objs)))
+    fp = StringIO()
+    dump(Sub(baz=[Sub()]), fp, backend="binary")
+    fp.seek(0)
+    assert_equal(load(fp, backend="binary"), Sub(baz=[Sub()]))
+    # NumPy arrays are stored natively
+    for array in sample_arrays():
+        loaded = loads(dumps(array, backend="binary"), backend="binary")
+        assert_same_array(loaded, array)
+    assert_raises(JSONAlizeError, dumps, 1, backend="yaml")
+
+
+def sample_arrays():
+    nan = np.frombuffer("\x01\x00\xc0\x7f", "<f4")[0]
+    return [np.arange(10, dtype="float32").reshape(2, 5),
+            np.array([np.nan, -0.0, 1e300, nan]), np.array([], dtype="int16"),
+            np.array(3), np.arange(10)[::3], np.arange(6).reshape(2, 3).T,
+            np.array([1, 2], dtype=">i4"), np.array(["ab", "c"]),
+            np.array([True, False]), np.array([1, "a", None], dtype=object)]
+
+
+def assert_same_array(loaded, array):
+    assert_equal(loaded.dtype, array.dtype)
+    assert_equal(loaded.shape, array.shape)
+    if array.dtype.hasobject:
+        assert_equal(loaded.tolist(), array.tolist())
+    else:
+        assert_equal(loaded.tobytes(), array.tobytes())
+        assert loaded.flags.writeable
+
+
+def test_ndarray():
+    for array in sample_arrays():
+        assert_same_array(loads(dumps(array)), array)
+        assert_same_array(copy(array), array)
+    # Elements list format
+    state = {"__class__": "ndarray", "__args__": [[1, 2], "int16"],
+            "__kwargs__": {}}
+    assert_same_array(unserialize(state), np.array([1, 2], dtype="int16"))
+
+
+class Twin(JSONAlizable):
+
+    schema = {"first": None, "second": None}
+
+    def __init__(self, first=None, second=None):
+        super(Twin, self).__init__(first=first, second=first)
+
+
+def test_references():
+    shared = Sub(baz="shared")
+    objs = [shared, Sub(foo=shared), {"a": shared}, Base(foo=shared),
+            np.arange(3)]
+    for backend in ("json", "binary"):
+        data = dumps(objs, backend=backend, references=True)
+        loaded = loads(data, backend=backend, references=True)
+        assert_equal(loaded[:4], objs[:4])
+        assert loaded[1].foo is loaded[0]
+        assert loaded[2]["a"] is loaded[0]
+        assert loaded[3].foo is loaded[0]
+        assert_equal(list(loaded[4]), [0, 1, 2])
+        # Cycles
+        parent = Sub(baz="parent")
+        child = Sub(baz="child", foo=parent)
+        parent.foo = [child, (parent,), {"self": parent}]
+        data = dumps(parent, backend=backend, references=True)
+        loaded = loads(data, backend=backend, references=True)
+        assert_equal(loaded.baz, "parent")
+        assert_equal(loaded.foo[0].baz, "child")
+        assert loaded.foo[0].foo is loaded
+        assert loaded.foo[1][0] is loaded
+        assert loaded.foo[2]["self"] is loaded
+    # Placeholders stored in several fields by a constructor
+    state = {"__class__": "Sub", "__args__": [], "__id__": 0,
+            "__kwargs__": {"foo": {"__class__": "Twin", "__id__": 1,
+            "__args__": [], "__kwargs__": {"first": {"__ref__": 0}}}}}
+    loaded = unserialize(state, True)
+    assert loaded.foo.first is loaded
+    assert loaded.foo.second is loaded
+    # Shared objects are stored once
+    many = [Sub(baz=range(100))] * 100
+    assert len(dumps(many, references=True)) < len(dumps(many)) / 10
+    # Cycles through non JSONAlizable objects can't be restored
+    class Holder(object):
+        def __init__(self, value):
+            self.value = value
+    register(Holder, lambda o: ([o.value], {}))
+    try:
+        state = {"__class__": "Sub", "__args__": [], "__id__": 0, 
+                "__kwargs__": {"foo": {"__class__": "Holder", "__id__": 1,
+                "__args__": [{"__ref__": 0}], "__kwargs__": {}}}}
+        assert_raises(JSONAlizeError, unserialize, state, True)
+    finally:
+        unregister(Holder)
+
+
+def test_deep():
+    objs = [Base(), SubSubSub(), {"a": [1, (2, 3)], "b": u"c"}, 1 + 2j,
+            np.arange(3), [[[]]], Sub(foo=Sub(foo=Sub()))]
+    state = serialize(objs)
+    assert_equal(serialize_deep(objs), state)
+    assert_equal(unserialize_deep(state)[:4], unserialize(state)[:4])
+    assert_equal(unserialize_deep(state)[5:], unserialize(state)[5:])
+    # Beyond the recursion limit
+    depth = 10000
+    chain = Sub(baz=0)
+    for i in range(1, depth):
+        chain = Sub(baz=i, foo=chain)
+    nested = []
+    for i in range(depth):
+        nested = [nested]
+    state = serialize_deep([chain, nested])
+    loaded_chain, loaded_nested = unserialize_deep(state)
+    for i in reversed(range(depth)):
+        assert_equal(loaded_chain.baz, i)
+        loaded_chain = loaded_chain.foo
+        assert_equal(len(loaded_nested), 1)
+        loaded_nested = loaded_nested[0]
+    assert_equal(loaded_chain, None)
+    assert_equal(loaded_nested, [])
+    # Deep containers in fields
+    obj = Sub()
+    obj.foo = nested
+    obj.baz = [nested]
+    state = serialize_deep(obj)
+    loaded = unserialize_deep(state)
+    for value in (loaded.foo, loaded.baz[0]):
+        for i in range(depth):
+            assert_equal(len(value), 1)
+            value = value[0]
+        assert_equal(value, [])
+
+
+class Counted(Sub):
+
+    instances = 0
+
+    def __init__(self, **kwargs):
+        super(Counted, self).__init__(**kwargs)
+        Counted.instances += 1
+
+
+def test_lazy():
+    doc = {"items": [Counted(baz=i, foo=Counted(baz=-i)) for i in range(10)],
+            "extra": (slice(1, 2), 3)}
+    for backend in ("json", "binary"):
+        data = dumps(doc, backend=backend)
+        Counted.instances = 0
+        proxy = loads_lazy(data, backend=backend)
+        assert isinstance(proxy, LazyDict)
+        items = proxy["items"]
+        assert isinstance(items, LazyList)
+        assert_equal(len(items), 10)
+        assert_equal(Counted.instances, 0)
+        # Path access only constructs the requested object
+        child = lazy_get(proxy, "/items/3/foo")
+        assert isinstance(child, LazyObject)
+        assert_equal(lazy_get(proxy, "/items/3/baz"), 3)
+        assert_equal(Counted.instances, 0)
+        assert_equal(child.baz, -3)
+        assert_equal(Counted.instances, 1)
+        # Parents reuse the objects already constructed
+        parent = resolve(items[3])
+        assert_equal(Counted.instances, 2)
+        assert parent.foo is resolve(child)
+        assert_equal(resolve(proxy), loads(data, backend=backend))
+        assert_raises(ValueError, lazy_get, proxy, "/items/10")
+        assert_raises(ValueError, lazy_get, proxy, "/items/3/baz/x")
+        assert_raises(ValueError, lazy_get, proxy, "/nothing")
+    assert_equal(resolve(5), 5)
+    fp = StringIO(dumps([Sub(baz=1)]))
+    assert_equal(lazy_get(load_lazy(fp), "/0/baz"), 1)
+
+
+class Sparse(Sub):
+
+    omit_defaults = True
+
+    schema = {
+            "items": [],
+            "count": 0,
+        }
+
+
+def test_omit_defaults():
+    obj = Sparse(baz="yarr", count=2)
+    assert_equal(serialize(obj)["__kwargs__"], {"count": 2})
+    assert_equal(loads(dumps(obj, backend="binary"), backend="binary"), obj)
+    assert_equal(loads(dumps(obj)), obj)
+    assert_equal(unserialize(serialize_deep(obj)), obj)
+    # Values of a different type are not omitted
+    obj.count = 0.0
+    assert_equal(serialize(obj)["__kwargs__"], {"count": 0.0})
+
+
+def test_diff_state():
+    old = Base(foo=Sparse(items=[1, 2, 3], count=1))
+    old.dict["three"] = (1, 2)
+    assert_equal(diff_state(old, copy(old)), None)
+    new = copy(old)
+    new.bar = 456
+    new.foo.items = [1, 5]
+    new.foo.count = 0
+    new.list.append(Sub(baz="three"))
+    new.list[0].baz = "zero"
+    new.dict["three"] = (1, 3)
+    del new.dict["two"]
+    new.dict["four"] = slice(1, 2)
+    patch = diff_state(old, new)
+    assert_equal(patch, {"__update__": {
+            "bar": {"__set__": 456},
+            "foo": {
+                "__update__": {"items": {
+                    "__items__": {"1": {"__set__": 5}},
+                    "__length__": 2,
+                }},
+                "__remove__": ["count"],
+            },
+            "list": {
+                "__items__": {
+                    "0": {"__update__": {"baz": {"__set__": "zero"}}},
+                    "2": {"__set__": serialize(Sub(baz="three"))},
+                },
+                "__length__": 3,
+            },
+            "dict": {
+                "__update__": {
+                    "three": {"__items__": {"1": {"__set__": 3}}},
+                    "four": {"__set__": serialize(slice(1, 2))},
+                },
+                "__remove__": ["two"],
+            },
+        }})
+    patch = json.loads(json.dumps(patch))
+    patched = apply_state(old, patch)
+    assert patched is old
+    assert_equal(old, new)
+    assert_equal(apply_state(1, diff_state(1, "a")), "a")
+    # Strings become unicode after a JSON round-trip
+    loaded = loads(dumps(new))
+    new.foo.count = 3
+    new.list[1].baz = u"two"
+    assert_equal(diff_state(loaded, new), {"__update__": {"foo":
+        {"__update__": {"count": {"__set__": 3}}}}})
+    assert_equal(diff_state(1L, 1), None)
+    assert_raises(JSONAlizeError, apply_state, old, {"foo": 1})
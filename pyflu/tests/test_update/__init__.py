@@ -1,11 +1,23 @@
 import os
-from nose.tools import assert_true
+from nose.tools import assert_true, assert_equal, assert_raises
 from os.path import dirname, join, isdir, isfile
 from pyflu.update import patch, diff, sub_path, control_sum, \
         InvalidOriginalFile, InvalidResultingFile, IncompatiblePatchFormat, \
-        archive_path
+        archive_path, digest_algorithms, UnknownDigest, load_patch_info, \
+        UpdateError
+from pyflu.update import PatchFile
 from pyflu.update.version import Version
+from pyflu.update.chunks import Chunker, python_cut_points
+from pyflu.update.compression import codecs, detect_codec, UnknownCodec
+from pyflu.update.archive import IndexedArchive, is_indexed_archive
+from pyflu.update.hashcache import HashCache
+from pyflu.update.chain import patch_chain
 import shutil
+import tarfile
+import pickle
+import tempfile
+import random
+import time
 
 
 data_dir = join(dirname(__file__), "data")
@@ -67,6 +79,306 @@ def test_basic():
     compare_directories(new_dir, tmp_dir)
 
 
+def test_parallel_diff():
+    parallel_patch_file = join(data_dir, "parallel_patch.tar.bz2")
+    diff(patch_file, orig_dir, new_dir)
+    diff(parallel_patch_file, orig_dir, new_dir, workers=3)
+    try:
+        assert open(patch_file, "rb").read() == \
+                open(parallel_patch_file, "rb").read()
+    finally:
+        os.unlink(parallel_patch_file)
+
+
+class FailingPatchFile(PatchFile):
+
+    def write_diff(self, *args, **kwargs):
+        # Let the workers compute the other diffs
+        time.sleep(1)
+        raise IOError("disk full")
+
+
+def test_diff_cleanup():
+    work_dir = tempfile.mkdtemp()
+    default_tempdir = tempfile.tempdir
+    tempfile.tempdir = work_dir
+    try:
+        tar = tarfile.open(patch_file, "w:bz2")
+        patch = FailingPatchFile(tar, block_size=100)
+        assert_raises(IOError, patch.diff, orig_dir, new_dir, workers=3)
+        tar.close()
+        # Blocked diffs of results that were not consumed are removed
+        assert_equal(os.listdir(work_dir), [])
+    finally:
+        tempfile.tempdir = default_tempdir
+        shutil.rmtree(work_dir)
+
+
+def test_parallel_patch():
+    for indexed in (False, True):
+        diff(patch_file, orig_dir, new_dir, block_size=100, dedup=True,
+                indexed=indexed)
+        for processes in (False, True):
+            calls = []
+            def start_callback(stage, length):
+                calls.append((stage, length))
+            def progress_callback(index):
+                calls.append(index)
+            patch(patch_file, orig_dir, tmp_dir, start_callback, 
+                    progress_callback, workers=3, processes=processes)
+            one_way_compare(new_dir, tmp_dir)
+            shutil.rmtree(tmp_dir)
+            stages = [i for i, c in enumerate(calls) if isinstance(c, tuple)]
+            assert_equal([calls[i][0] for i in stages], ["patch", "plain"])
+            for i in stages:
+                assert_equal(calls[i + 1:i + 1 + calls[i][1]], 
+                        range(1, calls[i][1] + 1))
+            assert_equal(len(calls), 2 + calls[0][1] + calls[stages[1]][1])
+    assert_raises(InvalidOriginalFile, patch, patch_file, bad_orig_dir, 
+            tmp_dir, workers=3)
+
+
+def test_unchanged_files():
+    diff(patch_file, orig_dir, new_dir)
+    tar = tarfile.open(patch_file, "r:bz2")
+    names = tar.getnames()
+    tar.close()
+    assert "patches/img.png" in names
+    assert "patches/exec" not in names
+    assert "patches/subdir/subfile" not in names
+    patch(patch_file, orig_dir, tmp_dir)
+    compare_directories(new_dir, tmp_dir)
+
+
+def test_blocks():
+    diff(patch_file, orig_dir, new_dir, block_size=100)
+    tar = tarfile.open(patch_file, "r:bz2")
+    info = load_patch_info(tar.extractfile("info").read())
+    tar.close()
+    assert info.blocked == {"patches/img.png": 100, 
+            "patches/empty/subdir/img.png": 100}
+    patch(patch_file, orig_dir, tmp_dir)
+    compare_directories(new_dir, tmp_dir)
+    # The sum of the original is checked after patching
+    work_dir = tempfile.mkdtemp()
+    try:
+        bad_orig = join(work_dir, "img.png")
+        data = open(join(orig_dir, "img.png"), "rb").read()
+        open(bad_orig, "wb").write(data[:-1] + chr(ord(data[-1]) ^ 1))
+        dest = join(work_dir, "dest.png")
+        tar = tarfile.open(patch_file, "r:bz2")
+        try:
+            patch_obj = PatchFile(tar)
+            patch_obj.info = load_patch_info(tar.extractfile("info").read())
+            assert_raises(InvalidOriginalFile, patch_obj.patch_file,
+                    bad_orig, dest, "patches/img.png")
+        finally:
+            tar.close()
+        assert not os.path.exists(dest)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def test_dedup():
+    work_dir = tempfile.mkdtemp()
+    try:
+        rand = random.Random(0)
+        data = "".join(chr(rand.randrange(256)) for i in range(20000))
+        old = join(work_dir, "old")
+        new = join(work_dir, "new")
+        for path, content in [
+                (join(old, "a.bin"), data),
+                (join(old, "b.bin"), data[::-1]),
+                (join(new, "a.bin"), data),
+                (join(new, "moved", "a.bin"), data),
+                (join(new, "c.bin"), data[:5000] + "abc" + data[5000:]),
+                ]:
+            if not isdir(dirname(path)):
+                os.makedirs(dirname(path))
+            open(path, "wb").write(content)
+        # Chunker splits files similarly with python and numpy
+        chunker = Chunker(1024)
+        ref = python_cut_points(data, 123, chunker.mask)
+        assert ref == chunker.cut_points(data, 123)
+        tar = tarfile.open(patch_file, "w:bz2")
+        PatchFile(tar, chunker=chunker).diff(old, new)
+        tar.close()
+        tar = tarfile.open(patch_file, "r:bz2")
+        names = tar.getnames()
+        tar.close()
+        assert "plain/moved/a.bin" not in names
+        assert "plain/c.bin" not in names
+        assert len([n for n in names if n.startswith("chunks/")]) <= 2
+        patch(patch_file, old, join(work_dir, "result"))
+        one_way_compare(new, join(work_dir, "result"))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def test_patch_chain():
+    work_dir = tempfile.mkdtemp()
+    try:
+        rand = random.Random(0)
+        data = "".join(chr(rand.randrange(256)) for i in range(5000))
+        versions = [
+                {"same": data, "changed": data, "once": data,
+                    "sub/removed": data},
+                {"same": data, "changed": data[:100] + "a" + data[100:],
+                    "once": data[::-1], "sub/new": data[:3000]},
+                {"same": data, "changed": data[:200] + "b" + data[200:],
+                    "once": data[::-1], "sub/new": data[:2000] + data,
+                    "moved": data[::-1]},
+                {"same": data, "changed": data[300:], "once": data[::-1],
+                    "sub/new": data[:2000], "moved": data[::-1] + "c"},
+            ]
+        dirs = []
+        for index, files in enumerate(versions):
+            dirs.append(join(work_dir, "v%d" % index))
+            for path, content in files.items():
+                path = join(dirs[-1], *path.split("/"))
+                if not isdir(dirname(path)):
+                    os.makedirs(dirname(path))
+                open(path, "wb").write(content)
+        # Blocked and whole files diffs are mixed
+        for block_sizes in ((100, 100, 100), (100, None, 1000)):
+            patches = []
+            for index, block_size in enumerate(block_sizes):
+                patches.append(join(work_dir, "patch-%d.tar.bz2" % index))
+                diff(patches[-1], dirs[index], dirs[index + 1],
+                        block_size=block_size)
+            for workers in (1, 3):
+                result = join(work_dir, "result")
+                patch_chain(patches, dirs[0], result, workers=workers)
+                # Files are never removed by patches
+                one_way_compare(dirs[-1], result)
+                assert_equal(open(join(result, "sub", "removed"),
+                    "rb").read(), data)
+                shutil.rmtree(result)
+        # Files built from chunks of the previous version need several runs
+        diff(patches[1], dirs[1], dirs[2], dedup=True)
+        patch_chain(patches, dirs[0], result)
+        one_way_compare(dirs[-1], result)
+        shutil.rmtree(result)
+        # Checks
+        open(join(dirs[0], "same"), "ab").write("x")
+        assert_raises(InvalidOriginalFile, patch_chain, patches, dirs[0],
+                result)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def test_codecs():
+    for name in codecs:
+        diff(patch_file, orig_dir, new_dir, codec=name)
+        assert_equal(detect_codec(patch_file).name, name)
+        patch(patch_file, orig_dir, tmp_dir)
+        compare_directories(new_dir, tmp_dir)
+        shutil.rmtree(tmp_dir)
+    assert_raises(UnknownCodec, diff, patch_file, orig_dir, new_dir, 
+            codec="foo")
+
+
+def test_digests():
+    for name in digest_algorithms:
+        diff(patch_file, orig_dir, new_dir, digest=name)
+        tar = tarfile.open(patch_file, "r:bz2")
+        info = load_patch_info(tar.extractfile("info").read())
+        tar.close()
+        assert_equal(info.digest, name)
+        assert_equal(info.control_sums["patches/img.png"][1], 
+                control_sum(join(new_dir, "img.png"), name))
+        patch(patch_file, orig_dir, tmp_dir)
+        compare_directories(new_dir, tmp_dir)
+        shutil.rmtree(tmp_dir)
+        assert_raises(InvalidOriginalFile, patch, patch_file, bad_orig_dir, 
+                tmp_dir)
+        shutil.rmtree(tmp_dir)
+    assert_raises(UnknownDigest, diff, patch_file, orig_dir, new_dir, 
+            digest="foo")
+
+
+def test_patch_info():
+    diff(patch_file, orig_dir, new_dir, block_size=100, dedup=True)
+    tar = tarfile.open(patch_file, "r:bz2")
+    data = tar.extractfile("info").read()
+    tar.close()
+    info = load_patch_info(data)
+    assert info.recipes and info.blocked and info.unchanged
+    assert_equal(info.pack(), data)
+    assert_equal(load_patch_info(info.pack()).__dict__, info.__dict__)
+    # Binary format checks
+    assert_raises(UpdateError, load_patch_info, data[:-1])
+    assert_raises(IncompatiblePatchFormat, load_patch_info, 
+            data.replace(info.version, "9.9", 1))
+    # Legacy pickled patch info
+    del info.__dict__["packed_ctrl"]
+    info.version = "0.6"
+    legacy = load_patch_info(pickle.dumps(info))
+    assert not legacy.packed_ctrl
+    assert_equal(legacy.control_sums, info.control_sums)
+    assert_raises(UpdateError, load_patch_info, 
+            "cos\nsystem\n(S'echo unsafe'\ntR.")
+
+
+def test_hash_cache():
+    cache_path = join(data_dir, "hashes.json")
+    img_path = join(orig_dir, "img.png")
+    try:
+        cache = HashCache(cache_path)
+        cache.min_age = 0
+        diff(patch_file, orig_dir, new_dir, hash_cache=cache)
+        assert_equal(cache.get(img_path, "sha512"), control_sum(img_path))
+        assert_equal(cache.get(img_path, "sha256"), None)
+        # Sums are stored with the stats taken before hashing
+        calls = []
+        set_sum = cache.set
+        def record_set(path, digest, sum, statinfo=None):
+            calls.append(statinfo)
+            set_sum(path, digest, sum, statinfo)
+        cache.set = record_set
+        diff(patch_file, orig_dir, new_dir, hash_cache=cache)
+        del cache.set
+        assert calls and None not in calls
+        cache.save()
+        cache = HashCache(cache_path)
+        assert_equal(cache.get(img_path, "sha512"), control_sum(img_path))
+        # Cached sums are used instead of reading files
+        cache.set(img_path, "sha512", "bogus")
+        diff(patch_file, orig_dir, new_dir, hash_cache=cache)
+        tar = tarfile.open(patch_file, "r:bz2")
+        info = load_patch_info(tar.extractfile("info").read())
+        tar.close()
+        assert_equal(info.control_sums["patches/img.png"][0], "bogus")
+        # Changed files are not found in the cache
+        tmp_file = join(data_dir, "hashed")
+        open(tmp_file, "wb").write("abc")
+        try:
+            cache.set(tmp_file, "sha512", "bogus")
+            open(tmp_file, "ab").write("def")
+            assert_equal(cache.get(tmp_file, "sha512"), None)
+        finally:
+            os.unlink(tmp_file)
+    finally:
+        if os.path.exists(cache_path):
+            os.unlink(cache_path)
+
+
+def test_indexed():
+    for name in codecs:
+        diff(patch_file, orig_dir, new_dir, codec=name, indexed=True)
+        assert is_indexed_archive(patch_file)
+        patch(patch_file, orig_dir, tmp_dir)
+        compare_directories(new_dir, tmp_dir)
+        shutil.rmtree(tmp_dir)
+    archive = IndexedArchive(patch_file)
+    assert_equal(archive.getmember("patches/img.png").name, 
+            "patches/img.png")
+    assert archive.getmember("plain/new_dir").isdir()
+    assert_raises(KeyError, archive.getmember, "plain/nothing")
+    data = archive.extractfile("plain/3.png").read()
+    assert_equal(data, open(join(new_dir, "3.png"), "rb").read())
+
+
 def test_new_files():
     diff(patch_file, orig_dir, new_dir)
     patch(patch_file, orig_with_new_dir, tmp_dir)
@@ -0,0 +1,99 @@
+import os
+import random
+import hashlib
+from os.path import join, exists, abspath
+from nose.tools import assert_equal, assert_raises
+from pyflu.update.download import Downloader, DownloadError
+from pyflu.tests.test_update import data_dir
+from pyflu.tests.test_update.test_remote import start_server
+
+
+dest_path = join(data_dir, "downloaded")
+size = 3 * 2**18 + 123
+data = "".join(chr(random.randint(0, 255)) for i in xrange(size))
+
+
+def make_downloader(segments=4):
+    downloader = Downloader(segments, retries=0)
+    downloader.min_segment_size = 2**16
+    downloader.chunk_size = 2**12
+    return downloader
+
+
+def remove_downloads():
+    for path in (dest_path, dest_path + ".part", dest_path + ".part.json"):
+        if exists(path):
+            os.unlink(path)
+
+
+def test_segments():
+    remove_downloads()
+    del server.ranges[:]
+    progress = []
+    def progress_callback(received, total):
+        progress.append((received, total))
+    make_downloader().download(server.url + "/data", dest_path,
+            progress_callback=progress_callback)
+    assert_equal(open(dest_path, "rb").read(), data)
+    assert_equal(len(server.ranges), 4)
+    assert_equal(progress[-1], (size, size))
+    assert_equal(progress, sorted(progress))
+    assert not exists(dest_path + ".part")
+    assert not exists(dest_path + ".part.json")
+
+
+def test_resume():
+    remove_downloads()
+    # Interrupted downloads
+    server.cut_after = 2**15
+    try:
+        assert_raises(DownloadError, make_downloader().download,
+                server.url + "/data", dest_path)
+    finally:
+        server.cut_after = None
+    assert not exists(dest_path)
+    assert exists(dest_path + ".part")
+    # Resume
+    del server.ranges[:]
+    make_downloader().download(server.url + "/data", dest_path)
+    assert_equal(open(dest_path, "rb").read(), data)
+    assert_equal(len(server.ranges), 4)
+    # Segments were resumed after the data already received
+    starts = sorted(int(h[6:].split("-")[0]) for h in server.ranges)
+    bounds = [size * i / 4 for i in range(4)]
+    assert min(s - b for s, b in zip(starts, bounds)) >= 0
+    assert max(s - b for s, b in zip(starts, bounds)) > 0
+
+
+def test_checks():
+    remove_downloads()
+    digest = hashlib.sha512(data).hexdigest()
+    make_downloader().download(server.url + "/data", dest_path, size,
+            digest="sha512", sum=digest)
+    remove_downloads()
+    assert_raises(DownloadError, make_downloader().download,
+            server.url + "/data", dest_path, size, digest="sha512",
+            sum="00" * 64)
+    assert not exists(dest_path + ".part")
+    assert_raises(DownloadError, make_downloader().download,
+            server.url + "/missing", dest_path)
+
+
+def test_no_ranges():
+    remove_downloads()
+    path = join(data_dir, "patches", "index.html")
+    url = "file://%s" % abspath(path)
+    make_downloader().download(url, dest_path)
+    assert_equal(open(dest_path, "rb").read(), open(path, "rb").read())
+
+
+def setup():
+    global server
+    server = start_server()
+    server.files["/data"] = data
+
+
+def teardown():
+    server.shutdown()
+    server.server_close()
+    remove_downloads()
@@ -0,0 +1,119 @@
+import os
+import shutil
+from os.path import join, isdir, exists
+from nose.tools import assert_equal, assert_raises
+from pyflu.update.engine import UpdateEngine
+from pyflu.update.download import DownloadError
+from pyflu.update.remote import make_manifest
+from pyflu.update import control_sum
+from pyflu.tests.test_update import tmp_dir
+from pyflu.tests.test_update.test_remote import start_server, \
+        patches_dir, patches_pattern
+
+
+work_dir = join(tmp_dir, "test_engine_work_dir")
+target_dir = join(work_dir, "target")
+v1_1_dir = join(patches_dir, "versions", "1.1")
+
+
+def compare_contents(path):
+    """
+    Check that the files of version 1.1 were found in *path* (modes depend
+    on the checkout of the test data, and are not compared).
+    """
+    for name in os.listdir(v1_1_dir):
+        assert_equal(control_sum(join(v1_1_dir, name)),
+                control_sum(join(path, name)))
+
+
+def make_engine(**kwargs):
+    if isdir(work_dir):
+        shutil.rmtree(work_dir)
+    os.makedirs(work_dir)
+    shutil.copytree(join(patches_dir, "versions", "1.0"), target_dir)
+    return UpdateEngine(server.url + "/index.html", "1.0", work_dir,
+            target_dir, patches_pattern, **kwargs)
+
+
+def test_update():
+    events = []
+    engine = make_engine()
+    new_dir = engine.update(events.append)
+    compare_contents(new_dir)
+    names = [e.name for e in events]
+    assert_equal(names[:2], ["checking", "checked"])
+    assert_equal(names.count("download_started"), 3)
+    assert_equal(names.count("download_finished"), 3)
+    assert_equal(names[-1], "finished")
+    assert_equal(events[-1].path, new_dir)
+    progress = [e for e in events if e.name == "download_progress"]
+    assert_equal(progress[-1].received, progress[-1].total)
+    # Patches are applied in a single pass
+    assert_equal([e.stage for e in events if e.name == "patch_started"],
+            ["patch", "plain"])
+    # Patches were removed
+    assert_equal(sorted(os.listdir(work_dir)),
+            sorted(["target", os.path.basename(new_dir)]))
+    # Up to date
+    engine = UpdateEngine(server.url + "/index.html", "1.1", work_dir,
+            target_dir, patches_pattern)
+    assert_equal(engine.update(), None)
+
+
+def test_manifest():
+    engine = make_engine(manifest_url=server.url + "/files/manifest.json")
+    urls = engine.check()
+    assert_equal(len(urls), 3)
+    assert_equal(len(engine.sums), 8)
+    engine.download()
+    # Complete downloads are checked and not fetched again
+    del server.requests[:]
+    engine.download()
+    assert_equal(server.requests, [])
+    compare_contents(engine.apply())
+    # Invalid sums
+    engine = make_engine(manifest_url=server.url + "/files/manifest.json")
+    engine.check()
+    url = engine.chain[0][2]
+    engine.sums[url] = ("sha512", "00" * 64)
+    assert_raises(DownloadError, engine.download)
+    assert not exists(join(work_dir, os.path.basename(url)))
+
+
+def test_start():
+    engine = make_engine()
+    engine.start()
+    events = list(engine.iter_events(timeout=60))
+    assert_equal(events[-1].name, "finished")
+    new_dir = engine.wait()
+    assert_equal(events[-1].path, new_dir)
+    compare_contents(new_dir)
+    # Errors
+    engine = UpdateEngine(server.url + "/missing.html", "1.0", work_dir,
+            target_dir, patches_pattern)
+    engine.start()
+    events = list(engine.iter_events(timeout=60))
+    assert_equal(events[-1].name, "error")
+    assert_raises(IOError, engine.wait)
+    # Update checked beforehand
+    engine = make_engine()
+    engine.check()
+    engine.start(check=False)
+    events = list(engine.iter_events(timeout=60))
+    assert "checking" not in [e.name for e in events]
+    assert_equal(events[-1].name, "finished")
+    compare_contents(engine.wait())
+
+
+def setup():
+    global server
+    server = start_server()
+    server.files["/files/manifest.json"] = make_manifest(
+            join(patches_dir, "files"), patches_pattern).dumps()
+
+
+def teardown():
+    server.shutdown()
+    server.server_close()
+    if isdir(work_dir):
+        shutil.rmtree(work_dir)
@@ -1,13 +1,16 @@
 import os
 import shutil
 import louie
-from os.path import abspath, join, dirname, isdir
+from os.path import join, dirname, isdir
 from mock import Mock
 from PyQt4.QtGui import *
+from PyQt4.QtCore import QTimer
 from PyQt4.QtTest import QTest
 from pyflu.update.qt import UpdateDialogMixin
 from pyflu.qt.util import get_or_create_app
 from pyflu.tests.test_update import data_dir, tmp_dir, one_way_compare
+from pyflu.tests.test_update.test_remote import start_server, \
+        patches_pattern
 from pyflu.update import signals
 
 
@@ -27,10 +30,9 @@ class Ui_UpdateDialog(object):
 
 class UpdateDialog(UpdateDialogMixin, QDialog, Ui_UpdateDialog):
 
-    update_url = "file://%s" % abspath(join(data_dir, "patches", "index.html"))
-    version_pattern = r"(?P<%s>r?[0-9a-zA-Z_.-]+?)"
-    patch_files_pattern = r"^patch-%s-%s\.tar\.bz2" % \
-            (version_pattern % "from", version_pattern % "to")
+    # Set by setup(), once the server is started
+    update_url = None
+    patch_files_pattern = patches_pattern
     current_version = "1.0"
     patch_dl_dir = work_dir
     patch_target_dir = join(work_dir, "target")
@@ -56,14 +58,26 @@ def test_update_dialog():
     dlg._exit.side_effect = lambda code: dlg.close()
     louie.connect(finish_update, signals.update_finished, dlg)
     dlg.start_update(confirm=False)    
+    # The update runs in the background, and finishes from the event loop
+    assert not dlg._exit.called
+    QTimer.singleShot(60000, app.quit)
     app.exec_()
+    dlg._exit.assert_called_once_with(0)
     # We should now be at version 1.1
     v1_1_dir = join(data_dir, "patches", "versions", "1.1")
     one_way_compare(v1_1_dir, target_dir)
 
 
 def setup():
+    global server
     if isdir(work_dir):
         shutil.rmtree(work_dir)
     os.makedirs(work_dir)
+    server = start_server()
+    UpdateDialog.update_url = server.url + "/index.html"
+
+
+def teardown():
+    server.shutdown()
+    server.server_close()
 
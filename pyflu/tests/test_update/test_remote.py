@@ -0,0 +1,238 @@
+import os
+import re
+import hashlib
+import threading
+from os.path import abspath, join, getsize, isfile, exists
+from StringIO import StringIO
+from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
+from SimpleHTTPServer import SimpleHTTPRequestHandler
+from nose.tools import assert_equal, assert_raises
+from pyflu.update.remote import find_patches, find_patches_groups, \
+        fetch_size, fetch_sizes, plan_update, make_manifest, Manifest, \
+        fetch_manifest, find_updates, InvalidManifest
+from pyflu.update.version import Version
+from pyflu.tests.test_update import data_dir
+
+
+patches_dir = join(data_dir, "patches")
+manifest_cache = join(data_dir, "manifest-cache.json")
+index_url = "file://%s" % abspath(join(patches_dir, "index.html"))
+patches_pattern = r"^patch-(?P<from>r?[0-9a-zA-Z_.-]+?)-" \
+        r"(?P<to>r?[0-9a-zA-Z_.-]+?)\.tar\.bz2"
+
+
+def make_patches(*pairs):
+    return [(Version(a), Version(b), "%s-%s" % (a, b)) for a, b in pairs]
+
+
+def test_find_patches():
+    patches = find_patches(index_url, patches_pattern)
+    assert_equal(len(patches), 8)
+    assert_equal(patches[0][:2], (Version("0.1"), Version("0.1_10")))
+    assert patches[0][2].endswith("/files/patch-0.1-0.1_10.tar.bz2")
+    groups = find_patches_groups(index_url, patches_pattern)
+    assert_equal([str(v) for v in groups], ["0.1", "0.5", "1.0", "2.0pre"])
+    assert_equal(len(groups[Version("1.0")]), 3)
+
+
+def test_fetch_sizes():
+    patches = find_patches(index_url, patches_pattern)
+    url = patches[0][2]
+    path = join(patches_dir, "files", "patch-0.1-0.1_10.tar.bz2")
+    assert_equal(fetch_size(url), getsize(path))
+    assert_equal(fetch_size(url + ".missing"), None)
+    assert_equal(fetch_sizes([url, url + ".missing"]), {url: getsize(path)})
+
+
+def test_plan_update():
+    patches = make_patches(("100", "110"), ("110", "120"), ("120", "200"),
+            ("100", "200"), ("200", "210"), ("300", "310"))
+    steps = lambda chain: [p[2] for p in chain]
+    # Without sizes, the shortest chain is chosen
+    assert_equal(steps(plan_update(patches, "100")), ["100-200", "200-210"])
+    assert_equal(steps(plan_update(patches, "110")),
+            ["110-120", "120-200", "200-210"])
+    # Weighted by sizes
+    sizes = {"100-110": 10, "110-120": 10, "120-200": 10, "100-200": 100,
+            "200-210": 10}
+    assert_equal(steps(plan_update(patches, "100", sizes)),
+            ["100-110", "110-120", "120-200", "200-210"])
+    assert_equal(steps(plan_update(patches, "100", sizes,
+        target_version="120")), ["100-110", "110-120"])
+    # Up to date, or no chain to the target
+    assert_equal(plan_update(patches, "210"), [])
+    assert_equal(plan_update(patches, "100", target_version="310"), None)
+    # Full installs
+    full = ("210", "setup-210", 35)
+    assert_equal(plan_update(patches, "100", sizes, full),
+            [(None, Version("210"), "setup-210")])
+    assert_equal(steps(plan_update(patches, "110", sizes, full)),
+            ["110-120", "120-200", "200-210"])
+    assert_equal(steps(plan_update(patches, "110", sizes,
+        ("210", "setup-210", None))), ["110-120", "120-200", "200-210"])
+    assert_equal(plan_update(patches, "100", sizes, ("310", "setup-310",
+        1000)), [(None, Version("310"), "setup-310")])
+    assert_equal(plan_update(patches, "210", sizes, full), [])
+
+
+class UpdateServerHandler(SimpleHTTPRequestHandler):
+    """
+    Serves the test patches directory, and the files stored in the server
+    ``files`` dict. Supports conditional requests with ETags, and Range 
+    requests.
+
+    Responses are cut after ``cut_after`` bytes of data, if it's set on the
+    server.
+    """
+
+    range_pattern = re.compile(r"^bytes=(\d+)-(\d*)$")
+
+    def send_head(self):
+        self.server.requests.append((self.command, self.path))
+        if self.path in self.server.files:
+            data = self.server.files[self.path]
+        else:
+            path = join(patches_dir, *self.path.lstrip("/").split("/"))
+            if not isfile(path):
+                self.send_error(404)
+                return None
+            data = open(path, "rb").read()
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        if self.headers.getheader("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return None
+        match = self.range_pattern.match(self.headers.getheader("Range", ""))
+        if match:
+            self.server.ranges.append(match.group(0))
+            start = int(match.group(1))
+            end = int(match.group(2) or len(data) - 1) + 1
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, 
+                end - 1, len(data)))
+            data = data[start:end]
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        if self.server.cut_after is not None:
+            data = data[:self.server.cut_after]
+        return StringIO(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UpdateServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients closing connections early are expected
+        pass
+
+
+def start_server():
+    """
+    Start an :class:`UpdateServer` in a thread, and returns it.
+    """
+    server = UpdateServer(("127.0.0.1", 0), UpdateServerHandler)
+    server.requests = []
+    server.ranges = []
+    server.files = {}
+    server.cut_after = None
+    server.url = "http://127.0.0.1:%d" % server.server_port
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return server
+
+
+server = None
+
+
+def setup():
+    global server
+    server = start_server()
+    server.files["/files/manifest.json"] = make_manifest(
+            join(patches_dir, "files"), patches_pattern).dumps()
+
+
+def teardown():
+    server.shutdown()
+    server.server_close()
+    if exists(manifest_cache):
+        os.unlink(manifest_cache)
+
+
+def test_manifest():
+    manifest = make_manifest(join(patches_dir, "files"), patches_pattern)
+    assert_equal(len(manifest.patches), 8)
+    path = join(patches_dir, "files", "patch-0.1-0.1_10.tar.bz2")
+    entry = manifest.patches[0]
+    assert_equal((entry["from"], entry["to"], entry["size"]), 
+            ("0.1", "0.1_10", getsize(path)))
+    loaded = Manifest.loads(manifest.dumps(), "http://host/files/index")
+    url = "http://host/files/patch-0.1-0.1_10.tar.bz2"
+    assert_equal(loaded.patches_list()[0], 
+            (Version("0.1"), Version("0.1_10"), url))
+    assert_equal(loaded.sizes()[url], getsize(path))
+    assert_equal(loaded.full_install(), None)
+    # Installer sizes are not mixed with patch sizes
+    loaded.installs.append({"version": "3.0", "url": "setup", "size": 10**9})
+    assert_equal(loaded.sizes()[url], getsize(path))
+    assert "setup" not in loaded.sizes()
+    assert_equal(loaded.full_install(), (Version("3.0"), "setup", 10**9))
+    assert_raises(InvalidManifest, Manifest.loads, "{}")
+    assert_raises(InvalidManifest, Manifest.loads, 
+            '{"format": 1, "patches": [{"from": "a"}]}')
+
+
+def test_fetch_manifest():
+    if exists(manifest_cache):
+        os.unlink(manifest_cache)
+    url = server.url + "/files/manifest.json"
+    del server.requests[:]
+    manifest = fetch_manifest(url, manifest_cache)
+    assert_equal(len(manifest.patches), 8)
+    assert manifest.patches[0]["url"].startswith(server.url + "/files/")
+    # Not modified, the cached copy is used
+    manifest = fetch_manifest(url, manifest_cache)
+    assert_equal(len(manifest.patches), 8)
+    assert_equal(len(server.requests), 2)
+    # Modified
+    old_manifest = server.files["/files/manifest.json"]
+    try:
+        server.files["/files/manifest.json"] = \
+                Manifest(manifest.patches[:2]).dumps()
+        assert_equal(len(fetch_manifest(url, manifest_cache).patches), 2)
+        assert_equal(len(fetch_manifest(url, manifest_cache).patches), 2)
+    finally:
+        server.files["/files/manifest.json"] = old_manifest
+
+
+def test_find_updates():
+    index_url = server.url + "/index.html"
+    # From the manifest
+    del server.requests[:]
+    patches, sizes, full_install, sums = find_updates(index_url, 
+            patches_pattern, server.url + "/files/manifest.json")
+    assert_equal(len(patches), 8)
+    assert_equal(len(sizes), 8)
+    assert_equal(sorted(sums), sorted(sizes))
+    assert_equal(server.requests, [("GET", "/files/manifest.json")])
+    # From the HTML page
+    del server.requests[:]
+    patches, sizes, full_install, sums = find_updates(index_url, 
+            patches_pattern, server.url + "/files/missing.json", 
+            current_version="1.0")
+    assert_equal([str(p[0]) for p in patches], 
+            ["1.0", "1.0.2", "1.0.2_256", "2.0pre"])
+    assert_equal(sorted(sizes), sorted(p[2] for p in patches))
+    assert_equal(server.requests[:2], [("GET", "/files/missing.json"), 
+        ("GET", "/index.html")])
+    assert_equal([r[0] for r in server.requests[2:]], ["HEAD"] * 4)
+    chain = plan_update(patches, "1.0", sizes)
+    assert_equal([str(p[1]) for p in chain], ["1.0.2", "1.0.2_256", "1.1"])
@@ -1,17 +1,51 @@
 import sys
 import os
 import hashlib
-from os.path import join, commonprefix, isfile, isdir, dirname, basename
+from os.path import join, commonprefix, isfile, isdir, dirname
 from pyflu.path import sub_path
+from pyflu.update import chunks, compression, binformat
+from pyflu.update.archive import open_archive, is_indexed_archive
+from pyflu.update.hashcache import HashCache
 import bsdiff
 import tarfile
 import pickle
 import struct
 import shutil
+from binascii import hexlify, unhexlify
+import multiprocessing
+import threading
+import tempfile
+from multiprocessing.pool import ThreadPool
+from itertools import imap
+from optparse import OptionParser
 from StringIO import StringIO
 
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
+
+
+__version__ = "0.7"
 
-__version__ = "0.1"
+# Patch format versions that can be read by this library ("0.2" was never
+# released). Patch info and control data were pickled up to version "0.6".
+compatible_versions = ("0.1", "0.3", "0.4", "0.5", "0.6", __version__)
+
+# Hash algorithms usable for control sums, by name. "blake2b" requires Python
+# 3.6 or the pyblake2 module.
+digest_algorithms = {
+        "sha512": hashlib.sha512,
+        "sha256": hashlib.sha256,
+    }
+if blake2b is not None:
+    digest_algorithms["blake2b"] = blake2b
+
+# Size of the buffers used to read files when computing control sums
+control_sum_buffer_size = 2**20
 
 
 class UpdateError(Exception): pass
@@ -25,32 +59,102 @@ class InvalidFile(UpdateError):
 class InvalidOriginalFile(InvalidFile): pass
 class InvalidResultingFile(InvalidFile): pass
 class IncompatiblePatchFormat(UpdateError): pass
+class UnknownDigest(UpdateError): pass
+
+
+def check_compatible(version, digest):
+    """
+    Raise :class:`IncompatiblePatchFormat` if patches of format ``version``,
+    with control sums computed with ``digest``, can't be read.
+    """
+    if version not in compatible_versions:
+        raise IncompatiblePatchFormat("patch file has version '%s', "
+                "the library can read versions %s" % 
+                (version, ", ".join(compatible_versions)))
+    if digest not in digest_algorithms:
+        raise IncompatiblePatchFormat("patch control sums use the '%s' "
+                "algorithm, which is not available" % digest)
 
 
 class PatchInfo(object):
+    """
+    Information stored in patches along the files diffs.
+
+    Control sums are computed with the ``digest`` algorithm, one of the names
+    in :data:`digest_algorithms`. Files sizes are also stored, and checked
+    before computing control sums.
 
-    def __init__(self):
+    Patch info is stored in the binary format written by :meth:`pack`. 
+    Older versions of the library pickled it, see :func:`load_patch_info`.
+    """
+
+    magic = "PYFLUINF"
+
+    # Flags of files entries in the binary format
+    unchanged_flag = 1
+    blocked_flag = 2
+    sizes_flag = 4
+
+    def __init__(self, digest="sha512"):
+        get_digest(digest)
         self.control_sums = {}
+        self.sizes = {}
+        self.unchanged = set()
+        self.blocked = {}
+        self.recipes = {}
+        self.digest = digest
         self.version = __version__
+        # bsdiff control data is pickled in legacy patches
+        self.packed_ctrl = True
 
     def store_sums(self, path, orig_file, new_file):
         """Store control sums of original and new files"""
-        self.control_sums[path] = (control_sum(orig_file),
-                control_sum(new_file))
+        self.control_sums[path] = (control_sum(orig_file, self.digest),
+                control_sum(new_file, self.digest))
+        self.sizes[path] = (os.path.getsize(orig_file), 
+                os.path.getsize(new_file))
+
+    def new_hash(self):
+        """
+        Returns a new hash object of the patch digest algorithm.
+        """
+        return get_digest(self.digest)()
 
-    def valid_orig(self, path, file):
+    def valid_orig(self, path, file, data=None, digest=None):
         """
         Returns True if ``file`` has the same control sum as the original 
         file stored under ``path`` in this patch info object.
+
+        ``data`` is the content of ``file``, if it was already read, and
+        ``digest`` its control sum, if it was computed while reading it.
         """
-        return self.control_sums[path][0] == control_sum(file)
+        sizes = self.sizes.get(path)
+        if sizes is not None and os.path.getsize(file) != sizes[0]:
+            return False
+        if digest is not None:
+            pass
+        elif data is None:
+            digest = control_sum(file, self.digest)
+        else:
+            hasher = self.new_hash()
+            hasher.update(data)
+            digest = hasher.digest()
+        return self.control_sums[path][0] == digest
 
-    def valid_result(self, path, file):
+    def valid_result(self, path, file, digest=None):
         """
         Returns True if ``file`` has the same control sum as the new 
         file stored under ``path`` in this patch info object.
+
+        ``digest`` is the control sum of ``file``, if it was computed while
+        writing it.
         """
-        return self.control_sums[path][1] == control_sum(file)
+        sizes = self.sizes.get(path)
+        if sizes is not None and os.path.getsize(file) != sizes[1]:
+            return False
+        if digest is None:
+            digest = control_sum(file, self.digest)
+        return self.control_sums[path][1] == digest
 
     def is_ext_file(self, path):
         """
@@ -58,40 +162,281 @@ class PatchInfo(object):
         """
         return path not in self.control_sums
 
+    def is_unchanged(self, path):
+        """
+        Returns True if the file at ``path`` is identical in the original and
+        new versions, and has no patch member.
+        """
+        return path in self.unchanged
+
+    def pack(self):
+        """
+        Returns the patch info in binary format.
+
+        The data starts with :attr:`magic`, the format version and the
+        digest name, followed by the table of files and the table of 
+        recipes.
+        """
+        out = binformat.Writer()
+        out.raw(self.magic)
+        out.string(self.version)
+        out.string(self.digest)
+        paths = sorted(self.control_sums)
+        out.pack("<I", len(paths))
+        for path in paths:
+            flags = 0
+            if path in self.unchanged:
+                flags |= self.unchanged_flag
+            if path in self.blocked:
+                flags |= self.blocked_flag
+            if path in self.sizes:
+                flags |= self.sizes_flag
+            out.string(path)
+            out.pack("<B", flags)
+            out.string(self.control_sums[path][0])
+            out.string(self.control_sums[path][1])
+            if flags & self.sizes_flag:
+                out.pack("<qq", *self.sizes[path])
+            if flags & self.blocked_flag:
+                out.pack("<q", self.blocked[path])
+        paths = sorted(self.recipes)
+        out.pack("<I", len(paths))
+        for path in paths:
+            new_sum, mode, refs = self.recipes[path]
+            out.string(path)
+            out.string(new_sum)
+            out.pack("<II", mode, len(refs))
+            for digest, old_path, offset, length in refs:
+                out.string(unhexlify(digest))
+                if old_path is None:
+                    out.string("")
+                    out.pack("<qq", -1, length)
+                else:
+                    out.string(old_path)
+                    out.pack("<qq", offset, length)
+        return out.getvalue()
+
+    @classmethod
+    def unpack(cls, data):
+        """
+        Returns the patch info stored in ``data`` by :meth:`pack`.
+        """
+        reader = binformat.Reader(data)
+        try:
+            if reader.raw(len(cls.magic)) != cls.magic:
+                raise UpdateError("invalid patch info")
+            version = reader.string()
+            digest = reader.string()
+            check_compatible(version, digest)
+            info = cls(digest)
+            info.version = version
+            for i in xrange(reader.unpack("<I")[0]):
+                path = reader.string()
+                flags = reader.unpack("<B")[0]
+                info.control_sums[path] = (reader.string(), reader.string())
+                if flags & cls.unchanged_flag:
+                    info.unchanged.add(path)
+                if flags & cls.sizes_flag:
+                    info.sizes[path] = reader.unpack("<qq")
+                if flags & cls.blocked_flag:
+                    info.blocked[path] = reader.unpack("<q")[0]
+            for i in xrange(reader.unpack("<I")[0]):
+                path = reader.string()
+                new_sum = reader.string()
+                mode, count = reader.unpack("<II")
+                refs = []
+                for j in xrange(count):
+                    digest = hexlify(reader.string())
+                    old_path = reader.string()
+                    offset, length = reader.unpack("<qq")
+                    if not old_path:
+                        old_path = offset = None
+                    refs.append((digest, old_path, offset, length))
+                info.recipes[path] = (new_sum, mode, refs)
+        except binformat.TruncatedData:
+            raise UpdateError("truncated patch info")
+        return info
+
     def __setstate__(self, state):
         self.__dict__.update(state)
-        if self.version != __version__:
-            raise IncompatiblePatchFormat("patch file has version '%s', "
-                    "the library can read version '%s'" % 
-                    (self.version, __version__))
+        self.__dict__.setdefault("digest", "sha512")
+        check_compatible(self.version, self.digest)
+        self.__dict__.setdefault("unchanged", set())
+        self.__dict__.setdefault("blocked", {})
+        self.__dict__.setdefault("recipes", {})
+        self.__dict__.setdefault("sizes", {})
+        self.__dict__.setdefault("packed_ctrl", False)
+
+
+class LegacyUnpickler(pickle.Unpickler):
+    """
+    Unpickler for the data of patches created by older versions of the 
+    library, only allowing the globals listed in :attr:`allowed_globals`.
+    """
+
+    allowed_globals = frozenset([
+            ("copy_reg", "_reconstructor"),
+            ("__builtin__", "object"),
+            ("__builtin__", "set"),
+            ("pyflu.update", "PatchInfo"),
+        ])
+
+    def find_class(self, module, name):
+        if (module, name) not in self.allowed_globals:
+            raise pickle.UnpicklingError("global '%s.%s' is not allowed in "
+                    "patch data" % (module, name))
+        return pickle.Unpickler.find_class(self, module, name)
+
+
+class LegacyCtrlUnpickler(LegacyUnpickler):
+    """
+    Unpickler for the bsdiff control data of legacy patches, made of lists
+    of tuples of integers only.
+    """
+
+    allowed_globals = frozenset()
+
+
+def load_patch_info(data):
+    """
+    Returns the :class:`PatchInfo` object stored in ``data``, in binary 
+    format or pickled by older versions of the library.
+    """
+    if data.startswith(PatchInfo.magic):
+        return PatchInfo.unpack(data)
+    try:
+        info = LegacyUnpickler(StringIO(data)).load()
+    except (pickle.UnpicklingError, EOFError, ValueError, KeyError,
+            IndexError), err:
+        raise UpdateError("invalid patch info: %s" % err)
+    if not isinstance(info, PatchInfo):
+        raise UpdateError("invalid patch info")
+    return info
 
 
 class PatchFile(object):
     """
-    Utility class to read and write patches in a TarFile object.
+    Utility class to read and write patches in a TarFile object, or an 
+    :class:`~pyflu.update.archive.IndexedArchive`.
 
     Patches are stored in a simple binary format that should be compressed
     efficiently.
+
+    Files larger than ``block_size`` bytes are split in blocks of this size,
+    each block being diffed against the block at the same offset in the
+    original file. Blocks are stored one after the other in the patch member,
+    and are applied one at a time, so memory usage when patching stays
+    around a few times ``block_size``, whatever the size of the files. 
+    Creating patches of blocks requires about ten times ``block_size`` bytes
+    of memory per worker process.
+
+    If a :class:`~pyflu.update.chunks.Chunker` is given in ``chunker``, new
+    files are split in chunks, and chunks already present anywhere in the
+    original tree are not stored in the patch. This catches moved, renamed
+    and copied files, at the cost of reading the whole original tree when
+    creating the patch. New files are then stored as lists of references to
+    chunks in the patch info ("recipes"), and chunks that could not be found
+    are stored once in the ``chunks/`` directory of the archive.
+
+    Control sums of the patches created are computed with the ``digest``
+    algorithm, see :class:`PatchInfo`. When patching, control sums of the
+    resulting files are computed while writing them. Sums are looked up in,
+    and added to, ``hash_cache`` if it's a 
+    :class:`~pyflu.update.hashcache.HashCache`.
     """
     
     patches_prefix = "patches"
     plain_prefix = "plain"
+    chunks_prefix = "chunks"
     info_path = "info"
 
     header_fmt = "<q"
     block_header_fmt = "<q"
     block_data_fmt_pattern = "<%ds"
 
-    def __init__(self, tar):
+    default_block_size = 2**24
+
+    def __init__(self, tar, block_size=None, chunker=None, digest="sha512",
+            hash_cache=None):
         self.tar = tar
+        if block_size is None:
+            block_size = self.default_block_size
+        self.block_size = block_size
+        self.chunker = chunker
+        self.digest = digest
+        self.hash_cache = hash_cache
+        self.lock = None
 
-    def diff(self, old_dir, new_dir):
+    def diff(self, old_dir, new_dir, workers=1):
         """
         Fill the TarFile with the differences between two directories.
+
+        Files diffs are computed in a pool of ``workers`` processes (all the
+        available CPUs if ``workers`` is None). Members are always written in
+        the same order, so the result does not depend on the number of
+        workers.
         """
-        self.info = PatchInfo()
+        self.info = PatchInfo(self.digest)
+        actions = self.diff_actions(old_dir, new_dir)
+        # Blocked diffs are written in this directory, removed at the end
+        # along with the files of results that were not consumed
+        tmp_dir = tempfile.mkdtemp(prefix="pyflu-diff-")
+        jobs = [(self.__class__, a[1], a[2], a[3], self.block_size,
+            self.digest, (self.cached_sum(a[2]), self.cached_sum(a[3])),
+            tmp_dir) for a in actions if a[0] == "diff"]
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if workers > 1 and len(jobs) > 1:
+            pool = multiprocessing.Pool(min(workers, len(jobs)))
+            results = pool.imap(compute_diff, jobs)
+        else:
+            pool = None
+            results = imap(compute_diff, jobs)
+        if self.chunker is not None:
+            self.chunks_index = chunks.index_tree(old_dir, self.chunker)
+            self.stored_chunks = set()
 
         # Write patches and plain files
+        try:
+            for action in actions:
+                if action[0] == "diff":
+                    result = results.next()
+                    self.write_diff(*result[:6])
+                    if self.hash_cache is not None:
+                        # Cache the sums with the files stats taken before
+                        # hashing, so that files modified meanwhile are
+                        # hashed again next time
+                        sums, stats = result[1], result[6]
+                        self.hash_cache.set(action[2], self.digest, sums[0],
+                                stats[0])
+                        self.hash_cache.set(action[3], self.digest, sums[1],
+                                stats[1])
+                elif self.chunker is None:
+                    self.tar.add(action[1], action[2])
+                else:
+                    self.store_chunked(action[1], action[2])
+        finally:
+            if pool is not None:
+                pool.terminate()
+            shutil.rmtree(tmp_dir)
+
+        # Write info file
+        data = self.info.pack()
+        info = tarfile.TarInfo(self.info_path)
+        info.size = len(data)
+        self.tar.addfile(info, StringIO(data))
+
+    def diff_actions(self, old_dir, new_dir):
+        """
+        Returns the list of operations needed to store the differences 
+        between two directories, in the order they must be written to the 
+        TarFile.
+
+        Items are ``("diff", tar_path, old_file, new_file)`` tuples for files
+        present on both sides, and ``("add", path, tar_path)`` tuples for new
+        files and directories.
+        """
+        actions = []
         for base, dirs, files in os.walk(old_dir):
             sub_dir = sub_path(base, old_dir)
             new_sub_dir = join(new_dir, sub_dir)    
@@ -105,43 +450,49 @@ class PatchFile(object):
                 new_file = join(new_sub_dir, file)
                 if isfile(new_file):
                     # File is present on both sides, store binary diff
-                    self.store_diff(self.patch_path(sub_dir, file), 
-                            old_file, new_file)
+                    actions.append(("diff", self.patch_path(sub_dir, file), 
+                            old_file, new_file))
             # Search for new files and directories
             for item in os.listdir(new_sub_dir):
                 item_path = join(new_sub_dir, item)
                 if isfile(item_path):
                     if item not in files:
-                        self.tar.add(item_path, 
-                                self.plain_path(sub_dir, item))
+                        actions.append(("add", item_path,
+                                self.plain_path(sub_dir, item)))
                 elif isdir(item_path):
                     if item not in dirs:
-                        self.tar.add(item_path, 
-                                self.plain_path(sub_dir, item))
-
-        # Write info file
-        data = pickle.dumps(self.info)
-        info = tarfile.TarInfo(self.info_path)
-        info.size = len(data)
-        self.tar.addfile(info, StringIO(data))
+                        actions.append(("add", item_path,
+                                self.plain_path(sub_dir, item)))
+        return actions
 
     def patch(self, old_dir, dest_dir, start_callback=None, 
-            progress_callback=None):
+            progress_callback=None, workers=1, processes=False):
         """
         Apply the patch to the content of ``old_dir`` and write the results in
         ``dest_dir``.
+
+        Files are patched in a pool of ``workers`` threads (all the available
+        CPUs if ``workers`` is None), or in a pool of processes if
+        ``processes`` is True. Callbacks are always called from the calling
+        thread, with increasing indexes, as files are done.
+
+        Pools are not a speedup in general. bsdiff holds the GIL while
+        patching, so threads only overlap reading and control sums, and
+        measured slower than a single worker with indexed archives. Processes
+        run bsdiff in parallel, but each of them opens the archive again,
+        which only pays off with several CPUs and large diffs. Members of
+        compressed tar archives must be read in order, see :func:`patch`.
         """
         # Read info file
-        self.info = pickle.load(self.tar.extractfile(self.info_path))
-
-        # Patch files
-        if start_callback is not None:
-            # Count source files
-            length = 0
-            for base, dirs, files in os.walk(old_dir):
-                length += len(files)
-            start_callback(stage="patch", length=length)  
-        index = 0
+        self.info = load_patch_info(
+                self.tar.extractfile(self.info_path).read())
+        # Load the list of members now, TarFile objects load it lazily
+        plain_files = [m for m in self.tar.getmembers() 
+                if m.name.startswith(self.plain_prefix)
+                and not m.isdir()]
+
+        # List the tasks of each stage, and create the directories
+        patch_tasks = []
         for base, dirs, files in os.walk(old_dir):
             sub_dir = sub_path(base, old_dir)
             dest_sub_dir = join(dest_dir, sub_dir)
@@ -154,37 +505,210 @@ class PatchFile(object):
                 dst_file = join(dest_sub_dir, file)
                 if self.info.is_ext_file(patch_path):
                     # File is not in the patch, copy it to the destination dir
-                    shutil.copy(src_file, dst_file)
+                    patch_tasks.append(("copy", src_file, dst_file))
+                elif self.info.is_unchanged(patch_path):
+                    # File did not change, check and copy it
+                    patch_tasks.append(("check", src_file, dst_file, 
+                        patch_path))
                 else:
-                    self.patch_file(src_file, dst_file, patch_path)
-                if progress_callback is not None:
-                    index += 1
-                    progress_callback(index=index)
-
-        # Extract plain files
-        plain_files = [m for m in self.tar.getmembers() 
-                if m.name.startswith(self.plain_prefix)
-                and not m.isdir()]
-        if start_callback is not None:
-            start_callback(stage="plain", length=len(plain_files))
-        index = 0
+                    patch_tasks.append(("patch", src_file, dst_file, 
+                        patch_path))
+        plain_tasks = []
         for file in plain_files:
             outpath = join(dest_dir, 
                     sub_path(file.name, self.plain_prefix))
-            outdir = dirname(outpath)
+            plain_tasks.append(("extract", file.name, outpath))
+        # Rebuild files made of chunks
+        for tar_path in sorted(self.info.recipes):
+            outpath = join(dest_dir, sub_path(tar_path, self.plain_prefix))
+            plain_tasks.append(("build", old_dir, outpath, tar_path))
+        for task in plain_tasks:
+            outdir = dirname(task[2])
             if not isdir(outdir):
                 os.makedirs(outdir)
-            infile = self.tar.extractfile(file)
-            outfile = open(outpath, "wb")
-            while True:
-                data = infile.read(2**14)
-                if not data:
-                    break
-                outfile.write(data)
-            outfile.close()
-            if progress_callback is not None:
-                index += 1
-                progress_callback(index=index)
+
+        # Run tasks
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        pool = None
+        if workers > 1 and processes:
+            pool = multiprocessing.Pool(workers, init_patch_worker,
+                    (self.__class__, self.archive_name(), self.info))
+            func = run_patch_task
+        elif workers > 1:
+            pool = ThreadPool(workers)
+            func = self.run_task
+            self.lock = threading.Lock()
+        try:
+            for stage, tasks in (("patch", patch_tasks), 
+                    ("plain", plain_tasks)):
+                if start_callback is not None:
+                    start_callback(stage=stage, length=len(tasks))
+                if pool is None:
+                    results = imap(self.run_task, tasks)
+                else:
+                    results = pool.imap_unordered(func, tasks)
+                index = 0
+                for result in results:
+                    if progress_callback is not None:
+                        index += 1
+                        progress_callback(index=index)
+        finally:
+            if pool is not None:
+                pool.terminate()
+            self.lock = None
+
+    def run_task(self, task):
+        """
+        Run a task of :meth:`patch`, a tuple made of the action name and its
+        arguments.
+        """
+        action = task[0]
+        if action == "copy":
+            src_file, dst_file = task[1:]
+            shutil.copy(src_file, dst_file)
+        elif action == "check":
+            self.copy_unchanged(*task[1:])
+        elif action == "patch":
+            self.patch_file(*task[1:])
+        elif action == "extract":
+            self.extract_plain(*task[1:])
+        elif action == "build":
+            old_dir, outpath, tar_path = task[1:]
+            self.build_file(old_dir, outpath, self.info.recipes[tar_path])
+        else:
+            raise ValueError("unknown patch action: %r" % action)
+
+    def copy_unchanged(self, src_file, dst_file, patch_path):
+        """
+        Copy the unchanged file ``src_file`` to ``dst_file``, checking its
+        control sum during the copy.
+        """
+        sizes = self.info.sizes.get(patch_path)
+        if sizes is not None and os.path.getsize(src_file) != sizes[0]:
+            raise InvalidOriginalFile(src_file)
+        hasher = self.info.new_hash()
+        src = open(src_file, "rb")
+        try:
+            dst = open(dst_file, "wb")
+            try:
+                while True:
+                    data = src.read(control_sum_buffer_size)
+                    if not data:
+                        break
+                    hasher.update(data)
+                    dst.write(data)
+            finally:
+                dst.close()
+        finally:
+            src.close()
+        if hasher.digest() != self.info.control_sums[patch_path][0]:
+            os.unlink(dst_file)
+            raise InvalidOriginalFile(src_file)
+        shutil.copymode(src_file, dst_file)
+
+    def extract_plain(self, name, outpath):
+        """
+        Extract the archive member ``name`` to ``outpath``.
+        """
+        infile = self.extractfile(name)
+        outfile = open(outpath, "wb")
+        while True:
+            data = infile.read(2**14)
+            if not data:
+                break
+            outfile.write(data)
+        outfile.close()
+
+    def extractfile(self, member):
+        """
+        Returns a file object reading ``member`` in the archive.
+
+        Members of a TarFile share the same file object, reads are serialized
+        when patching in several threads.
+        """
+        if self.lock is None:
+            return self.tar.extractfile(member)
+        self.lock.acquire()
+        try:
+            return LockedFile(self.tar.extractfile(member), self.lock)
+        finally:
+            self.lock.release()
+
+    def archive_name(self):
+        """
+        Returns the path of the archive file.
+        """
+        name = getattr(self.tar, "path", None) or self.tar.name
+        if name is None:
+            raise UpdateError("can't find the path of the patch archive")
+        return name
+
+    def store_chunked(self, path, tar_path):
+        """
+        Store the new file or directory at ``path`` as a list of chunks.
+        """
+        if isdir(path):
+            self.tar.add(path, tar_path, recursive=False)
+            for item in os.listdir(path):
+                self.store_chunked(join(path, item), 
+                        archive_path(tar_path, "", item))
+            return
+        refs = []
+        fp = open(path, "rb")
+        try:
+            for chunk in self.chunker.iter_chunks(fp):
+                digest = chunks.chunk_digest(chunk)
+                if digest in self.chunks_index:
+                    old_path, offset, length = self.chunks_index[digest]
+                    refs.append((digest, old_path, offset, length))
+                    continue
+                if digest not in self.stored_chunks:
+                    info = tarfile.TarInfo(self.chunk_path(digest))
+                    info.size = len(chunk)
+                    self.tar.addfile(info, StringIO(chunk))
+                    self.stored_chunks.add(digest)
+                refs.append((digest, None, None, len(chunk)))
+        finally:
+            fp.close()
+        self.info.recipes[tar_path] = (self.control_sum(path), 
+                os.stat(path).st_mode, refs)
+
+    def build_file(self, old_dir, dest_path, recipe):
+        """
+        Build the file at ``dest_path`` from ``recipe``, a ``(sum, mode,
+        refs)`` tuple created by :meth:`store_chunked`.
+
+        Chunks referencing the original tree are read from ``old_dir``.
+        """
+        new_sum, mode, refs = recipe
+        hasher = self.info.new_hash()
+        dest = open(dest_path, "wb")
+        try:
+            for digest, old_path, offset, length in refs:
+                if old_path is None:
+                    data = self.extractfile(
+                            self.chunk_path(digest)).read()
+                else:
+                    src_path = join(old_dir, *old_path.split("/"))
+                    try:
+                        src = open(src_path, "rb")
+                        try:
+                            src.seek(offset)
+                            data = src.read(length)
+                        finally:
+                            src.close()
+                    except IOError:
+                        raise InvalidOriginalFile(src_path)
+                    if chunks.chunk_digest(data) != digest:
+                        raise InvalidOriginalFile(src_path)
+                hasher.update(data)
+                dest.write(data)
+        finally:
+            dest.close()
+        os.chmod(dest_path, mode)
+        if hasher.digest() != new_sum:
+            raise InvalidResultingFile(dest_path)
 
     def store_diff(self, tar_path, old_file, new_file):
         """
@@ -196,30 +720,99 @@ class PatchFile(object):
 
         The sums dictionnary is also updated.
         """
-        # Compute files sums
-        self.info.store_sums(tar_path, old_file, new_file)
-        # Compute files diff
+        self.write_diff(*compute_diff((self.__class__, tar_path, old_file,
+            new_file, self.block_size, self.digest, 
+            (self.cached_sum(old_file), self.cached_sum(new_file)),
+            None))[:6])
+
+    @classmethod
+    def diff_data(cls, old_file, new_file):
+        """
+        Returns the patch data transforming ``old_file`` into ``new_file``.
+        """
         old_content = open(old_file, "rb").read()
         new_content = open(new_file, "rb").read()
+        return cls.diff_segment(old_content, new_content)
+
+    @classmethod
+    def blocked_diff_data(cls, old_file, new_file, block_size, tmp_dir=None):
+        """
+        Compute the patch data transforming ``old_file`` into ``new_file``
+        block by block.
+
+        The data is written to a temporary file, in ``tmp_dir`` if it's not
+        None, returns a :class:`TemporaryData` object.
+        """
+        fd, path = tempfile.mkstemp(prefix="pyflu-patch-", dir=tmp_dir)
+        out = os.fdopen(fd, "wb")
+        old = open(old_file, "rb")
+        new = open(new_file, "rb")
+        try:
+            while True:
+                new_block = new.read(block_size)
+                if not new_block:
+                    break
+                out.write(cls.diff_segment(old.read(block_size), new_block))
+        except:
+            out.close()
+            os.unlink(path)
+            raise
+        finally:
+            old.close()
+            new.close()
+        out.close()
+        return TemporaryData(path)
+
+    @classmethod
+    def diff_segment(cls, old_content, new_content):
+        """
+        Returns the patch data transforming the string ``old_content`` into
+        ``new_content``.
+        """
         ctrl, diff_block, extra_block = bsdiff.Diff(old_content, new_content)
-        ctrl_block = pickle.dumps(ctrl)
+        ctrl_block = binformat.pack_ctrl(ctrl)
         # Prepare struct format
-        fmt = self.header_fmt
-        fmt += self.block_fmt(ctrl_block)
-        fmt += self.block_fmt(diff_block)
-        fmt += self.block_fmt(extra_block)
-        # Pack data and write it to the TarFile
-        data = struct.pack(fmt, 
+        fmt = cls.header_fmt
+        fmt += cls.block_fmt(ctrl_block)
+        fmt += cls.block_fmt(diff_block)
+        fmt += cls.block_fmt(extra_block)
+        # Pack data
+        return struct.pack(fmt, 
                 len(new_content), 
                 len(ctrl_block), ctrl_block,
                 len(diff_block), diff_block, 
                 len(extra_block), extra_block)
+
+    def write_diff(self, tar_path, sums, data, statinfo, block_size=None,
+            sizes=None):
+        """
+        Write the results of :func:`compute_diff` to the TarFile.
+
+        Unchanged files (with ``data`` set to None) are only recorded in the
+        patch info.
+        """
+        self.info.control_sums[tar_path] = sums
+        if sizes is not None:
+            self.info.sizes[tar_path] = sizes
+        if data is None:
+            self.info.unchanged.add(tar_path)
+            return
+        if block_size is not None:
+            self.info.blocked[tar_path] = block_size
         info = tarfile.TarInfo(tar_path)
-        statinfo = os.stat(new_file)
-        info.size = len(data)
         info.mode = statinfo.st_mode
         info.mtime = statinfo.st_mtime
-        self.tar.addfile(info, StringIO(data))
+        if isinstance(data, TemporaryData):
+            info.size = os.path.getsize(data.path)
+            fp = open(data.path, "rb")
+            try:
+                self.tar.addfile(info, fp)
+            finally:
+                fp.close()
+                data.remove()
+        else:
+            info.size = len(data)
+            self.tar.addfile(info, StringIO(data))
 
     def patch_file(self, orig_path, dest_path, patch_path):
         """
@@ -228,39 +821,85 @@ class PatchFile(object):
         Patches the file at ``orig_path`` into ``dest_path`` with patch info
         stored in the TarFile at ``patch_path``.
         """
-        # First check file to be patched
-        if not self.info.valid_orig(patch_path, orig_path):
-            raise InvalidOriginalFile(orig_path)
-        # Open files
-        orig = open(orig_path, "rb")
-        dest = open(dest_path, "wb")
         patch_info = self.tar.getmember(patch_path)        
-        patch_data = self.tar.extractfile(patch_info).read()
-        offset = 0
-        # Parse patch header
-        new_content_len = struct.unpack_from(self.header_fmt, patch_data)[0]
-        offset += struct.calcsize(self.header_fmt)
-        # Get data blocks
-        offset, ctrl_block = self.read_block(patch_data, offset)
-        ctrl = pickle.loads(ctrl_block)
-        offset, diff_block = self.read_block(patch_data, offset)
-        offset, extra_block = self.read_block(patch_data, offset)
-        # Construct new file
-        dest.write(bsdiff.Patch(orig.read(), new_content_len, 
-                ctrl, diff_block, extra_block))
-        # Close files
-        dest.close()
-        orig.close()
+        block_size = self.info.blocked.get(patch_path)
+        hasher = self.info.new_hash()
+        if block_size is None:
+            # First check file to be patched, it is read in memory anyway
+            orig = open(orig_path, "rb")
+            orig_content = orig.read()
+            orig.close()
+            if not self.info.valid_orig(patch_path, orig_path, orig_content):
+                raise InvalidOriginalFile(orig_path)
+            patch_data = self.extractfile(patch_info).read()
+            offset = 0
+            # Parse patch header
+            new_content_len = struct.unpack_from(self.header_fmt, 
+                    patch_data)[0]
+            offset += struct.calcsize(self.header_fmt)
+            # Get data blocks
+            offset, ctrl_block = self.read_block(patch_data, offset)
+            ctrl = self.load_ctrl(ctrl_block)
+            offset, diff_block = self.read_block(patch_data, offset)
+            offset, extra_block = self.read_block(patch_data, offset)
+            # Construct new file
+            new_content = bsdiff.Patch(orig_content, new_content_len, 
+                    ctrl, diff_block, extra_block)
+            hasher.update(new_content)
+            dest = open(dest_path, "wb")
+            dest.write(new_content)
+            dest.close()
+        else:
+            # Patch blocks one at a time. The file to be patched is only read
+            # once, its control sum is computed along the way and checked at
+            # the end.
+            sizes = self.info.sizes.get(patch_path)
+            if sizes is not None and os.path.getsize(orig_path) != sizes[0]:
+                raise InvalidOriginalFile(orig_path)
+            orig_hasher = self.info.new_hash()
+            orig = open(orig_path, "rb")
+            try:
+                dest = open(dest_path, "wb")
+                try:
+                    patch_fp = self.extractfile(patch_info)
+                    while True:
+                        segment = self.read_segment(patch_fp)
+                        if segment is None:
+                            break
+                        new_content_len, ctrl, diff_block, extra_block = \
+                                segment
+                        orig_block = orig.read(block_size)
+                        orig_hasher.update(orig_block)
+                        new_block = bsdiff.Patch(orig_block, new_content_len,
+                                ctrl, diff_block, extra_block)
+                        hasher.update(new_block)
+                        dest.write(new_block)
+                    # The new file may be shorter than the original
+                    while True:
+                        data = orig.read(control_sum_buffer_size)
+                        if not data:
+                            break
+                        orig_hasher.update(data)
+                finally:
+                    dest.close()
+            finally:
+                orig.close()
+            if not self.info.valid_orig(patch_path, orig_path,
+                    digest=orig_hasher.digest()):
+                os.unlink(dest_path)
+                raise InvalidOriginalFile(orig_path)
         # Restore file's mode
         os.chmod(dest_path, patch_info.mode)
         # Check resulting file validity
-        if not self.info.valid_result(patch_path, dest_path):
+        if not self.info.valid_result(patch_path, dest_path, 
+                hasher.digest()):
             raise InvalidResultingFile(dest_path)
 
-    def block_fmt(self, data):
+    @classmethod
+    def block_fmt(cls, data):
         """Returns the struct format string for a data block"""
-        fmt = self.block_header_fmt
-        fmt += (self.block_data_fmt_pattern % len(data))[1:]
+        fmt = cls.block_header_fmt
+        fmt += (cls.block_data_fmt_pattern % len(data))[1:]
         return fmt[1:]
 
     def read_block(self, data, offset):
@@ -272,28 +911,203 @@ class PatchFile(object):
         offset += struct.calcsize(data_fmt)
         return offset, data
 
+    def read_segment(self, fp):
+        """
+        Read the patch of a block from file object ``fp``.
+
+        Returns a ``(new_content_len, ctrl, diff_block, extra_block)`` tuple,
+        or None at the end of the file.
+        """
+        header_size = struct.calcsize(self.header_fmt)
+        header = fp.read(header_size)
+        if not header:
+            return None
+        if len(header) != header_size:
+            raise UpdateError("truncated patch data")
+        new_content_len = struct.unpack(self.header_fmt, header)[0]
+        ctrl = self.load_ctrl(self.read_stream_block(fp))
+        diff_block = self.read_stream_block(fp)
+        extra_block = self.read_stream_block(fp)
+        return new_content_len, ctrl, diff_block, extra_block
+
+    def load_ctrl(self, data):
+        """
+        Returns the bsdiff control triples stored in ``data``.
+        """
+        if not self.info.packed_ctrl:
+            try:
+                return LegacyCtrlUnpickler(StringIO(data)).load()
+            except (pickle.UnpicklingError, EOFError, ValueError, KeyError,
+                    IndexError), err:
+                raise UpdateError("invalid control data: %s" % err)
+        try:
+            return binformat.unpack_ctrl(data)
+        except binformat.TruncatedData:
+            raise UpdateError("truncated patch data")
+
+    def read_stream_block(self, fp):
+        """Read a data block from file object ``fp``"""
+        header_size = struct.calcsize(self.block_header_fmt)
+        header = fp.read(header_size)
+        if len(header) != header_size:
+            raise UpdateError("truncated patch data")
+        data_len = struct.unpack(self.block_header_fmt, header)[0]
+        data = fp.read(data_len)
+        if len(data) != data_len:
+            raise UpdateError("truncated patch data")
+        return data
+
     # Utilities 
 
+    def control_sum(self, path):
+        """
+        Returns the control sum of the file at ``path``, using the hash cache
+        if there is one.
+        """
+        if self.hash_cache is None:
+            return control_sum(path, self.digest)
+        return self.hash_cache.control_sum(path, self.digest)
+
+    def cached_sum(self, path):
+        """
+        Returns the control sum of the file at ``path`` found in the hash
+        cache, or None.
+        """
+        if self.hash_cache is None:
+            return None
+        return self.hash_cache.get(path, self.digest)
+
     def patch_path(self, path, file):
         return archive_path(self.patches_prefix, path, file)
 
     def plain_path(self, path, file):
         return archive_path(self.plain_prefix, path, file)
 
+    def chunk_path(self, digest):
+        return archive_path(self.chunks_prefix, "", digest)
+
+
+class TemporaryData(object):
+    """
+    Patch data stored in the temporary file at ``path``.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def remove(self):
+        os.unlink(self.path)
+
+
+class LockedFile(object):
+    """
+    Read-only file object wrapping ``fp``, holding ``lock`` during reads.
+    """
+
+    def __init__(self, fp, lock):
+        self.fp = fp
+        self.lock = lock
+
+    def read(self, *args):
+        self.lock.acquire()
+        try:
+            return self.fp.read(*args)
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.fp.close()
+
+
+def compute_diff(job):
+    """
+    Compute the diff of two files, for :meth:`PatchFile.diff`.
+
+    ``job`` is a ``(patch_class, tar_path, old_file, new_file, block_size,
+    digest, cached_sums, tmp_dir)`` tuple, ``cached_sums`` holding the
+    control sums of the files already known, or None, and ``tmp_dir`` the
+    directory of temporary files (None for the default). Returns a
+    ``(tar_path, sums, data, statinfo, block_size, sizes, stats)`` tuple,
+    whose first six items are the arguments of :meth:`PatchFile.write_diff`.
+    ``data`` is None if the files have the same size, mode and contents, and
+    ``block_size`` is None if the files were not split in blocks. ``stats``
+    holds the results of :func:`os.stat` on the files, taken before
+    computing their sums. This is a module level function so it can be
+    called in worker processes.
+    """
+    patch_class, tar_path, old_file, new_file, block_size, digest, \
+            cached_sums, tmp_dir = job
+    old_stat = os.stat(old_file)
+    new_stat = os.stat(new_file)
+    sums = (cached_sums[0] or control_sum(old_file, digest), 
+            cached_sums[1] or control_sum(new_file, digest))
+    sizes = (old_stat.st_size, new_stat.st_size)
+    stats = (old_stat, new_stat)
+    if old_stat.st_size == new_stat.st_size \
+            and old_stat.st_mode == new_stat.st_mode and sums[0] == sums[1]:
+        return tar_path, sums, None, new_stat, None, sizes, stats
+    if max(old_stat.st_size, new_stat.st_size) > block_size:
+        data = patch_class.blocked_diff_data(old_file, new_file, block_size,
+                tmp_dir)
+        return tar_path, sums, data, new_stat, block_size, sizes, stats
+    data = patch_class.diff_data(old_file, new_file)
+    return tar_path, sums, data, new_stat, None, sizes, stats
+
 
-def diff(patch_file, old_dir, new_dir):
+# PatchFile of patch worker processes, see init_patch_worker()
+worker_patch = None
+
+
+def init_patch_worker(patch_class, path, info):
+    """
+    Initialize a worker process of :meth:`PatchFile.patch`, opening the
+    archive at ``path`` with ``info`` as patch info.
+    """
+    global worker_patch
+    worker_patch = patch_class(open_archive(path, "r"))
+    worker_patch.info = info
+
+
+def run_patch_task(task):
+    """
+    Run a task of :meth:`PatchFile.patch` in a worker process.
+    """
+    worker_patch.run_task(task)
+
+
+def diff(patch_file, old_dir, new_dir, workers=1, block_size=None,
+        dedup=False, codec="bz2", indexed=False, digest="sha512",
+        hash_cache=None):
     """
     Create a patch file storing the differences between ``old_dir`` and
     ``new_dir``.
+
+    ``workers`` is the number of processes used to compute files diffs, see
+    :meth:`PatchFile.diff`. ``block_size`` controls the memory used to patch
+    large files, and ``dedup`` enables the deduplication of new files
+    against the original tree, see :class:`PatchFile`. ``codec`` is the name
+    of the compression codec of the archive, see 
+    :mod:`pyflu.update.compression`. If ``indexed`` is True, the patch is
+    stored in an indexed archive instead of a tar file, see
+    :mod:`pyflu.update.archive`. ``digest`` is the name of the algorithm
+    used to compute files control sums, see :data:`digest_algorithms`.
+    Control sums are cached in ``hash_cache``, a
+    :class:`~pyflu.update.hashcache.HashCache`, if it's given; it must be
+    saved by the caller.
     """
-    tar = tarfile.open(patch_file, "w:bz2")
-    patch = PatchFile(tar)
-    patch.diff(old_dir, new_dir)
+    get_digest(digest)
+    if dedup:
+        chunker = chunks.Chunker()
+    else:
+        chunker = None
+    tar = open_archive(patch_file, "w", codec, indexed)
+    patch = PatchFile(tar, block_size, chunker, digest, hash_cache)
+    patch.diff(old_dir, new_dir, workers)
     tar.close()
 
 
 def patch(patch_file, old_dir, dest_dir, start_callback=None,
-        progress_callback=None):
+        progress_callback=None, workers=1, processes=False):
     """
     Patch ``old_dir`` with ``patch_file`` into ``dest_dir``.
 
@@ -309,11 +1123,36 @@ def patch(patch_file, old_dir, dest_dir, start_callback=None,
     ``progress_callback`` is a callable taking a single keyword argument,
     ``index`` wich indicates the progression of each stage (takes values
     between 1 and ``length``).    
+
+    The type and compression codec of ``patch_file`` are detected
+    automatically.
+
+    Files are patched in parallel if ``workers`` is greater than 1, in 
+    threads or in processes if ``processes`` is True, see 
+    :meth:`PatchFile.patch`. Tar archives are then decompressed to a
+    temporary file first; with compressed tar archives, most of the time
+    saved compared to a single worker comes from this decompression, not
+    from running in parallel.
     """
-    tar = tarfile.open(patch_file, "r:bz2")
-    patch = PatchFile(tar)
-    patch.patch(old_dir, dest_dir, start_callback, progress_callback)
-    tar.close()
+    tmp_path = None
+    if workers != 1 and not is_indexed_archive(patch_file):
+        # Members of compressed tar streams can't be read out of order
+        # efficiently, work on a decompressed copy
+        fd, tmp_path = tempfile.mkstemp(prefix="pyflu-patch-", suffix=".tar")
+        os.close(fd)
+        compression.decompress(patch_file, tmp_path)
+        patch_file = tmp_path
+    try:
+        tar = open_archive(patch_file, "r")
+        try:
+            patch = PatchFile(tar)
+            patch.patch(old_dir, dest_dir, start_callback, 
+                    progress_callback, workers, processes)
+        finally:
+            tar.close()
+    finally:
+        if tmp_path is not None:
+            os.unlink(tmp_path)
 
 
 def archive_path(prefix, path, file):
@@ -325,17 +1164,33 @@ def archive_path(prefix, path, file):
     return ret.replace("\\", "/").replace("//", "/")
 
 
-def control_sum(fpath):
-    """Returns the control sum of the file at ``fpath``"""
+def get_digest(name):
+    """
+    Returns the constructor of hash objects of the digest algorithm ``name``.
+    """
+    try:
+        return digest_algorithms[name]
+    except KeyError:
+        raise UnknownDigest("unknown or unavailable digest algorithm '%s'" %
+                name)
+
+
+def control_sum(fpath, digest="sha512"):
+    """
+    Returns the control sum of the file at ``fpath``, computed with the
+    ``digest`` algorithm.
+    """
+    hasher = get_digest(digest)()
     f = open(fpath, "rb")
-    digest = hashlib.sha512()
-    while True:
-        buf = f.read(4096)
-        if not buf:
-            break
-        digest.update(buf)
-    f.close()
-    return digest.digest()
+    try:
+        while True:
+            buf = f.read(control_sum_buffer_size)
+            if not buf:
+                break
+            hasher.update(buf)
+    finally:
+        f.close()
+    return hasher.digest()
 
 
 def usage():
@@ -346,11 +1201,42 @@ def makepatch():
     """
     Entry points for the create patch command line script.
     """
+    parser = OptionParser(usage="%prog [options] olddir newdir patchfile")
+    parser.add_option("-j", "--jobs", type="int", default=1,
+            help="number of processes used to compute diffs, 0 to use all "
+            "the available CPUs [default: %default]")
+    parser.add_option("-b", "--block-size", type="int",
+            help="split files larger than this size in megabytes in blocks "
+            "diffed independently, to bound the memory used when applying "
+            "the patch [default: %d]" % (PatchFile.default_block_size / 2**20))
+    parser.add_option("-d", "--dedup", action="store_true", default=False,
+            help="store the data of new files found in the original tree "
+            "(moved or copied files) as references")
+    parser.add_option("-c", "--codec", default="bz2",
+            help="compression codec of the patch archive, one of: %s "
+            "[default: %%default]" % ", ".join(sorted(compression.codecs)))
+    parser.add_option("-i", "--indexed", action="store_true", default=False,
+            help="create an indexed archive, whose members can be accessed "
+            "directly, instead of a tar file")
+    parser.add_option("-s", "--digest", default="sha512",
+            help="algorithm of files control sums, one of: %s "
+            "[default: %%default]" % ", ".join(sorted(digest_algorithms)))
+    parser.add_option("-H", "--hash-cache", metavar="FILE",
+            help="cache files control sums in FILE, to avoid computing them "
+            "again when creating successive patches")
+    options, args = parser.parse_args()
     try:
-        olddir, newdir, patchfile = sys.argv[1:]
-    except:
-        print >>sys.stderr, ("usage: %s olddir newdir patchfile" 
-                % basename(sys.argv[0]))
+        olddir, newdir, patchfile = args
+    except ValueError:
+        parser.print_usage(sys.stderr)
         sys.exit(1)
-    diff(patchfile, olddir, newdir)
+    if options.hash_cache:
+        hash_cache = HashCache(options.hash_cache)
+    else:
+        hash_cache = None
+    diff(patchfile, olddir, newdir, options.jobs or None, 
+            options.block_size and options.block_size * 2**20, options.dedup,
+            options.codec, options.indexed, options.digest, hash_cache)
+    if hash_cache is not None:
+        hash_cache.save()
     sys.exit(0)
@@ -0,0 +1,293 @@
+"""
+Indexed patch archives.
+
+An indexed archive stores each member compressed independently, followed by
+an index mapping members names to their offset, length and codec. Members
+can then be read directly, without decompressing the data preceding them as
+in a compressed tar stream.
+
+:class:`IndexedArchive` implements the subset of the TarFile interface used
+by :class:`pyflu.update.PatchFile`, and :func:`open_archive` opens either
+kind of archive.
+"""
+import os
+import struct
+import tarfile
+try:
+    import json
+except ImportError:
+    import simplejson as json
+from pyflu.update.compression import get_codec, open_tar
+
+
+class InvalidArchive(Exception): pass
+
+
+def archive_name(name):
+    """Normalize the member name ``name``"""
+    if isinstance(name, unicode):
+        name = name.encode("utf-8")
+    return name.replace("\\", "/").replace("//", "/").rstrip("/")
+
+
+class IndexedArchive(object):
+    """
+    An indexed archive at ``path``, opened for reading ("r" ``mode``) or
+    writing ("w" ``mode``).
+
+    Members written in the archive are compressed with ``codec`` (a codec
+    name from :mod:`pyflu.update.compression`).
+
+    Files start with the :attr:`magic` string, followed by the members data,
+    the JSON encoded index, and a trailer holding the offset and length of
+    the index followed by :attr:`magic` again. Names are stored in the index
+    decoded as latin-1, so that any byte string can be stored.
+    """
+
+    magic = "PYFLUIDX"
+    trailer_fmt = "<qq8s"
+    chunk_size = 2**16
+
+    def __init__(self, path, mode="r", codec="bz2"):
+        self.path = path
+        self.mode = mode
+        self.codec = codec
+        self.entries = {}
+        self.names = []
+        if mode == "w":
+            self.fp = open(path, "wb")
+            self.fp.write(self.magic)
+        elif mode == "r":
+            self.fp = None
+            self.read_index()
+        else:
+            raise ValueError("invalid mode: %r" % mode)
+
+    def read_index(self):
+        fp = open(self.path, "rb")
+        try:
+            if fp.read(len(self.magic)) != self.magic:
+                raise InvalidArchive("%s is not an indexed archive" %
+                        self.path)
+            trailer_size = struct.calcsize(self.trailer_fmt)
+            fp.seek(-trailer_size, os.SEEK_END)
+            offset, length, magic = struct.unpack(self.trailer_fmt,
+                    fp.read(trailer_size))
+            if magic != self.magic:
+                raise InvalidArchive("truncated archive: %s" % self.path)
+            fp.seek(offset)
+            index = json.loads(fp.read(length))
+        finally:
+            fp.close()
+        for entry in index:
+            name = entry["name"] = entry["name"].encode("latin-1")
+            self.entries[name] = entry
+            self.names.append(name)
+
+    # Reading
+
+    def getmember(self, name):
+        """
+        Returns a TarInfo object describing the member ``name``.
+        """
+        try:
+            entry = self.entries[archive_name(name)]
+        except KeyError:
+            raise KeyError("filename %r not found" % name)
+        return self.tarinfo(entry)
+
+    def getmembers(self):
+        return [self.tarinfo(self.entries[name]) for name in self.names]
+
+    def getnames(self):
+        return list(self.names)
+
+    def tarinfo(self, entry):
+        info = tarfile.TarInfo(entry["name"])
+        info.size = entry["size"]
+        info.mode = entry["mode"]
+        info.mtime = entry["mtime"]
+        if entry["dir"]:
+            info.type = tarfile.DIRTYPE
+        return info
+
+    def extractfile(self, member):
+        """
+        Returns a file object to read the contents of ``member`` (a name or
+        a TarInfo object), or None for directories.
+
+        Each call opens a new file handle, so members can be read
+        concurrently.
+        """
+        if isinstance(member, tarfile.TarInfo):
+            member = member.name
+        try:
+            entry = self.entries[archive_name(member)]
+        except KeyError:
+            raise KeyError("filename %r not found" % member)
+        if entry["dir"]:
+            return None
+        return MemberFile(self.path, entry["offset"], entry["length"],
+                get_codec(entry["codec"]).decompressor(), self.chunk_size)
+
+    # Writing
+
+    def addfile(self, tarinfo, fileobj=None):
+        """
+        Add the member described by ``tarinfo``, reading ``tarinfo.size``
+        bytes from ``fileobj`` for regular files.
+        """
+        name = archive_name(tarinfo.name)
+        offset = self.fp.tell()
+        if tarinfo.isreg():
+            compressor = get_codec(self.codec).compressor()
+            remaining = tarinfo.size
+            while remaining:
+                data = fileobj.read(min(self.chunk_size, remaining))
+                if not data:
+                    raise IOError("unexpected end of data")
+                remaining -= len(data)
+                self.fp.write(compressor.compress(data))
+            self.fp.write(compressor.flush())
+        self.entries[name] = {
+                "name": name,
+                "offset": offset,
+                "length": self.fp.tell() - offset,
+                "size": tarinfo.size,
+                "codec": self.codec,
+                "mode": tarinfo.mode,
+                "mtime": tarinfo.mtime,
+                "dir": tarinfo.isdir(),
+            }
+        if name not in self.names:
+            self.names.append(name)
+
+    def add(self, name, arcname=None, recursive=True):
+        """
+        Add the file or directory at ``name`` under the name ``arcname``.
+        """
+        if arcname is None:
+            arcname = name
+        statinfo = os.stat(name)
+        info = tarfile.TarInfo(arcname)
+        info.mode = statinfo.st_mode & 07777
+        info.mtime = statinfo.st_mtime
+        if os.path.isdir(name):
+            info.type = tarfile.DIRTYPE
+            self.addfile(info)
+            if recursive:
+                for item in os.listdir(name):
+                    self.add(os.path.join(name, item),
+                            os.path.join(arcname, item), recursive)
+        else:
+            info.size = statinfo.st_size
+            fp = open(name, "rb")
+            try:
+                self.addfile(info, fp)
+            finally:
+                fp.close()
+
+    def close(self):
+        """
+        Write the index, if the archive was opened for writing.
+        """
+        if self.fp is None:
+            return
+        entries = []
+        for name in self.names:
+            entry = dict(self.entries[name])
+            entry["name"] = name.decode("latin-1")
+            entries.append(entry)
+        index = json.dumps(entries)
+        offset = self.fp.tell()
+        self.fp.write(index)
+        self.fp.write(struct.pack(self.trailer_fmt, offset, len(index),
+                self.magic))
+        self.fp.close()
+        self.fp = None
+
+
+class MemberFile(object):
+    """
+    Read-only file object decompressing the ``length`` bytes found at
+    ``offset`` in the file at ``path`` with ``decompressor``.
+    """
+
+    def __init__(self, path, offset, length, decompressor,
+            chunk_size=2**16):
+        self.fp = open(path, "rb")
+        self.fp.seek(offset)
+        self.remaining = length
+        self.decompressor = decompressor
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+
+    def fill(self):
+        """
+        Decompress more data in the buffer, dropping the data already read.
+
+        Returns False at the end of the member.
+        """
+        if not self.remaining:
+            return False
+        data = self.fp.read(min(self.chunk_size, self.remaining))
+        if not data:
+            raise IOError("unexpected end of archive")
+        self.remaining -= len(data)
+        data = self.decompressor.decompress(data)
+        if not self.remaining and hasattr(self.decompressor, "flush"):
+            data += self.decompressor.flush() or ""
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) - self.pos < size:
+            if not self.fill():
+                break
+        if size < 0:
+            end = len(self.buffer)
+        else:
+            end = min(self.pos + size, len(self.buffer))
+        ret = self.buffer[self.pos:end]
+        self.pos = end
+        return ret
+
+    def readline(self):
+        while True:
+            end = self.buffer.find("\n", self.pos)
+            if end >= 0:
+                return self.read(end + 1 - self.pos)
+            if not self.fill():
+                return self.read()
+
+    def close(self):
+        self.fp.close()
+
+
+def is_indexed_archive(path):
+    """Returns True if the file at ``path`` is an indexed archive"""
+    fp = open(path, "rb")
+    try:
+        return fp.read(len(IndexedArchive.magic)) == IndexedArchive.magic
+    finally:
+        fp.close()
+
+
+def open_archive(path, mode="r", codec=None, indexed=False):
+    """
+    Open a patch archive at ``path``, for reading ("r" ``mode``) or writing
+    ("w" ``mode``).
+
+    When writing, an :class:`IndexedArchive` is created if ``indexed`` is
+    True, otherwise a tar archive; ``codec`` defaults to "bz2". When reading,
+    the archive type and codec are detected automatically.
+    """
+    if mode == "r":
+        if is_indexed_archive(path):
+            return IndexedArchive(path, "r")
+        return open_tar(path, "r", codec)
+    if indexed:
+        return IndexedArchive(path, "w", codec or "bz2")
+    return open_tar(path, "w", codec)
@@ -0,0 +1,85 @@
+"""
+Helpers for the binary formats of patch data.
+
+Integers are stored little-endian, and strings are prefixed by their length
+as a 32 bits unsigned integer.
+"""
+import struct
+from itertools import chain
+
+
+class TruncatedData(ValueError): pass
+
+
+class Writer(object):
+    """
+    Builds binary data.
+    """
+
+    def __init__(self):
+        self.parts = []
+
+    def raw(self, data):
+        self.parts.append(data)
+
+    def pack(self, fmt, *values):
+        self.parts.append(struct.pack(fmt, *values))
+
+    def string(self, data):
+        self.parts.append(struct.pack("<I", len(data)))
+        self.parts.append(data)
+
+    def getvalue(self):
+        return "".join(self.parts)
+
+
+class Reader(object):
+    """
+    Reads the binary data ``data``, starting at ``offset``.
+
+    Methods raise :class:`TruncatedData` if there is not enough data left.
+    """
+
+    def __init__(self, data, offset=0):
+        self.data = data
+        self.offset = offset
+
+    def raw(self, size):
+        end = self.offset + size
+        if end > len(self.data):
+            raise TruncatedData("expected %d bytes at offset %d" %
+                    (size, self.offset))
+        ret = self.data[self.offset:end]
+        self.offset = end
+        return ret
+
+    def unpack(self, fmt):
+        size = struct.calcsize(fmt)
+        if self.offset + size > len(self.data):
+            raise TruncatedData("expected %d bytes at offset %d" %
+                    (size, self.offset))
+        values = struct.unpack_from(fmt, self.data, self.offset)
+        self.offset += size
+        return values
+
+    def string(self):
+        return self.raw(self.unpack("<I")[0])
+
+
+def pack_ctrl(ctrl):
+    """
+    Pack the list of bsdiff control triples ``ctrl`` as an array of 64 bits
+    integers.
+    """
+    return struct.pack("<%dq" % (3 * len(ctrl)), *chain(*ctrl))
+
+
+def unpack_ctrl(data):
+    """
+    Unpack control triples packed with :func:`pack_ctrl`, returns a list of
+    tuples.
+    """
+    if len(data) % 24:
+        raise TruncatedData("control data length is not a multiple of 24")
+    values = iter(struct.unpack("<%dq" % (len(data) / 8), data))
+    return zip(values, values, values)
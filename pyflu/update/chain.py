@@ -0,0 +1,376 @@
+"""
+Application of chains of patches in a single pass.
+
+:func:`patch_chain` composes the patch info of several patches, so that each
+file of the result is written once: files no patch touches are copied once,
+and files changed by several patches go through all their diffs in memory::
+
+    from pyflu.update.chain import patch_chain
+
+    patch_chain(["patch-1.0-1.1.tar.bz2", "patch-1.1-1.2.tar.bz2"],
+            "app-1.0", "app-1.2")
+"""
+import os
+import shutil
+import tempfile
+import threading
+import multiprocessing
+from os.path import join, isdir, dirname
+from itertools import imap
+from multiprocessing.pool import ThreadPool
+import bsdiff
+from pyflu.path import sub_path
+from pyflu.update import PatchFile, load_patch_info, archive_path, \
+        compression, control_sum_buffer_size, get_digest, \
+        InvalidOriginalFile, InvalidResultingFile
+from pyflu.update.archive import open_archive, is_indexed_archive
+
+
+class PatchChain(object):
+    """
+    Applies the :class:`~pyflu.update.PatchFile` objects ``patches``, in
+    order.
+
+    The patch info of each patch tells how it changes each file: files can
+    be left as is, checked, patched, or created from the patch data. The
+    plan of each file of the result is made of its source (the original
+    file, or a file created by one of the patches) followed by the checks and
+    diffs of the next patches. Diffs are applied block by block if all the
+    diffs of a file use the same block size, otherwise the file is patched
+    in memory. Control sums of the intermediate versions of the files are
+    computed in memory, once per digest algorithm.
+
+    Files built from chunks of the original tree (see
+    :class:`~pyflu.update.chunks.Chunker`) need the real files of the
+    previous version: the chain is then applied in several runs, see
+    :meth:`runs`.
+    """
+
+    def __init__(self, patches):
+        self.patches = patches
+        for patch in patches:
+            patch.info = load_patch_info(
+                    patch.tar.extractfile(patch.info_path).read())
+            patch.plain_files = [m.name for m in patch.tar.getmembers()
+                    if m.name.startswith(patch.plain_prefix)
+                    and not m.isdir()]
+
+    def runs(self):
+        """
+        Returns the lists of patches that can be applied in a single pass.
+
+        A new run is started by each patch building files from chunks of the
+        files of the previous version.
+        """
+        runs = []
+        for patch in self.patches:
+            if not runs or self.uses_old_chunks(patch):
+                runs.append([])
+            runs[-1].append(patch)
+        return runs
+
+    def uses_old_chunks(self, patch):
+        for sum, mode, refs in patch.info.recipes.values():
+            for ref in refs:
+                if ref[1] is not None:
+                    return True
+        return False
+
+    def plan(self, patches, old_dir):
+        """
+        Returns the plan of each file of the result of applying ``patches``
+        to ``old_dir``, as a dict mapping paths relative to the result
+        directory (with slashes separators) to ``(source, stages)`` tuples.
+
+        ``source`` is ``("orig", path)`` for files of ``old_dir``,
+        ``("extract", patch, member)`` for files stored in a patch or
+        ``("build", patch, tar_path)`` for files built from chunks.
+        ``stages`` is a list of ``("check", patch, tar_path)`` and ``("patch",
+        patch, tar_path)`` tuples.
+
+        Also returns the list of the directories of ``old_dir``.
+        """
+        plan = {}
+        dirs = []
+        for base, dir_names, files in os.walk(old_dir):
+            sub_dir = sub_path(base, old_dir)
+            dirs.append(sub_dir)
+            for file in files:
+                plan[archive_path("", sub_dir, file)] = (
+                        ("orig", join(base, file)), [])
+        for patch in patches:
+            for path, (source, stages) in plan.items():
+                tar_path = patch.patch_path("", path)
+                if patch.info.is_ext_file(tar_path):
+                    continue
+                elif patch.info.is_unchanged(tar_path):
+                    stages.append(("check", patch, tar_path))
+                else:
+                    stages.append(("patch", patch, tar_path))
+            for name in patch.plain_files:
+                plan[name[len(patch.plain_prefix) + 1:]] = (
+                        ("extract", patch, name), [])
+            for tar_path in patch.info.recipes:
+                plan[tar_path[len(patch.plain_prefix) + 1:]] = (
+                        ("build", patch, tar_path), [])
+        return plan, dirs
+
+    def apply(self, patches, old_dir, dest_dir, start_callback=None,
+            progress_callback=None, workers=1):
+        """
+        Apply ``patches`` to the content of ``old_dir`` and write the results
+        in ``dest_dir``, in a pool of ``workers`` threads.
+
+        Callbacks are called as by :meth:`pyflu.update.PatchFile.patch`:
+        files of ``old_dir`` are processed in the "patch" stage, and files
+        created by the patches in the "plain" stage.
+        """
+        plan, dirs = self.plan(patches, old_dir)
+        for sub_dir in dirs:
+            dest_sub_dir = join(dest_dir, sub_dir)
+            if not isdir(dest_sub_dir):
+                os.makedirs(dest_sub_dir)
+        patch_tasks = []
+        plain_tasks = []
+        for path in sorted(plan):
+            source, stages = plan[path]
+            dest_file = join(dest_dir, *path.split("/"))
+            if source[0] == "orig":
+                patch_tasks.append((source, stages, old_dir, dest_file))
+            else:
+                plain_tasks.append((source, stages, old_dir, dest_file))
+                outdir = dirname(dest_file)
+                if not isdir(outdir):
+                    os.makedirs(outdir)
+
+        # Run tasks
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        pool = None
+        if workers > 1:
+            pool = ThreadPool(workers)
+            for patch in patches:
+                patch.lock = threading.Lock()
+        try:
+            for stage, tasks in (("patch", patch_tasks),
+                    ("plain", plain_tasks)):
+                if start_callback is not None:
+                    start_callback(stage=stage, length=len(tasks))
+                if pool is None:
+                    results = imap(self.run_task, tasks)
+                else:
+                    results = pool.imap_unordered(self.run_task, tasks)
+                index = 0
+                for result in results:
+                    if progress_callback is not None:
+                        index += 1
+                        progress_callback(index=index)
+        finally:
+            if pool is not None:
+                pool.terminate()
+            for patch in patches:
+                patch.lock = None
+
+    def run_task(self, task):
+        """
+        Write the file ``dest_file`` from its ``source`` and ``stages``,
+        see :meth:`plan`.
+        """
+        source, stages, old_dir, dest_file = task
+        if source[0] == "orig" and not stages:
+            shutil.copy(source[1], dest_file)
+        elif source[0] == "extract" and not stages:
+            source[1].extract_plain(source[2], dest_file)
+        elif source[0] == "build":
+            patch, tar_path = source[1:]
+            recipe = patch.info.recipes[tar_path]
+            if not stages:
+                patch.build_file(old_dir, dest_file, recipe)
+                return
+            build_path = dest_file + ".build"
+            patch.build_file(old_dir, build_path, recipe)
+            try:
+                self.write_file(open(build_path, "rb"), build_path, stages,
+                        dest_file)
+            finally:
+                os.unlink(build_path)
+        elif source[0] == "orig":
+            self.write_file(open(source[1], "rb"), source[1], stages,
+                    dest_file)
+        else:
+            patch, name = source[1:]
+            self.write_file(patch.extractfile(name), None, stages, dest_file)
+
+    def write_file(self, src, src_path, stages, dest_path):
+        """
+        Write the result of applying ``stages`` to the data read from the
+        file object ``src`` to ``dest_path``, and check it.
+
+        ``src_path`` is the path of the source file, if it has one, used to
+        restore the mode of files that are only checked.
+        """
+        diffs = [s for s in stages if s[0] == "patch"]
+        block_sizes = set(s[1].info.blocked.get(s[2]) for s in diffs)
+        if not diffs:
+            read_size = control_sum_buffer_size
+        elif len(block_sizes) == 1 and None not in block_sizes:
+            read_size = block_sizes.pop()
+        else:
+            # Patch the whole file in memory
+            read_size = None
+        # Intermediate versions of the file are numbered from 0 (the source)
+        # to the number of diffs, their control sums are computed once per
+        # digest algorithm
+        hashers = {}
+        version = 0
+        for action, patch, tar_path in stages:
+            hashers.setdefault((version, patch.info.digest),
+                    get_digest(patch.info.digest)())
+            if action == "patch":
+                version += 1
+                hashers.setdefault((version, patch.info.digest),
+                        get_digest(patch.info.digest)())
+        sizes = [0] * (version + 1)
+        patch_fps = [s[1].extractfile(s[1].tar.getmember(s[2]))
+                for s in diffs]
+        try:
+            dest = open(dest_path, "wb")
+            try:
+                while True:
+                    if read_size is None:
+                        data = src.read()
+                    else:
+                        data = src.read(read_size)
+                    more = bool(data)
+                    self.hash_version(hashers, sizes, 0, data)
+                    for index, (action, patch, tar_path) in enumerate(diffs):
+                        if read_size is None:
+                            data = self.patch_data(patch, patch_fps[index],
+                                    data, patch.info.blocked.get(tar_path))
+                        else:
+                            segment = patch.read_segment(patch_fps[index])
+                            if segment is None:
+                                data = ""
+                            else:
+                                more = True
+                                data = self.patch_segment(data, segment)
+                        self.hash_version(hashers, sizes, index + 1, data)
+                    dest.write(data)
+                    if not more or read_size is None:
+                        break
+            finally:
+                dest.close()
+        finally:
+            src.close()
+            for fp in patch_fps:
+                fp.close()
+        try:
+            self.check_stages(stages, hashers, sizes, src_path, dest_path)
+        except:
+            os.unlink(dest_path)
+            raise
+        # Restore file's mode
+        if diffs:
+            patch, tar_path = diffs[-1][1:]
+            os.chmod(dest_path, patch.tar.getmember(tar_path).mode)
+        elif src_path is not None:
+            shutil.copymode(src_path, dest_path)
+
+    def hash_version(self, hashers, sizes, version, data):
+        sizes[version] += len(data)
+        for (hashed_version, digest), hasher in hashers.iteritems():
+            if hashed_version == version:
+                hasher.update(data)
+
+    def patch_data(self, patch, fp, data, block_size):
+        """
+        Apply the whole diff read from ``fp`` to ``data``, split in blocks
+        of ``block_size`` bytes if it's not None.
+        """
+        if block_size is None:
+            return self.patch_segment(data, patch.read_segment(fp))
+        parts = []
+        offset = 0
+        while True:
+            segment = patch.read_segment(fp)
+            if segment is None:
+                break
+            parts.append(self.patch_segment(
+                data[offset:offset + block_size], segment))
+            offset += block_size
+        return "".join(parts)
+
+    def patch_segment(self, data, segment):
+        new_content_len, ctrl, diff_block, extra_block = segment
+        return bsdiff.Patch(data, new_content_len, ctrl, diff_block,
+                extra_block)
+
+    def check_stages(self, stages, hashers, sizes, src_path, dest_path):
+        """
+        Check the control sums and sizes of the versions of a file computed
+        by :meth:`write_file`.
+        """
+        version = 0
+        for action, patch, tar_path in stages:
+            info = patch.info
+            orig_sum, new_sum = info.control_sums[tar_path]
+            file_sizes = info.sizes.get(tar_path)
+            if hashers[version, info.digest].digest() != orig_sum \
+                    or (file_sizes is not None
+                        and sizes[version] != file_sizes[0]):
+                raise InvalidOriginalFile(src_path or dest_path)
+            if action == "patch":
+                version += 1
+                if hashers[version, info.digest].digest() != new_sum \
+                        or (file_sizes is not None
+                            and sizes[version] != file_sizes[1]):
+                    raise InvalidResultingFile(dest_path)
+
+
+def patch_chain(patch_files, old_dir, dest_dir, start_callback=None,
+        progress_callback=None, workers=1):
+    """
+    Apply the patches at ``patch_files``, in order, to the content of
+    ``old_dir`` and write the results in ``dest_dir``.
+
+    This is equivalent to applying the patches one after the other with
+    :func:`pyflu.update.patch`, but each file is written only once. The
+    callbacks and ``workers`` arguments are also the same, callbacks are
+    called for each run of the chain (see :meth:`PatchChain.runs`), usually
+    only once.
+    """
+    tmp_paths = []
+    tmp_dirs = []
+    tars = []
+    try:
+        for path in patch_files:
+            if workers != 1 and not is_indexed_archive(path):
+                # Members of compressed tar streams can't be read out of
+                # order efficiently, work on a decompressed copy
+                fd, tmp_path = tempfile.mkstemp(prefix="pyflu-patch-",
+                        suffix=".tar")
+                os.close(fd)
+                tmp_paths.append(tmp_path)
+                compression.decompress(path, tmp_path)
+                path = tmp_path
+            tars.append(open_archive(path, "r"))
+        chain = PatchChain([PatchFile(tar) for tar in tars])
+        runs = chain.runs()
+        src_dir = old_dir
+        for index, patches in enumerate(runs):
+            if index == len(runs) - 1:
+                run_dest_dir = dest_dir
+            else:
+                run_dest_dir = tempfile.mkdtemp(prefix="pyflu-patch-",
+                        dir=dirname(os.path.abspath(dest_dir)))
+                tmp_dirs.append(run_dest_dir)
+            chain.apply(patches, src_dir, run_dest_dir, start_callback,
+                    progress_callback, workers)
+            src_dir = run_dest_dir
+    finally:
+        for tar in tars:
+            tar.close()
+        for path in tmp_paths:
+            os.unlink(path)
+        for path in tmp_dirs:
+            shutil.rmtree(path)
@@ -0,0 +1,164 @@
+"""
+Content-defined chunking, used to find the data of new files already present
+in the original tree of a patch.
+
+Files are split at positions depending only on their content (where a
+rolling "gear" hash of the last 32 bytes matches a mask), so that inserting
+or removing data in a file only changes the chunks around the modification,
+and moving a file does not change its chunks at all.
+"""
+import os
+import struct
+import hashlib
+from os.path import join
+from pyflu.path import sub_path
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Random values associated to each byte value
+gear_table = [struct.unpack("<I", hashlib.md5(chr(i)).digest()[:4])[0]
+        for i in range(256)]
+
+
+class Chunker(object):
+    """
+    Split files in chunks of ``avg_size`` bytes on average, ``avg_size``
+    being a power of two.
+
+    Chunks are at least ``min_size`` bytes long (except the last chunk of a
+    file) and at most ``max_size`` bytes long, the defaults are a quarter and
+    four times ``avg_size``.
+    """
+
+    read_size = 2**22
+
+    def __init__(self, avg_size=2**16, min_size=None, max_size=None):
+        bits = len(bin(avg_size)) - 3
+        if avg_size != 1 << bits:
+            raise ValueError("average chunk size must be a power of two")
+        if min_size is None:
+            min_size = avg_size / 4
+        if max_size is None:
+            max_size = avg_size * 4
+        self.avg_size = avg_size
+        self.min_size = min_size
+        self.max_size = max_size
+        # Use the high bits of the hash, they depend on more bytes
+        self.mask = ((1 << bits) - 1) << (32 - bits)
+
+    def iter_chunks(self, fp):
+        """
+        Iterate over the chunks of the data read from file object ``fp``.
+        """
+        buffer = ""
+        state = 0
+        min_size = self.min_size
+        max_size = self.max_size
+        while True:
+            block = fp.read(self.read_size)
+            if not block:
+                break
+            offset = len(buffer)
+            cuts, state = self.cut_points(block, state)
+            buffer += block
+            last = 0
+            for pos in cuts:
+                boundary = offset + pos + 1
+                while boundary - last > max_size:
+                    yield buffer[last:last + max_size]
+                    last += max_size
+                if boundary - last >= min_size:
+                    yield buffer[last:boundary]
+                    last = boundary
+            while len(buffer) - last >= max_size:
+                yield buffer[last:last + max_size]
+                last += max_size
+            buffer = buffer[last:]
+        if buffer:
+            yield buffer
+
+    def cut_points(self, data, state):
+        """
+        Returns the list of indexes in the string ``data`` after which the
+        hash matches the chunks boundaries mask, and the new hash state.
+
+        ``state`` is the hash state at the end of the previous data.
+        """
+        if numpy is not None:
+            return numpy_cut_points(data, state, self.mask)
+        return python_cut_points(data, state, self.mask)
+
+
+def python_cut_points(data, state, mask):
+    """
+    Pure Python implementation of :meth:`Chunker.cut_points`.
+    """
+    gear = gear_table
+    cuts = []
+    h = state
+    index = 0
+    for byte in bytearray(data):
+        h = ((h << 1) + gear[byte]) & 0xffffffff
+        if not h & mask:
+            cuts.append(index)
+        index += 1
+    return cuts, h
+
+
+if numpy is not None:
+    numpy_gear_table = numpy.array(gear_table, dtype=numpy.uint32)
+
+    def numpy_cut_points(data, state, mask):
+        """
+        NumPy implementation of :meth:`Chunker.cut_points`.
+
+        The hash at each position is the sum of the gear values of the 32
+        previous bytes, shifted by their distance to the position; it is
+        computed for all positions at once.
+        """
+        values = numpy_gear_table[numpy.frombuffer(data, numpy.uint8)]
+        length = len(values)
+        hashes = values.copy()
+        for shift in range(1, 32):
+            if shift >= length:
+                break
+            hashes[shift:] += values[:-shift] << numpy.uint32(shift)
+        # Contribution of the data preceding this block
+        count = min(31, length)
+        hashes[:count] += numpy.array([(state << (index + 1)) & 0xffffffff
+            for index in range(count)], dtype=numpy.uint32)
+        cuts = numpy.flatnonzero((hashes & numpy.uint32(mask)) == 0)
+        return cuts.tolist(), int(hashes[-1])
+
+
+def chunk_digest(data):
+    """Returns the digest identifying chunk ``data``"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def index_tree(root, chunker):
+    """
+    Split the files found in directory ``root`` in chunks.
+
+    Returns a dict mapping chunks digests to ``(path, offset, length)``
+    tuples, ``path`` being relative to ``root`` with "/" separators.
+    """
+    index = {}
+    for base, dirs, files in os.walk(root):
+        sub_dir = sub_path(base, root)
+        for file in files:
+            path = join(sub_dir, file).replace("\\", "/").lstrip("/")
+            offset = 0
+            fp = open(join(base, file), "rb")
+            try:
+                for chunk in chunker.iter_chunks(fp):
+                    index.setdefault(chunk_digest(chunk),
+                            (path, offset, len(chunk)))
+                    offset += len(chunk)
+            finally:
+                fp.close()
+    return index
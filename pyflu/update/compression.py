@@ -0,0 +1,263 @@
+"""
+Compression codecs of patch archives.
+
+Codecs are registered by name, and recognized by the magic bytes at the
+start of compressed files::
+
+    from pyflu.update.compression import open_tar
+
+    tar = open_tar("patch.tar.xz", "w", "xz")
+    ...
+    tar.close()
+    tar = open_tar("patch.tar.xz")
+
+The "none", "gz" and "bz2" codecs are always available. "xz" requires the
+:mod:`lzma` module (:mod:`backports.lzma` on Python 2) and "zstd" the
+:mod:`zstandard` module.
+"""
+import os
+import bz2
+import gzip
+import zlib
+import shutil
+import tarfile
+import tempfile
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class UnknownCodec(ValueError): pass
+
+
+class Codec(object):
+    """
+    Base class of codecs.
+
+    Subclasses define the codec ``name``, the ``magic`` bytes found at the
+    start of compressed files, and the following methods:
+
+      * ``open(path, mode)``: open the file at ``path`` for reading ("r"
+        ``mode``) or writing ("w" ``mode``). The returned file object must
+        support ``tell()``, and ``seek()`` in read mode.
+      * ``compressor()``: returns a new incremental compressor object, with
+        ``compress(data)`` and ``flush()`` methods.
+      * ``decompressor()``: returns a new incremental decompressor object,
+        with a ``decompress(data)`` method.
+    """
+
+    name = None
+    magic = None
+
+
+class NoCompression(object):
+    """
+    Compressor and decompressor of the "none" codec.
+    """
+
+    def compress(self, data):
+        return data
+
+    def flush(self):
+        return ""
+
+    def decompress(self, data):
+        return data
+
+
+class NoCodec(Codec):
+
+    name = "none"
+
+    def open(self, path, mode):
+        return open(path, mode + "b")
+
+    def compressor(self):
+        return NoCompression()
+
+    def decompressor(self):
+        return NoCompression()
+
+
+class GzipCodec(Codec):
+    """
+    Gzip codec. Incremental compressors produce zlib streams, without the
+    gzip header.
+    """
+
+    name = "gz"
+    magic = "\x1f\x8b"
+
+    def open(self, path, mode):
+        return gzip.GzipFile(path, mode + "b", 9)
+
+    def compressor(self):
+        return zlib.compressobj(9)
+
+    def decompressor(self):
+        return zlib.decompressobj()
+
+
+class Bzip2Codec(Codec):
+
+    name = "bz2"
+    magic = "BZh"
+
+    def open(self, path, mode):
+        return bz2.BZ2File(path, mode, compresslevel=9)
+
+    def compressor(self):
+        return bz2.BZ2Compressor(9)
+
+    def decompressor(self):
+        return bz2.BZ2Decompressor()
+
+
+class XzCodec(Codec):
+
+    name = "xz"
+    magic = "\xfd7zXZ\x00"
+
+    def open(self, path, mode):
+        if mode == "w":
+            return lzma.LZMAFile(path, "w", preset=6)
+        return lzma.LZMAFile(path, "r")
+
+    def compressor(self):
+        return lzma.LZMACompressor(preset=6)
+
+    def decompressor(self):
+        return lzma.LZMADecompressor()
+
+
+class ZstdCodec(Codec):
+    """
+    Zstandard codec.
+
+    Compressed streams can't be seeked backwards, archives are decompressed
+    to a temporary file for reading.
+    """
+
+    name = "zstd"
+    magic = "\x28\xb5\x2f\xfd"
+    level = 10
+
+    def open(self, path, mode):
+        if mode == "w":
+            compressor = zstandard.ZstdCompressor(level=self.level)
+            return compressor.stream_writer(open(path, "wb"))
+        tmp = tempfile.TemporaryFile()
+        src = open(path, "rb")
+        try:
+            zstandard.ZstdDecompressor().copy_stream(src, tmp)
+        finally:
+            src.close()
+        tmp.seek(0)
+        return tmp
+
+    def compressor(self):
+        return zstandard.ZstdCompressor(level=self.level).compressobj()
+
+    def decompressor(self):
+        return zstandard.ZstdDecompressor().decompressobj()
+
+
+# Registered codecs, indexed by name
+codecs = {}
+
+
+def register_codec(codec):
+    """
+    Register ``codec``, an instance of a :class:`Codec` subclass.
+    """
+    codecs[codec.name] = codec
+
+
+def get_codec(name):
+    """
+    Retrieve a codec by its name.
+    """
+    try:
+        return codecs[name]
+    except KeyError:
+        raise UnknownCodec("unknown or unavailable codec '%s'" % name)
+
+
+def detect_codec(path):
+    """
+    Returns the codec of the file at ``path``, identified by its first bytes.
+
+    Files not matching any magic string are assumed to be uncompressed.
+    """
+    fp = open(path, "rb")
+    try:
+        header = fp.read(16)
+    finally:
+        fp.close()
+    for codec in codecs.values():
+        if codec.magic is not None and header.startswith(codec.magic):
+            return codec
+    return codecs["none"]
+
+
+def decompress(path, dest_path):
+    """
+    Decompress the file at ``path`` to ``dest_path``, the codec is detected
+    with :func:`detect_codec`.
+    """
+    src = detect_codec(path).open(path, "r")
+    try:
+        dest = open(dest_path, "wb")
+        try:
+            shutil.copyfileobj(src, dest, 2**20)
+        finally:
+            dest.close()
+    finally:
+        src.close()
+
+
+def open_tar(path, mode="r", codec=None):
+    """
+    Open the tar archive at ``path`` for reading ("r" ``mode``) or writing
+    ("w" ``mode``), compressed with ``codec``.
+
+    ``codec`` is a codec name, it defaults to "bz2" for writing and to the
+    codec detected with :func:`detect_codec` for reading. Closing the
+    returned TarFile also closes the compressed stream.
+    """
+    if codec is not None:
+        codec = get_codec(codec)
+    elif mode == "r":
+        codec = detect_codec(path)
+    else:
+        codec = get_codec("bz2")
+    fp = codec.open(path, mode)
+    try:
+        tar = tarfile.open(fileobj=fp, mode=mode + ":")
+    except:
+        fp.close()
+        raise
+    # Let the TarFile close its file object, like tarfile.open() does for
+    # compressed archives
+    tar._extfileobj = False
+    tar.name = os.path.abspath(path)
+    return tar
+
+
+register_codec(NoCodec())
+register_codec(GzipCodec())
+register_codec(Bzip2Codec())
+if lzma is not None:
+    register_codec(XzCodec())
+if zstandard is not None:
+    register_codec(ZstdCodec())
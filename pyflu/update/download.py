@@ -0,0 +1,266 @@
+"""
+Resumable HTTP downloads.
+
+Files are downloaded to a ``.part`` file next to their destination, along
+with a ``.part.json`` file recording the progress of each segment. An
+interrupted download is resumed with Range requests the next time it is
+started::
+
+    from pyflu.update.download import Downloader
+
+    Downloader().download("http://example.com/patch.tar.bz2",
+            "patch.tar.bz2")
+
+Large files are fetched in several segments in parallel, if the server
+supports Range requests.
+"""
+import os
+import time
+import socket
+import httplib
+import urllib2
+import threading
+from binascii import unhexlify
+from os.path import exists, getsize
+try:
+    import json
+except ImportError:
+    import simplejson as json
+from pyflu.update import control_sum
+from pyflu.update.remote import fetch_size
+
+
+class DownloadError(IOError): pass
+class RangeNotSupported(DownloadError): pass
+
+
+class Downloader(object):
+    """
+    Downloads files in up to ``segments`` parallel connections.
+
+    Each segment is retried ``retries`` times on network errors, resuming
+    where it stopped. ``timeout`` is the timeout of network operations in
+    seconds.
+
+    Files smaller than twice :attr:`min_segment_size` are downloaded in a
+    single segment.
+    """
+
+    chunk_size = 2**16
+    min_segment_size = 2**20
+    # Interval between progress callbacks and saves of the download state,
+    # in seconds
+    poll_interval = 0.1
+    save_interval = 1.0
+
+    def __init__(self, segments=4, retries=3, timeout=60):
+        self.segments = segments
+        self.retries = retries
+        self.timeout = timeout
+
+    def download(self, url, path, size=None, progress_callback=None,
+            digest=None, sum=None):
+        """
+        Download the file at ``url`` to ``path``.
+
+        ``size`` is the size of the file, it is retrieved with a HEAD
+        request if it's not given. ``progress_callback`` is called with the
+        keyword arguments ``received`` and ``total`` (None if the size is
+        unknown) as data is received, from the calling thread. If ``sum``
+        is given, it is the hex control sum of the file, computed with the
+        ``digest`` algorithm, and the download is checked against it.
+
+        Raises :class:`DownloadError` if the download fails. The partial
+        download is kept, and resumed by the next call, unless the data
+        received turns out to be invalid.
+        """
+        if size is None:
+            size = fetch_size(url)
+        part_path = path + ".part"
+        state_path = path + ".part.json"
+        state = self.load_state(state_path, url, size)
+        if state is None or not exists(part_path):
+            state = self.new_state(url, size)
+            fp = open(part_path, "wb")
+            if size is not None:
+                fp.truncate(size)
+            fp.close()
+        try:
+            self.fetch_segments(state, part_path, state_path,
+                    progress_callback)
+        except RangeNotSupported:
+            # Start again in a single segment
+            state = self.new_state(url, size, 1)
+            self.fetch_segments(state, part_path, state_path,
+                    progress_callback)
+        if size is not None and getsize(part_path) != size:
+            self.remove(part_path, state_path)
+            raise DownloadError("%s: expected %d bytes, got %d" % (url, size,
+                getsize(part_path)))
+        if sum is not None \
+                and control_sum(part_path, digest) != unhexlify(sum):
+            self.remove(part_path, state_path)
+            raise DownloadError("%s: invalid control sum" % url)
+        if os.name == "nt" and exists(path):
+            os.unlink(path)
+        os.rename(part_path, path)
+        os.unlink(state_path)
+
+    def new_state(self, url, size, segments=None):
+        """
+        Returns the initial state of the download of ``url``, splitting it
+        in ``segments`` segments (:attr:`segments` by default).
+
+        States are dicts holding the ``url`` and ``size`` of the file, and
+        a list of ``[start, end, position]`` lists describing the segments.
+        ``end`` is None if the size is unknown.
+        """
+        if segments is None:
+            segments = self.segments
+        if size is None:
+            return {"url": url, "size": None, "segments": [[0, None, 0]]}
+        count = max(1, min(segments, size / self.min_segment_size))
+        bounds = [size * i / count for i in range(count + 1)]
+        return {"url": url, "size": size, "segments":
+                [[bounds[i], bounds[i + 1], bounds[i]]
+                    for i in range(count)]}
+
+    def load_state(self, state_path, url, size):
+        """
+        Returns the saved state of the download of ``url`` at
+        ``state_path``, or None if it can't be resumed.
+        """
+        if not exists(state_path):
+            return None
+        try:
+            fp = open(state_path, "rb")
+            try:
+                state = json.load(fp)
+            finally:
+                fp.close()
+        except (IOError, ValueError):
+            return None
+        if state.get("url") != url or state.get("size") != size \
+                or size is None:
+            return None
+        return state
+
+    def save_state(self, state, state_path, lock):
+        lock.acquire()
+        try:
+            data = json.dumps(state)
+        finally:
+            lock.release()
+        fp = open(state_path, "wb")
+        try:
+            fp.write(data)
+        finally:
+            fp.close()
+
+    def remove(self, *paths):
+        for path in paths:
+            if exists(path):
+                os.unlink(path)
+
+    def fetch_segments(self, state, part_path, state_path,
+            progress_callback):
+        """
+        Download the segments of ``state`` in parallel threads.
+        """
+        lock = threading.Lock()
+        errors = []
+        stop = threading.Event()
+        threads = []
+        for segment in state["segments"]:
+            if segment[1] is not None and segment[2] >= segment[1]:
+                continue
+            thread = threading.Thread(target=self.segment_thread,
+                    args=(state, segment, part_path, lock, errors, stop))
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        last_save = time.time()
+        last_received = None
+        while threads:
+            threads[0].join(self.poll_interval)
+            threads = [t for t in threads if t.isAlive()]
+            received = sum(s[2] - s[0] for s in state["segments"])
+            if progress_callback is not None and received != last_received:
+                progress_callback(received=received, total=state["size"])
+                last_received = received
+            if time.time() - last_save > self.save_interval:
+                self.save_state(state, state_path, lock)
+                last_save = time.time()
+        self.save_state(state, state_path, lock)
+        if errors:
+            raise errors[0]
+
+    def segment_thread(self, state, segment, part_path, lock, errors,
+            stop):
+        try:
+            tries = 0
+            while not stop.isSet():
+                try:
+                    self.fetch_range(state, segment, part_path, lock, stop)
+                    return
+                except RangeNotSupported:
+                    raise
+                except urllib2.HTTPError, err:
+                    # Only retry server errors
+                    tries += 1
+                    if err.code < 500 or tries > self.retries:
+                        raise
+                except (IOError, socket.error, httplib.HTTPException):
+                    tries += 1
+                    if tries > self.retries:
+                        raise
+        except Exception, err:
+            if not isinstance(err, DownloadError):
+                err = DownloadError("%s: %s" % (state["url"], err))
+            errors.append(err)
+            stop.set()
+
+    def fetch_range(self, state, segment, part_path, lock, stop):
+        """
+        Download the remaining data of ``segment``.
+        """
+        start, end, position = segment
+        request = urllib2.Request(state["url"])
+        if position > 0 or end != state["size"]:
+            request.add_header("Range", "bytes=%d-%s" % (position,
+                "" if end is None else end - 1))
+        response = urllib2.urlopen(request, timeout=self.timeout)
+        try:
+            if request.has_header("Range") and response.getcode() != 206:
+                # The whole file is sent
+                if start != 0 or end != state["size"]:
+                    raise RangeNotSupported("%s: the server does not "
+                            "support Range requests" % state["url"])
+                lock.acquire()
+                segment[2] = position = 0
+                lock.release()
+            fp = open(part_path, "r+b")
+            try:
+                fp.seek(position)
+                while not stop.isSet():
+                    if end is None:
+                        length = self.chunk_size
+                    else:
+                        length = min(self.chunk_size, end - position)
+                        if not length:
+                            return
+                    data = response.read(length)
+                    if not data:
+                        break
+                    fp.write(data)
+                    fp.flush()
+                    position += len(data)
+                    lock.acquire()
+                    segment[2] = position
+                    lock.release()
+            finally:
+                fp.close()
+        finally:
+            response.close()
+        if end is not None and position < end and not stop.isSet():
+            raise DownloadError("%s: connection closed" % state["url"])
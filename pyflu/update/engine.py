@@ -0,0 +1,317 @@
+"""
+GUI independent update process.
+
+:class:`UpdateEngine` finds the updates published on a server, downloads
+the patches leading to the latest version and applies them::
+
+    from pyflu.update.engine import UpdateEngine
+
+    def listener(event):
+        print event
+
+    engine = UpdateEngine("http://example.com/updates/", "1.0",
+            "/tmp/patches", "/opt/app")
+    new_dir = engine.update(listener)
+
+Progress is reported to listeners as :class:`UpdateEvent` objects. The
+update can also run in a background thread with :meth:`UpdateEngine.start`,
+its events are then queued in :attr:`UpdateEngine.events`.
+"""
+import os
+import threading
+import Queue
+from binascii import unhexlify
+from os.path import basename, join, isdir, exists, getsize
+from multiprocessing.pool import ThreadPool
+from pyflu.update import control_sum
+from pyflu.update.chain import patch_chain
+from pyflu.update.remote import find_updates, plan_update
+from pyflu.update.download import Downloader
+from pyflu.update.version import Version
+
+
+class UpdateEvent(object):
+    """
+    An event of the update process.
+
+    ``name`` is one of:
+      * "checking": updates are being searched
+      * "checked": the search finished, ``chain`` is the list of patches to
+        apply, as returned by :func:`~pyflu.update.remote.plan_update`, and
+        ``full_install_url`` the url of the full installation package to
+        use instead, or None
+      * "download_started": the download of ``url`` to ``path`` started,
+        ``index`` is its position in the ``count`` patches to download
+      * "download_progress": ``received`` bytes of all the patches were
+        downloaded, out of ``total`` (None if some sizes are unknown)
+      * "download_finished": ``url`` was downloaded to ``path``
+      * "patch_started": a stage of the application of the patches at
+        ``paths`` started, with the ``stage`` and ``length`` arguments of
+        :func:`~pyflu.update.patch`
+      * "patch_progress": ``position`` files out of the stage length were
+        processed
+      * "finished": the update finished, ``path`` is the patched directory,
+        or None if no patch was applied
+      * "error": the update failed with the exception ``error``, only sent
+        by :meth:`UpdateEngine.start`
+    """
+
+    def __init__(self, name, **kwargs):
+        self.name = name
+        self.__dict__.update(kwargs)
+
+    def __repr__(self):
+        args = ", ".join("%s=%r" % item for item in sorted(
+            self.__dict__.items()) if item[0] != "name")
+        return "UpdateEvent(%r, %s)" % (self.name, args)
+
+
+class UpdateEngine(object):
+    """
+    Updates the directory ``target_dir``, at version ``current_version``,
+    with the patches published at ``update_url``.
+
+    Patches are found on the ``update_url`` page with the regular expression
+    ``patch_files_pattern``, or listed in the manifest at ``manifest_url``
+    and cached in ``manifest_cache_path``, see
+    :func:`~pyflu.update.remote.find_updates`. If ``full_install_pattern`` is
+    set, links matching it are full installation packages, used instead of
+    the patches when they are cheaper.
+
+    Patches are downloaded in ``download_dir``, ``download_workers`` at a
+    time, each in up to ``download_segments`` connections. They are applied
+    with ``patch_workers`` threads.
+
+    Listeners are callables taking an :class:`UpdateEvent`, called from the
+    thread running the engine methods.
+    """
+
+    version_pattern = r"(?P<%s>r?[0-9a-zA-Z_.-]+?)"
+    patch_files_pattern = r"^patch-%s-%s\.tar\.bz2" % \
+            (version_pattern % "from", version_pattern % "to")
+
+    def __init__(self, update_url, current_version, download_dir, target_dir,
+            patch_files_pattern=None, manifest_url=None,
+            manifest_cache_path=None, full_install_pattern=None,
+            download_workers=2, download_segments=4, patch_workers=1):
+        self.update_url = update_url
+        self.current_version = Version(str(current_version))
+        self.download_dir = download_dir
+        self.target_dir = target_dir
+        if patch_files_pattern is not None:
+            self.patch_files_pattern = patch_files_pattern
+        self.manifest_url = manifest_url
+        self.manifest_cache_path = manifest_cache_path
+        self.full_install_pattern = full_install_pattern
+        self.download_workers = download_workers
+        self.download_segments = download_segments
+        self.patch_workers = patch_workers
+        self.chain = []
+        self.sizes = {}
+        self.sums = {}
+        self.full_install_url = None
+        self.patches_paths = []
+        self.events = Queue.Queue()
+        self.thread = None
+        self.result = None
+        self.error = None
+
+    def update(self, listener=None, check=True):
+        """
+        Run the whole update process: :meth:`check`, :meth:`download` and
+        :meth:`apply`.
+
+        If ``check`` is False, the patches found by a previous call to
+        :meth:`check` are downloaded and applied.
+
+        Returns the patched directory, or None if there was no patch to
+        apply. :attr:`full_install_url` is set if a full installation
+        package should be used instead.
+        """
+        if check:
+            self.check(listener)
+        if self.chain:
+            self.download(listener)
+            path = self.apply(listener)
+        else:
+            path = None
+        self.send(listener, "finished", path=path)
+        return path
+
+    def start(self, listener=None, check=True):
+        """
+        Run :meth:`update` in a background thread, with the ``check``
+        argument.
+
+        Events are put in the :attr:`events` queue, and passed to
+        ``listener`` from the background thread. The last event is
+        "finished" or "error".
+        """
+        def queue_listener(event):
+            self.events.put(event)
+            if listener is not None:
+                listener(event)
+
+        def run():
+            try:
+                self.result = self.update(queue_listener, check)
+            except Exception, err:
+                self.error = err
+                self.send(queue_listener, "error", error=err)
+
+        self.result = None
+        self.error = None
+        self.thread = threading.Thread(target=run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def iter_events(self, timeout=None):
+        """
+        Yields the events of the update started with :meth:`start`, until
+        it finishes.
+        """
+        while True:
+            event = self.events.get(True, timeout)
+            yield event
+            if event.name in ("finished", "error"):
+                return
+
+    def wait(self, timeout=None):
+        """
+        Wait for the update started with :meth:`start` to finish, returns the
+        result of :meth:`update` or raises its exception.
+        """
+        self.thread.join(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def send(self, listener, name, **kwargs):
+        if listener is not None:
+            listener(UpdateEvent(name, **kwargs))
+
+    def check(self, listener=None):
+        """
+        Search for updates.
+
+        Returns the urls of the patches to download, in the order they must
+        be applied. Raises :class:`IOError` if the server can't be reached.
+        """
+        self.send(listener, "checking")
+        patches, self.sizes, full_install, self.sums = find_updates(
+                self.update_url, self.patch_files_pattern, self.manifest_url,
+                self.manifest_cache_path, self.full_install_pattern,
+                self.current_version)
+        chain = plan_update(patches, self.current_version, self.sizes,
+                full_install)
+        self.full_install_url = None
+        if chain and chain[0][0] is None:
+            self.full_install_url = chain[0][2]
+            chain = []
+        self.chain = chain or []
+        self.send(listener, "checked", chain=self.chain,
+                full_install_url=self.full_install_url)
+        return [p[2] for p in self.chain]
+
+    def download(self, listener=None):
+        """
+        Download the patches found by :meth:`check`, and returns their
+        paths.
+
+        Raises :class:`~pyflu.update.download.DownloadError` if a download
+        fails, partial downloads are resumed by the next call.
+        """
+        urls = [p[2] for p in self.chain]
+        paths = [join(self.download_dir, basename(url)) for url in urls]
+        received = dict((url, 0) for url in urls)
+        totals = dict((url, self.sizes.get(url)) for url in urls)
+        events = Queue.Queue()
+
+        def fetch(index):
+            url, path = urls[index], paths[index]
+            if self.downloaded(url, path):
+                received[url] = totals[url] = getsize(path)
+                return None
+            events.put(("download_started", {"url": url, "path": path,
+                "index": index, "count": len(urls)}))
+
+            def progress(received, total):
+                events.put((url, received, total))
+
+            digest, sum = self.sums.get(url, (None, None))
+            try:
+                Downloader(self.download_segments).download(url, path,
+                        totals[url], progress, digest, sum)
+            except Exception, err:
+                return err
+            events.put(("download_finished", {"url": url, "path": path}))
+            return None
+
+        # Downloads run in worker threads, events are sent from this thread
+        pool = ThreadPool(max(1, min(self.download_workers, len(urls))))
+        try:
+            result = pool.map_async(fetch, range(len(urls)))
+            while not result.ready() or not events.empty():
+                try:
+                    event = events.get(True, 0.1)
+                except Queue.Empty:
+                    continue
+                if event[0] in ("download_started", "download_finished"):
+                    self.send(listener, event[0], **event[1])
+                    continue
+                url, received[url], totals[url] = event
+                if None in totals.values():
+                    total = None
+                else:
+                    total = sum(totals.values())
+                self.send(listener, "download_progress",
+                        received=sum(received.values()), total=total)
+            errors = [err for err in result.get() if err is not None]
+        finally:
+            pool.close()
+            pool.join()
+        if errors:
+            raise errors[0]
+        self.patches_paths = paths
+        return paths
+
+    def downloaded(self, url, path):
+        """
+        Returns True if ``url`` was already downloaded to ``path``.
+        """
+        if not exists(path):
+            return False
+        if url in self.sums:
+            digest, sum = self.sums[url]
+            return control_sum(path, digest) == unhexlify(sum)
+        size = self.sizes.get(url)
+        return size is not None and getsize(path) == size
+
+    def apply(self, listener=None):
+        """
+        Apply the downloaded patches to a copy of the target directory in a
+        single pass (see :func:`~pyflu.update.chain.patch_chain`), and
+        remove them.
+
+        Returns the patched directory, created next to the target directory.
+        """
+        paths = self.patches_paths
+        new_dir = self.target_dir + "_"
+        while isdir(new_dir):
+            new_dir += "_"
+        os.mkdir(new_dir)
+
+        def start_cb(stage, length):
+            self.send(listener, "patch_started", paths=paths, stage=stage,
+                    length=length)
+
+        def progress_cb(index):
+            self.send(listener, "patch_progress", position=index)
+
+        patch_chain(paths, self.target_dir, new_dir, start_cb, progress_cb,
+                self.patch_workers)
+        # Remove patch files
+        for path in paths:
+            os.unlink(path)
+        self.patches_paths = []
+        return new_dir
@@ -0,0 +1,132 @@
+"""
+Persistent cache of files control sums.
+
+Sums are stored with the size, modification time and inode of the files they
+were computed from, and are only reused if these didn't change::
+
+    from pyflu.update.hashcache import HashCache
+
+    cache = HashCache("hashes.json")
+    diff("patch.tar.bz2", "v1", "v2", hash_cache=cache)
+    cache.save()
+"""
+import os
+import sys
+import time
+import tempfile
+from os.path import abspath, exists, dirname
+from binascii import hexlify, unhexlify
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+class HashCache(object):
+    """
+    A cache of control sums, stored in the JSON file at ``path``.
+
+    Files modified less than :attr:`min_age` seconds before their sum is
+    computed are not cached, since they could be modified again without
+    their modification time changing.
+    """
+
+    version = 1
+    min_age = 2
+
+    def __init__(self, path):
+        self.path = path
+        # Maps digest names to dicts of (size, mtime, inode, hex sum) lists,
+        # indexed by path keys (see path_key())
+        self.entries = {}
+        if exists(path):
+            self.load()
+
+    def load(self):
+        fp = open(self.path, "rb")
+        try:
+            try:
+                data = json.load(fp)
+            except ValueError:
+                # Corrupted cache, start again
+                return
+        finally:
+            fp.close()
+        if data.get("version") == self.version:
+            self.entries = data["entries"]
+
+    def save(self):
+        """
+        Write the cache, forgetting files that don't exist anymore.
+        """
+        for sums in self.entries.values():
+            for key in sums.keys():
+                if not exists(key.encode("latin-1")):
+                    del sums[key]
+        # Write to a temporary file first, so that the cache is never
+        # truncated
+        fd, tmp_path = tempfile.mkstemp(dir=dirname(abspath(self.path)))
+        fp = os.fdopen(fd, "wb")
+        try:
+            json.dump({"version": self.version, "entries": self.entries}, fp)
+        finally:
+            fp.close()
+        if os.name == "nt" and exists(self.path):
+            os.unlink(self.path)
+        os.rename(tmp_path, self.path)
+
+    def stat_key(self, statinfo):
+        return [statinfo.st_size, statinfo.st_mtime, statinfo.st_ino]
+
+    def get(self, path, digest):
+        """
+        Returns the ``digest`` sum of the file at ``path``, or None if it is
+        not in the cache or the file changed.
+        """
+        entry = self.entries.get(digest, {}).get(path_key(path))
+        if entry is None:
+            return None
+        try:
+            key = self.stat_key(os.stat(path))
+        except OSError:
+            return None
+        if entry[:3] != key:
+            return None
+        return unhexlify(entry[3])
+
+    def set(self, path, digest, sum, statinfo=None):
+        """
+        Store ``sum``, the ``digest`` sum of the file at ``path``.
+        ``statinfo`` is the result of :func:`os.stat` on the file when the
+        sum was computed.
+        """
+        if statinfo is None:
+            statinfo = os.stat(path)
+        if time.time() - statinfo.st_mtime < self.min_age:
+            return
+        self.entries.setdefault(digest, {})[path_key(path)] = \
+                self.stat_key(statinfo) + [hexlify(sum)]
+
+    def control_sum(self, path, digest):
+        """
+        Returns the ``digest`` sum of the file at ``path``, computing it only
+        if it's not in the cache.
+        """
+        from pyflu.update import control_sum
+        sum = self.get(path, digest)
+        if sum is None:
+            statinfo = os.stat(path)
+            sum = control_sum(path, digest)
+            self.set(path, digest, sum, statinfo)
+        return sum
+
+
+def path_key(path):
+    """
+    Returns the key of ``path`` in the cache, its absolute path decoded as
+    latin-1 so that any byte string can be stored.
+    """
+    path = abspath(path)
+    if isinstance(path, unicode):
+        path = path.encode(sys.getfilesystemencoding() or "utf-8")
+    return path.decode("latin-1")
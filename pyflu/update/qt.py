@@ -1,16 +1,12 @@
-from os.path import basename, join, isdir
-import os
+from os.path import basename
 import sys
-import shutil
-import re
+import Queue
 import louie
-import urllib2
 from PyQt4.QtGui import *
 from PyQt4.QtCore import *    
-from PyQt4.QtNetwork import *
-from pyflu.update import patch, signals
-from pyflu.update.remote import find_patches_groups
-from pyflu.update.version import Version
+from pyflu.update import signals
+from pyflu.update.download import DownloadError
+from pyflu.update.engine import UpdateEngine
 
 
 class UpdateDialogMixin(object):
@@ -27,6 +23,32 @@ class UpdateDialogMixin(object):
       * *current_version*: the current version string
       * *patch_dl_dir*: the temporary directory where patches are downloaded
       * *patch_target_dir*: the directory to patch
+
+    *patch_workers* is the number of threads used to apply patches (all the
+    available CPUs if None).
+
+    The cheapest chain of patches leading to the latest version is
+    downloaded, patches being weighted by their size. If 
+    *full_install_pattern* is set, links matching it on the *update_url* page
+    are full installation packages (the pattern must define a 'version'
+    group); when the latest package is cheaper than the patches, the
+    :class:`~pyflu.update.signals.full_install_available` signal is sent
+    instead of applying them.
+
+    If *manifest_url* is set, updates are listed from the manifest found
+    there (see :class:`~pyflu.update.remote.Manifest`), and the *update_url*
+    page is only used if the manifest can't be retrieved. The manifest is
+    cached in *manifest_cache_path* if it's set, so that it is downloaded 
+    again only when it changes.
+
+    Large patches are downloaded in *download_segments* parallel
+    connections. Interrupted downloads are resumed when the user retries.
+
+    The update itself is performed by a
+    :class:`~pyflu.update.engine.UpdateEngine`, see :meth:`create_engine`.
+    Updates are searched from the calling thread, then downloaded and applied
+    in the background thread of the engine; its events are displayed from
+    the Qt event loop, every *events_interval* milliseconds.
     """
 
     _properties = ["update_url", "patch_files_pattern"]
@@ -35,12 +57,31 @@ class UpdateDialogMixin(object):
     version_pattern = r"(?P<%s>r?[0-9a-zA-Z_.-]+?)"
     patch_files_pattern = r"^patch-%s-%s\.tar\.bz2" % \
             (version_pattern % "from", version_pattern % "to")
+    full_install_pattern = None
+    manifest_url = None
+    manifest_cache_path = None
+    download_segments = 4
     current_version = None
     patch_dl_dir = None
     patch_target_dir = None
+    patch_workers = 1
+    events_interval = 100
+    events_timer = None
     progress_bar_name = "progress_bar"
     operation_label_name = "operation_label"
 
+    def create_engine(self):
+        """
+        Returns the :class:`~pyflu.update.engine.UpdateEngine` performing
+        the update.
+        """
+        return UpdateEngine(self.update_url, self.current_version,
+                self.patch_dl_dir, self.patch_target_dir,
+                self.patch_files_pattern, self.manifest_url,
+                self.manifest_cache_path, self.full_install_pattern,
+                download_segments=self.download_segments,
+                patch_workers=self.patch_workers)
+
     def start_update(self, confirm=True):
         """
         Shows the dialog and starts the update process.
@@ -51,12 +92,20 @@ class UpdateDialogMixin(object):
         available or the user refused to apply it).
         """
         # Check for updates
-        self.patches_paths = []
+        self.engine = self.create_engine()
         self.start_long_operation(
                 self.trUtf8("Searching for updates..."), 1)
-        self.download_queue = self._updates_urls()
+        try:
+            urls = self.engine.check()
+        except IOError, err:
+            pb = getattr(self, self.progress_bar_name)
+            ol = getattr(self, self.operation_label_name)
+            pb.setValue(0)
+            ol.setText(self.trUtf8("Error opening update url: %1")
+                    .arg(str(err)))
+            urls = []
         self.update_long_operation(1)
-        if self.download_queue:
+        if urls:
             # Updates available, apply them or exit
             if confirm:
                 ret = QMessageBox.question(self, 
@@ -68,8 +117,12 @@ class UpdateDialogMixin(object):
             else:
                 do_update = True
             if do_update:
-                self._download_next()
+                self._start_engine()
                 return
+        elif self.engine.full_install_url is not None:
+            louie.send(signals.full_install_available, self, 
+                    self.engine.full_install_url)
+            return
         louie.send(signals.not_updated, self)
 
     def start_long_operation(self, text, length):
@@ -85,81 +138,105 @@ class UpdateDialogMixin(object):
         pb.setValue(index)
         QCoreApplication.processEvents()
 
-    def _download_next(self):
-        pb = getattr(self, self.progress_bar_name)
-        ol = getattr(self, self.operation_label_name)
-        # Open download file object
-        self.download_url = self.download_queue.pop(0)        
-        fname = basename(self.download_url)
-        self.save_path = join(self.patch_dl_dir, fname)
-        ol.setText(self.trUtf8("Downloading '%1'").arg(fname))
-        pb.setValue(0)
-        self.file = QFile(self.save_path)
-        self.file.open(QFile.ReadWrite)
-        # Start download
-        manager = QNetworkAccessManager(self)
-        self.reply = manager.get(QNetworkRequest(QUrl(self.download_url)))
-        self.reply.downloadProgress.connect(self._update_download_progress)
-        self.reply.error.connect(self._download_error)
-        self.reply.readyRead.connect(self._flush_download)
-        self.reply.finished.connect(self._download_finished)
+    def _start_engine(self):
+        """
+        Download and apply the updates found by the engine in its background
+        thread, and start processing its events.
+        """
+        self.engine.start(check=False)
+        if self.events_timer is None:
+            self.events_timer = QTimer(self)
+            self.events_timer.timeout.connect(self._process_engine_events)
+        self.events_timer.start(self.events_interval)
+
+    def _process_engine_events(self):
+        """
+        Called by the events timer to process the events queued by the
+        engine.
+        """
+        # Stop the timer while events are processed, so that the
+        # processEvents() calls of the widgets updates don't process them
+        # recursively
+        self.events_timer.stop()
+        while True:
+            try:
+                event = self.engine.events.get_nowait()
+            except Queue.Empty:
+                break
+            if event.name == "finished":
+                self._download_finished(event.path)
+                return
+            if event.name == "error":
+                # Resume the partial downloads if the user retries
+                if isinstance(event.error, DownloadError):
+                    if self._download_error(event.error):
+                        self._start_engine()
+                else:
+                    self._update_error(event.error)
+                return
+            self._engine_event(event)
+        self.events_timer.start(self.events_interval)
+
+    def _engine_event(self, event):
+        """
+        Displays the progress of the update engine.
+        """
+        if event.name == "download_started":
+            ol = getattr(self, self.operation_label_name)
+            ol.setText(self.trUtf8("Downloading '%1'")
+                    .arg(basename(event.path)))
+            QCoreApplication.processEvents()
+        elif event.name == "download_progress":
+            self._update_download_progress(event.received, event.total)
+        elif event.name == "patch_started":
+            if event.stage == "patch":
+                text = self.trUtf8("Installing %1 update(s) : patching "
+                        "files")
+            else:
+                text = self.trUtf8("Installing %1 update(s) : creating "
+                        "new files")
+            text = text.arg(len(event.paths))
+            self.start_long_operation(text, event.length)
+        elif event.name == "patch_progress":
+            self.update_long_operation(event.position)
 
     def _update_download_progress(self, received, total):
         pb = getattr(self, self.progress_bar_name)
-        pb.setRange(0, total)
-        pb.setValue(received)
+        if total is None:
+            pb.setRange(0, 0)
+        else:
+            pb.setRange(0, total)
+            pb.setValue(received)
+        QCoreApplication.processEvents()
 
-    def _flush_download(self):
-        self.file.write(self.reply.readAll())
+    def _download_error(self, err):
+        """
+        Called when the download of the patches failed with ``err``. Returns
+        True to retry the download.
+        """
+        ret = QMessageBox.critical(self, self.trUtf8("Error"), 
+                self.trUtf8("An error happened while downloading updates: "
+                    "%1").arg(str(err)),
+                QMessageBox.Retry | QMessageBox.Abort)
+        if ret == QMessageBox.Retry:
+            return True
+        self._exit(1)
+        return False
 
-    def _download_error(self, code):
+    def _update_error(self, err):
+        """
+        Called when the installation of the patches failed with ``err``.
+        """
         QMessageBox.critical(self, self.trUtf8("Error"), 
-                self.trUtf8("An error happened while downloading %1: %2")
-                .arg(self.download_url)
-                .arg(code))
+                self.trUtf8("An error happened while installing updates: "
+                    "%1").arg(str(err)))
         self._exit(1)
 
-    def _download_finished(self):
-        self.file.close()
-        self.patches_paths.append(self.save_path)
-        if self.download_queue:
-            # Start next download
-            self._download_next()
-        else:
-            # All has been downloaded
-            old_dir = self.patch_target_dir
-            # Create target directory(ies)
-            new_dir = old_dir + "_"
-            while isdir(new_dir):
-                new_dir += "_"
-            os.mkdir(new_dir)
-            if len(self.patches_paths) > 1:
-                new_dir2 = new_dir + "_"
-                while isdir(new_dir2):
-                    new_dir2 += "_"
-                os.mkdir(new_dir2)
-            # Apply patches, starting from original dir to new_dir, then 
-            # cycling between new_dir and new_dir2
-            d1 = old_dir
-            d2 = new_dir
-            for patch_index, path in enumerate(self.patches_paths):
-                if patch_index == 1:
-                    d1 = new_dir
-                    d2 = new_dir2
-                elif patch_index > 1:
-                    d1, d2 = d2, d1
-                start_cb, progress_cb = self._patch_callbacks(path, patch_index,
-                        len(self.patches_paths))
-                patch(path, d1, d2, start_cb, progress_cb)
-            # Remove middle-temp dir if we used more than one temp dir
-            if d1 != old_dir:
-                shutil.rmtree(d1)
-            # Remove patch files
-            for path in self.patches_paths:
-                os.unlink(path)
-            # Finish update and quit
-            louie.send(signals.update_finished, self, d2)
-            self._exit(0)
+    def _download_finished(self, new_dir):
+        # The patches were downloaded and applied to new_dir, finish update
+        # and quit
+        louie.send(signals.update_finished, self, new_dir)
+        self._exit(0)
 
     def _exit(self, code):
         """
@@ -167,48 +244,3 @@ class UpdateDialogMixin(object):
         tests.
         """
         sys.exit(code)
-
-    def _patch_callbacks(self, path, patch_index, total_patches):
-        fname = basename(path)
-
-        def start_cb(stage, length):
-            if stage == "patch":
-                text = self.trUtf8("Installing '%1' (%2/%3) : patching "
-                        "files") \
-                                .arg(fname) \
-                                .arg(patch_index + 1) \
-                                .arg(total_patches)
-            elif stage == "plain":
-                text = self.trUtf8("Installing '%1' (%2/%3) : creating "
-                        "new files") \
-                                .arg(fname) \
-                                .arg(patch_index + 1) \
-                                .arg(total_patches)
-            self.start_long_operation(text, length)
-
-        def progress_cb(index):
-            self.update_long_operation(index)
-
-        return start_cb, progress_cb
-
-    def _updates_urls(self):
-        """
-        Check for updates on the HTML page pointed by ``url``.
-        
-        Returns a list of urls pointing to the updates needed to upgrade to the
-        latest version.
-        """
-        try:
-            groups = find_patches_groups(self.update_url,
-                    re.compile(self.patch_files_pattern))
-        except IOError, err:
-            pb = getattr(self, self.progress_bar_name)
-            ol = getattr(self, self.operation_label_name)
-            pb.setValue(0)
-            ol.setText(self.trUtf8("Error opening update url: %1")
-                    .arg(str(err)))
-        else:
-            # Find patches chain entry point
-            current_version = Version(self.current_version)
-            group = groups.get(current_version, [])
-            return [x[2] for x in group]
@@ -1,42 +1,71 @@
+import os
+import sys
+import urllib
 import urllib2
 import re
+import heapq
+import tempfile
 from lxml import etree
-from os.path import join, basename
+from os.path import join, basename, exists, dirname, abspath, isfile
 from urlparse import urljoin
+from optparse import OptionParser
+try:
+    import json
+except ImportError:
+    import simplejson as json
+from pyflu.update import control_sum
 from pyflu.update.version import Version
 from pyflu.odict import odict
 
 
-def find_patches_groups(url, updates_pattern):
+def find_links(url, pattern):
     """
-    Retrieves groups of _consecutive_ patches in an HTML page.
-    
+    Returns the links of the HTML page at *url* whose file name matches the
+    regular expression *pattern*, as a list of ``(match, url)`` tuples.
+    """
+    parser = etree.HTMLParser()
+    doc = etree.parse(urllib2.urlopen(url), parser)
+    pattern = re.compile(pattern)
+    links = []
+    for link in doc.iterfind("//a"):
+        href = urljoin(url, link.get("href"))
+        match = pattern.match(basename(href))
+        if match:
+            links.append((match, href))
+    return links
+
+
+def find_patches(url, updates_pattern):
+    """
+    Retrieves all the patches linked in an HTML page.
+
     The links are parsed from the HTML page found at *url*. Links not
     matching the regular expression *updates_pattern* are filtered.
     *updates_pattern* must define two groups named 'from' and 'to', isolating
     the version numbers of the update.
 
+    Returns a list of ``(from_version, to_version, url)`` tuples, sorted by
+    *from_version*. Versions are :class:`~pyflu.update.version.Version`
+    objects.
+    """
+    updates = [(Version(m.group("from")), Version(m.group("to")), href)
+            for m, href in find_links(url, updates_pattern)]
+    updates.sort(key=lambda x: x[0])
+    return updates
+
+
+def find_patches_groups(url, updates_pattern):
+    """
+    Retrieves groups of _consecutive_ patches in an HTML page, see
+    :func:`find_patches` for the meaning of the arguments.
+    
     Returns an :class:`~pyflu.odict.odict` object, containing lists of update
     chains (updates that can be applied successively to update from a version
     to another), indexed by the first :class:`~pyflu.update.version.Version` 
     object of the chain.
     """
-    # Get links from the HTML update page
-    parser = etree.HTMLParser()
-    doc = etree.parse(urllib2.urlopen(url), parser)
-    updates_pattern = re.compile(updates_pattern)
-    updates = []
-    for link in doc.iterfind("//a"):
-        href = urljoin(url, link.get("href"))
-        filename = basename(href)
-        match = updates_pattern.match(filename)
-        if match:
-            updates.append((
-                Version(match.group("from")), 
-                Version(match.group("to")), 
-                href))
+    updates = find_patches(url, updates_pattern)
     # Create version groups
-    updates.sort(key=lambda x: x[0])
     last_version = None
     groups = odict()
     current_group = []
@@ -50,3 +79,387 @@ def find_patches_groups(url, updates_pattern):
     if current_group:
         groups[current_group[0][0]] = current_group
     return groups
+
+
+def fetch_size(url):
+    """
+    Returns the size in bytes of the file at *url*, given by the
+    Content-Length header of a HEAD request, or None if it is unknown.
+    """
+    request = urllib2.Request(url)
+    request.get_method = lambda: "HEAD"
+    try:
+        response = urllib2.urlopen(request)
+    except (IOError, ValueError):
+        return None
+    try:
+        length = response.info().getheader("Content-Length")
+    finally:
+        response.close()
+    try:
+        return int(length)
+    except (TypeError, ValueError):
+        return None
+
+
+def fetch_sizes(urls):
+    """
+    Returns a dict mapping the urls in *urls* to the sizes returned by 
+    :func:`fetch_size`, unknown sizes are left out.
+    """
+    sizes = {}
+    for url in urls:
+        size = fetch_size(url)
+        if size is not None:
+            sizes[url] = size
+    return sizes
+
+
+def plan_update(patches, current_version, sizes=None, full_install=None,
+        target_version=None):
+    """
+    Find the cheapest chain of *patches* updating *current_version* to
+    *target_version*, by default the latest version that can be reached
+    from *current_version*.
+
+    *patches* is a list of ``(from_version, to_version, url)`` tuples, as
+    returned by :func:`find_patches`. The cost of a chain is the sum of the
+    sizes of its patches, found in the *sizes* dict indexed by urls; patches
+    of unknown size weigh as much as the largest known patch, and all 
+    patches weigh 1 if no size is known, so the chain with the fewest 
+    patches is chosen. Among chains of equal cost, the shortest is chosen.
+
+    *full_install* is an optional ``(version, url, size)`` tuple, describing
+    a full installation package. It is chosen if it installs a more recent
+    version than the patches, if the target can't be reached with patches,
+    or if it is smaller than the chain.
+
+    Returns the list of patches to apply, in order; a single 
+    ``(None, version, url)`` tuple for a full installation; an empty list if
+    *current_version* is already up to date; or None if *target_version* 
+    can't be reached.
+    """
+    if sizes is None:
+        sizes = {}
+    current_version = Version(str(current_version))
+    if target_version is not None:
+        target_version = Version(str(target_version))
+    default_size = max(sizes.values() or [1])
+    edges = {}
+    for update in patches:
+        edges.setdefault(update[0], []).append(update)
+    # Dijkstra's algorithm on the graph of versions, steps maps versions to
+    # the last patch of their cheapest chain
+    heap = [(0, 0, current_version, None)]
+    steps = {}
+    costs = {}
+    while heap:
+        cost, length, version, step = heapq.heappop(heap)
+        if version in steps:
+            continue
+        steps[version] = step
+        costs[version] = cost
+        if target_version is not None and version == target_version:
+            break
+        for update in edges.get(version, []):
+            if update[1] not in steps:
+                heapq.heappush(heap, (cost + sizes.get(update[2], 
+                    default_size), length + 1, update[1], update))
+    if target_version is None:
+        target_version = max(steps)
+    if full_install is not None:
+        install_version, install_url, install_size = full_install
+        install_version = Version(str(install_version))
+        if install_version > current_version \
+                and install_version >= target_version \
+                and (install_version > target_version 
+                    or target_version not in steps
+                    or (install_size is not None 
+                        and install_size < costs[target_version])):
+            return [(None, install_version, install_url)]
+    if target_version not in steps:
+        return None
+    # Walk back the chain
+    chain = []
+    version = target_version
+    while steps[version] is not None:
+        chain.append(steps[version])
+        version = steps[version][0]
+    chain.reverse()
+    return chain
+
+
+class InvalidManifest(ValueError): pass
+
+
+class Manifest(object):
+    """
+    An update manifest, listing the patches and full installation packages
+    published on an update server.
+
+    Manifests are stored in JSON::
+
+        {
+            "format": 1,
+            "patches": [
+                {"from": "1.0", "to": "1.1", "url": "patch-1.0-1.1.tar.bz2",
+                 "size": 1234, "digest": "sha512", "sum": "<hex digest>"}
+            ],
+            "installs": [
+                {"version": "1.1", "url": "setup-1.1.exe", "size": 5678,
+                 "digest": "sha512", "sum": "<hex digest>"}
+            ]
+        }
+
+    Urls are relative to the url of the manifest. Sizes and sums are 
+    optional.
+    """
+
+    format = 1
+
+    def __init__(self, patches=None, installs=None):
+        self.patches = patches or []
+        self.installs = installs or []
+
+    @classmethod
+    def loads(cls, data, base_url=""):
+        """
+        Parse the manifest in the JSON string *data*, urls are resolved
+        relatively to *base_url*.
+        """
+        try:
+            doc = json.loads(data)
+            if doc["format"] != cls.format:
+                raise InvalidManifest("unsupported manifest format: %r" %
+                        doc["format"])
+            patches = []
+            for entry in doc.get("patches", []):
+                entry = dict(entry)
+                Version(entry["from"])
+                Version(entry["to"])
+                entry["url"] = urljoin(base_url, entry["url"])
+                patches.append(entry)
+            installs = []
+            for entry in doc.get("installs", []):
+                entry = dict(entry)
+                Version(entry["version"])
+                entry["url"] = urljoin(base_url, entry["url"])
+                installs.append(entry)
+        except InvalidManifest:
+            raise
+        except (ValueError, KeyError, TypeError, AttributeError), err:
+            raise InvalidManifest("invalid manifest: %s" % err)
+        return cls(patches, installs)
+
+    def dumps(self):
+        return json.dumps({"format": self.format, "patches": self.patches,
+            "installs": self.installs}, indent=1, sort_keys=True)
+
+    def patches_list(self):
+        """
+        Returns the patches in the format of :func:`find_patches`.
+        """
+        updates = [(Version(e["from"]), Version(e["to"]), e["url"]) 
+                for e in self.patches]
+        updates.sort(key=lambda x: x[0])
+        return updates
+
+    def sizes(self):
+        """
+        Returns a dict mapping the urls of patches to their sizes, when
+        known. The size of the full installation package is returned by
+        :meth:`full_install`.
+        """
+        return dict((e["url"], e["size"]) for e in self.patches 
+                if e.get("size") is not None)
+
+    def sums(self):
+        """
+        Returns a dict mapping urls to the ``(digest, hex sum)`` control sums
+        of the files, when known.
+        """
+        return dict((e["url"], (e.get("digest", "sha512"), e["sum"]))
+                for e in self.patches + self.installs
+                if e.get("sum") is not None)
+
+    def full_install(self):
+        """
+        Returns the latest installation package as a ``(version, url, 
+        size)`` tuple, or None.
+        """
+        if not self.installs:
+            return None
+        entry = max(self.installs, key=lambda e: Version(e["version"]))
+        return Version(entry["version"]), entry["url"], entry.get("size")
+
+
+def make_manifest(directory, updates_pattern, installs_pattern=None,
+        digest="sha512"):
+    """
+    Returns a :class:`Manifest` listing the files of *directory*.
+
+    Files matching the regular expression *updates_pattern* are patches (see
+    :func:`find_patches`), and files matching *installs_pattern* are full
+    installation packages (the pattern must define a 'version' group).
+    Control sums of the files are computed with *digest*.
+    """
+    updates_pattern = re.compile(updates_pattern)
+    if installs_pattern is not None:
+        installs_pattern = re.compile(installs_pattern)
+    manifest = Manifest()
+    for name in sorted(os.listdir(directory)):
+        path = join(directory, name)
+        if not isfile(path):
+            continue
+        entry = {
+                "url": urllib.quote(name),
+                "size": os.path.getsize(path),
+            }
+        match = updates_pattern.match(name)
+        if match:
+            entry["from"] = match.group("from")
+            entry["to"] = match.group("to")
+            entries = manifest.patches
+        elif installs_pattern is not None and installs_pattern.match(name):
+            entry["version"] = installs_pattern.match(name).group("version")
+            entries = manifest.installs
+        else:
+            continue
+        entry["digest"] = digest
+        entry["sum"] = control_sum(path, digest).encode("hex")
+        entries.append(entry)
+    return manifest
+
+
+def fetch_manifest(url, cache_path=None):
+    """
+    Download and parse the manifest at *url*.
+
+    If *cache_path* is given, the manifest is stored there along with its
+    ETag and Last-Modified headers, and the next requests are conditional:
+    if the manifest did not change, the server answers with a 304 status and
+    the cached copy is used.
+
+    Raises :class:`IOError` if the manifest can't be downloaded, or 
+    :class:`InvalidManifest` if it can't be parsed.
+    """
+    cached = None
+    if cache_path is not None and exists(cache_path):
+        try:
+            fp = open(cache_path, "rb")
+            try:
+                cached = json.load(fp)
+            finally:
+                fp.close()
+            if cached.get("url") != url:
+                cached = None
+        except ValueError:
+            cached = None
+    request = urllib2.Request(url)
+    if cached is not None:
+        if cached.get("etag"):
+            request.add_header("If-None-Match", cached["etag"])
+        if cached.get("last_modified"):
+            request.add_header("If-Modified-Since", cached["last_modified"])
+    try:
+        response = urllib2.urlopen(request)
+    except urllib2.HTTPError, err:
+        if err.code == 304 and cached is not None:
+            return Manifest.loads(cached["data"], url)
+        raise
+    try:
+        data = response.read()
+        headers = response.info()
+    finally:
+        response.close()
+    manifest = Manifest.loads(data, url)
+    if cache_path is not None:
+        entry = {
+                "url": url,
+                "etag": headers.getheader("ETag"),
+                "last_modified": headers.getheader("Last-Modified"),
+                "data": data,
+            }
+        # Write to a temporary file first, so that the cache is never
+        # truncated
+        fd, tmp_path = tempfile.mkstemp(dir=dirname(abspath(cache_path)))
+        fp = os.fdopen(fd, "wb")
+        try:
+            json.dump(entry, fp)
+        finally:
+            fp.close()
+        if os.name == "nt" and exists(cache_path):
+            os.unlink(cache_path)
+        os.rename(tmp_path, cache_path)
+    return manifest
+
+
+def find_updates(url, updates_pattern, manifest_url=None, cache_path=None,
+        installs_pattern=None, current_version=None):
+    """
+    Find the updates published on a server, for :func:`plan_update`.
+
+    The manifest at *manifest_url* is used if it's given, see 
+    :func:`fetch_manifest`. Otherwise, or if the manifest can't be 
+    retrieved, patches are found in the HTML page at *url* with
+    :func:`find_patches`, and full installation packages with 
+    *installs_pattern* (which must define a 'version' group). Sizes are then
+    retrieved with HEAD requests, for patches starting at *current_version*
+    or later only if it is given.
+
+    Returns a ``(patches, sizes, full_install, sums)`` tuple, see
+    :func:`plan_update` for the meaning of the first items. *sums* maps urls
+    to ``(digest, hex sum)`` control sums, it is only filled from a
+    manifest.
+    """
+    if manifest_url is not None:
+        try:
+            manifest = fetch_manifest(manifest_url, cache_path)
+        except (IOError, InvalidManifest):
+            pass
+        else:
+            return (manifest.patches_list(), manifest.sizes(), 
+                    manifest.full_install(), manifest.sums())
+    patches = find_patches(url, updates_pattern)
+    if current_version is not None:
+        current_version = Version(str(current_version))
+        patches = [p for p in patches if p[0] >= current_version]
+    full_install = None
+    if installs_pattern is not None:
+        installs = [(Version(m.group("version")), href) 
+                for m, href in find_links(url, installs_pattern)]
+        if installs:
+            version, href = max(installs, key=lambda x: x[0])
+            full_install = (version, href, fetch_size(href))
+    return patches, fetch_sizes([p[2] for p in patches]), full_install, {}
+
+
+def makemanifest():
+    """
+    Entry point of the create manifest command line script.
+    """
+    parser = OptionParser(usage="%prog [options] directory manifest")
+    parser.add_option("-p", "--patches-pattern", 
+            default=r"^patch-(?P<from>r?[0-9a-zA-Z_.-]+?)-"
+                r"(?P<to>r?[0-9a-zA-Z_.-]+?)\.tar\.bz2$",
+            help="regular expression matching patch files, with 'from' and "
+            "'to' groups [default: %default]")
+    parser.add_option("-i", "--installs-pattern", 
+            help="regular expression matching full installation packages, "
+            "with a 'version' group")
+    parser.add_option("-s", "--digest", default="sha512",
+            help="algorithm of files control sums [default: %default]")
+    options, args = parser.parse_args()
+    try:
+        directory, manifest_path = args
+    except ValueError:
+        parser.print_usage(sys.stderr)
+        sys.exit(1)
+    manifest = make_manifest(directory, options.patches_pattern,
+            options.installs_pattern, options.digest)
+    fp = open(manifest_path, "wb")
+    try:
+        fp.write(manifest.dumps())
+    finally:
+        fp.close()
+    sys.exit(0)
@@ -15,3 +15,13 @@ class not_updated(Signal):
     Sent by :meth:`~pyflu.update.qt.UpdateDialogMixin.start_update` when no
     update was performed.
     """
+
+
+class full_install_available(Signal):
+    """
+    Sent by :meth:`~pyflu.update.qt.UpdateDialogMixin.start_update` when a
+    full installation package is cheaper to download than the patches, or
+    when there is no patch leading to the latest version.
+
+    It receives a single argument, containing the url of the package.
+    """
@@ -32,6 +32,9 @@ Debian packages ``python-bsdiff`` and ``python-lxml``.
     packages = find_packages(),
 
     entry_points = {
-        "console_scripts": ["pyflu-makepatch = pyflu.update:makepatch"],
+        "console_scripts": [
+            "pyflu-makepatch = pyflu.update:makepatch",
+            "pyflu-makemanifest = pyflu.update.remote:makemanifest",
+        ],
     },
 )